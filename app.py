@@ -409,6 +409,145 @@ def init_warehouse():
     from models import create_sample_warehouse_data
     create_sample_warehouse_data()
 
+@app.cli.command()
+def rebuild_category_tree():
+    """Пересобрать таблицу замыкания иерархии категорий склада"""
+    try:
+        from models import WarehouseCategoryClosure
+        links_count = WarehouseCategoryClosure.rebuild()
+        db.session.commit()
+        print(f"✅ Дерево категорий пересобрано: {links_count} связей")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка пересборки дерева категорий: {e}")
+
+@app.cli.command()
+@click.option('--days', type=int, default=None, help='Пересчитать только последние N дней')
+def rebuild_daily_movement(days):
+    """Пересчитать дневную сводку движения товаров по истории операций"""
+    try:
+        from datetime import datetime, timedelta
+        from models import WarehouseDailyMovement
+        date_from = (datetime.utcnow() - timedelta(days=days)).date() if days else None
+        rows_count = WarehouseDailyMovement.rebuild(date_from=date_from)
+        db.session.commit()
+        print(f"✅ Дневная сводка пересчитана: {rows_count} строк")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка пересчета дневной сводки: {e}")
+
+
+@app.cli.command()
+def rebuild_reservation_index():
+    """Пересобрать индекс резервов склада по дням"""
+    try:
+        from models import WarehouseReservationDay
+        reservations_count = WarehouseReservationDay.rebuild()
+        db.session.commit()
+        print(f"✅ Индекс резервов пересобран: {reservations_count} активных резервов")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка пересборки индекса резервов: {e}")
+
+
+@app.cli.command()
+def forecast_stock():
+    """Пересчитать прогноз расхода товаров и точки заказа"""
+    try:
+        from utils.forecast import compute_forecasts
+        items_count, elapsed = compute_forecasts()
+        db.session.commit()
+        print(f"✅ Прогноз пересчитан: {items_count} товаров, расчёт {elapsed:.3f} с")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка пересчета прогноза: {e}")
+
+
+@app.cli.command()
+def rebuild_valuation():
+    """Пересобрать дневную сводку стоимости склада по журналу операций"""
+    try:
+        from models import WarehouseDailyValuation
+        rows_count = WarehouseDailyValuation.rebuild()
+        db.session.commit()
+        print(f"✅ Сводка стоимости склада пересобрана: {rows_count} строк")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка пересборки сводки стоимости: {e}")
+
+
+@app.cli.command()
+def rebuild_lead_indexes():
+    """Пересобрать индексы лидов: дни рождения и нормализованные телефоны"""
+    try:
+        from models import LEAD_INDEXES
+        counts = {index.__tablename__: index.rebuild() for index in LEAD_INDEXES}
+        db.session.commit()
+        for table, rows_count in counts.items():
+            print(f"✅ Индекс {table} пересобран: {rows_count} записей")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка пересборки индексов лидов: {e}")
+
+
+@app.cli.command()
+def rebuild_search_index():
+    """Перестроить поисковый индекс товаров склада"""
+    try:
+        from utils.search import rebuild_item_search_index
+        backend, items_count = rebuild_item_search_index()
+        print(f"✅ Поисковый индекс перестроен ({backend}): {items_count} товаров")
+    except Exception as e:
+        print(f"❌ Ошибка перестроения поискового индекса: {e}")
+
+
+@app.cli.command()
+@click.option('--date', 'date_str', default=None, help='Снимок на конец дня YYYY-MM-DD (по умолчанию - на начало сегодняшнего дня)')
+def take_stock_snapshot(date_str):
+    """Сохранить снимок остатков склада (запускать периодически, например по cron)"""
+    try:
+        from datetime import datetime, timedelta
+        from models import WarehouseStockSnapshot
+        as_of = datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1) if date_str else None
+        rows_count = WarehouseStockSnapshot.take(as_of=as_of)
+        db.session.commit()
+        print(f"✅ Снимок остатков сохранён: {rows_count} товаров")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка создания снимка остатков: {e}")
+
+
+@app.cli.command()
+@click.option('--months', type=int, default=12, help='Архивировать операции старше N месяцев')
+@click.option('--dry-run', is_flag=True, help='Только показать, что будет перенесено')
+def archive_operations(months, dry_run):
+    """Перенести старые операции склада в архивную таблицу"""
+    try:
+        import calendar
+        from datetime import datetime
+        from models import WarehouseOperationArchive
+        
+        today = datetime.utcnow().date()
+        month_index = today.year * 12 + today.month - 1 - months
+        year, month = divmod(month_index, 12)
+        day = min(today.day, calendar.monthrange(year, month + 1)[1])
+        cutoff = datetime(year, month + 1, day)
+        
+        report = WarehouseOperationArchive.archive(cutoff, dry_run=dry_run)
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        
+        prefix = '🔍 [dry-run] ' if dry_run else '✅ '
+        print(f"{prefix}Операций до {cutoff.date()}: {report['operations']} за {report['days']} дн.")
+        if report['operations']:
+            print(f"   Период: {report['first_operation_at']} - {report['last_operation_at']}")
+            print(f"   Освобождается в warehouse_operations: ~{report['estimated_bytes'] / 1024:.1f} КБ")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка архивации операций: {e}")
+
 
 if __name__ == '__main__':    
     with app.app_context():
@@ -420,4 +559,19 @@ if __name__ == '__main__':
         from models import create_sample_warehouse_data, create_sample_leads_data
         create_sample_warehouse_data()
         create_sample_leads_data()
+        # Дерево категорий, сводка движения и индексы лидов сверяются один раз до приёма запросов
+        from models import (
+            ensure_operation_indexes, ensure_leads_table_indexes,
+            sync_category_closure, sync_daily_movement, sync_lead_indexes
+        )
+        ensure_operation_indexes()
+        ensure_leads_table_indexes()
+        links_count = sync_category_closure()
+        if links_count is not None:
+            print(f"🔁 Дерево категорий пересобрано: {links_count} связей")
+        rows_count = sync_daily_movement()
+        if rows_count is not None:
+            print(f"🔁 Дневная сводка движения пересчитана: {rows_count} строк")
+        for table, rows_count in sync_lead_indexes().items():
+            print(f"🔁 Индекс {table} пересобран: {rows_count} записей")
     app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -48,6 +48,19 @@ class Config:
     CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'simple'
     CACHE_DEFAULT_TIMEOUT = 300
     
+    # Настройки поиска по штрих-коду (внешний сервис и кеш ответов)
+    BARCODE_SERVICE_URL = os.environ.get('BARCODE_SERVICE_URL') or 'https://service-online.su/text/shtrih-kod/'
+    BARCODE_CACHE_TTL_DAYS = int(os.environ.get('BARCODE_CACHE_TTL_DAYS') or 30)
+    BARCODE_NEGATIVE_CACHE_TTL_HOURS = int(os.environ.get('BARCODE_NEGATIVE_CACHE_TTL_HOURS') or 24)
+    BARCODE_LOOKUP_WORKERS = int(os.environ.get('BARCODE_LOOKUP_WORKERS') or 8)
+    BARCODE_BATCH_LIMIT = 200
+    
+    # Прогноз расхода товаров и точки заказа
+    FORECAST_WINDOW_DAYS = int(os.environ.get('FORECAST_WINDOW_DAYS') or 90)
+    FORECAST_EWMA_SPAN_DAYS = int(os.environ.get('FORECAST_EWMA_SPAN_DAYS') or 14)
+    FORECAST_LEAD_TIME_DAYS = int(os.environ.get('FORECAST_LEAD_TIME_DAYS') or 7)
+    FORECAST_SAFETY_FACTOR = float(os.environ.get('FORECAST_SAFETY_FACTOR') or 1.65)
+    
     # Настройки логирования
     LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
     LOG_FILE = os.environ.get('LOG_FILE') or 'app.log'
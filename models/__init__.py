@@ -1,8 +1,13 @@
 # models/__init__.py
 from flask_sqlalchemy import SQLAlchemy
+import calendar
 from datetime import datetime, timedelta
+from decimal import Decimal
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func
+from sqlalchemy import func, event
+from sqlalchemy.orm import aliased, joinedload, load_only
+from sqlalchemy.orm.attributes import set_committed_value
+from utils.helpers import format_phone_number
 
 db = SQLAlchemy()
 
@@ -1647,8 +1652,235 @@ class WarehouseInventory(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'started_at': self.started_at.isoformat() if self.started_at else None,
             'completed_at': self.completed_at.isoformat() if self.completed_at else None,
-            'records_count': len(self.records)
+            'records_count': self.get_summary()['total']
         }
+    
+    def get_summary(self):
+        """Сводка по записям инвентаризации одним агрегирующим запросом"""
+        record = WarehouseInventoryRecord
+        counted = record.actual_quantity.isnot(None)
+        row = db.session.query(
+            func.count(record.id),
+            func.count(record.actual_quantity),
+            func.sum(db.case((counted & (record.difference != 0), 1), else_=0)),
+            func.sum(db.case((counted & (record.difference > 0), record.difference), else_=0)),
+            func.sum(db.case((counted & (record.difference < 0), -record.difference), else_=0))
+        ).filter(record.inventory_id == self.id).one()
+        
+        total, checked, with_difference, surplus, shortage = row
+        return {
+            'total': total or 0,
+            'checked': checked or 0,
+            'pending': (total or 0) - (checked or 0),
+            'with_difference': with_difference or 0,
+            'surplus_quantity': surplus or 0,
+            'shortage_quantity': shortage or 0
+        }
+    
+    def start(self, category_ids=None):
+        """Начать инвентаризацию: зафиксировать остатки одним INSERT ... SELECT
+        
+        category_ids - категории (вместе с подкатегориями); без них
+        инвентаризуется весь склад. Возвращает количество записей.
+        """
+        if self.status != 'planned':
+            raise ValueError('Инвентаризация уже начата или завершена')
+        
+        source = db.select(
+            db.literal(self.id),
+            WarehouseItem.id,
+            func.coalesce(WarehouseItem.current_quantity, 0),
+            db.literal(0),
+            db.literal('pending')
+        ).where(WarehouseItem.status == 'active')
+        
+        if category_ids:
+            source = source.where(WarehouseItem.id.in_(
+                db.select(WarehouseItemCategory.item_id).where(
+                    WarehouseItemCategory.category_id.in_(WarehouseCategory.get_descendant_ids(category_ids))
+                )
+            ))
+        
+        result = db.session.execute(WarehouseInventoryRecord.__table__.insert().from_select(
+            ['inventory_id', 'item_id', 'system_quantity', 'difference', 'status'],
+            source
+        ))
+        
+        self.status = 'in_progress'
+        self.started_at = datetime.utcnow()
+        return result.rowcount
+    
+    def record_counts(self, counts, user_id=None):
+        """Учесть пачку подсчётов: counts - список {item_id | barcode, quantity, increment, comment}
+        
+        При increment=True количество прибавляется к уже посчитанному
+        (повторное сканирование), иначе заменяет его. Товары вне выбранных
+        категорий добавляются в инвентаризацию с текущим остатком системы.
+        Возвращает (обновлено записей, ошибки).
+        """
+        if self.status != 'in_progress':
+            raise ValueError('Инвентаризация не в процессе')
+        
+        barcodes = {str(entry['barcode']) for entry in counts if not entry.get('item_id') and entry.get('barcode')}
+        item_ids_by_barcode = {}
+        for chunk in _chunks(barcodes):
+            item_ids_by_barcode.update(db.session.query(WarehouseItem.barcode, WarehouseItem.id).filter(
+                WarehouseItem.barcode.in_(chunk)
+            ).all())
+        
+        errors = []
+        parsed = []
+        for index, entry in enumerate(counts):
+            item_id = entry.get('item_id') or item_ids_by_barcode.get(str(entry.get('barcode')))
+            if not item_id:
+                errors.append({'index': index, 'barcode': entry.get('barcode'), 'error': 'Товар не найден'})
+                continue
+            try:
+                quantity = int(entry.get('quantity', 1 if entry.get('increment') else 0))
+            except (TypeError, ValueError):
+                errors.append({'index': index, 'item_id': item_id, 'error': 'Некорректное количество'})
+                continue
+            if quantity < 0:
+                errors.append({'index': index, 'item_id': item_id, 'error': 'Количество не может быть отрицательным'})
+                continue
+            parsed.append((int(item_id), quantity, bool(entry.get('increment')), entry.get('comment')))
+        
+        item_ids = {item_id for item_id, _, _, _ in parsed}
+        records = {}
+        for chunk in _chunks(item_ids):
+            records.update(
+                (record.item_id, record)
+                for record in WarehouseInventoryRecord.query.filter(
+                    WarehouseInventoryRecord.inventory_id == self.id,
+                    WarehouseInventoryRecord.item_id.in_(chunk)
+                )
+            )
+        
+        for chunk in _chunks(item_ids - set(records)):
+            for item_id, quantity in db.session.query(WarehouseItem.id, WarehouseItem.current_quantity).filter(
+                WarehouseItem.id.in_(chunk)
+            ).all():
+                record = WarehouseInventoryRecord(
+                    inventory_id=self.id,
+                    item_id=item_id,
+                    system_quantity=quantity or 0,
+                    difference=0,
+                    status='pending'
+                )
+                db.session.add(record)
+                records[item_id] = record
+        
+        now = datetime.utcnow()
+        updated = set()
+        for item_id, quantity, increment, comment in parsed:
+            record = records.get(item_id)
+            if record is None:
+                errors.append({'item_id': item_id, 'error': 'Товар не найден'})
+                continue
+            if increment and record.actual_quantity is not None:
+                quantity += record.actual_quantity
+            record.actual_quantity = quantity
+            record.difference = quantity - record.system_quantity
+            record.status = 'checked'
+            record.checked_at = now
+            record.checked_by = user_id
+            if comment:
+                record.comment = comment
+            updated.add(item_id)
+        
+        return len(updated), errors
+    
+    def claim(self, status, from_statuses, **values):
+        """Атомарно перевести инвентаризацию из from_statuses в status
+        
+        Условный UPDATE ... WHERE status IN (...) пропускает только один из
+        параллельных запросов (двойной клик, повтор клиента); остальные
+        получают False и ничего не меняют.
+        """
+        result = db.session.execute(
+            db.update(WarehouseInventory).where(
+                WarehouseInventory.id == self.id,
+                WarehouseInventory.status.in_(from_statuses)
+            ).values(status=status, **values),
+            execution_options={'synchronize_session': False}
+        )
+        if result.rowcount != 1:
+            return False
+        db.session.refresh(self)
+        return True
+    
+    def complete(self, user_id=None, ip_address=None, missing_as_zero=False):
+        """Завершить инвентаризацию: все корректировки одной транзакцией
+        
+        Инвентаризация сначала занимается (claim), поэтому корректировки
+        применяются ровно один раз; если её уже завершил другой запрос -
+        ValueError. Расхождение (факт - остаток на момент старта) применяется
+        к текущему остатку, поэтому движения во время пересчёта не теряются.
+        При missing_as_zero непосчитанные товары считаются отсутствующими.
+        Возвращает количество созданных операций корректировки.
+        """
+        now = datetime.utcnow()
+        if not self.claim('completed', ('in_progress',), completed_at=now, completed_by=user_id):
+            raise ValueError('Инвентаризация не в процессе')
+        
+        record = WarehouseInventoryRecord
+        
+        if missing_as_zero:
+            db.session.execute(db.update(record).where(
+                record.inventory_id == self.id,
+                record.actual_quantity.is_(None)
+            ).values(
+                actual_quantity=0,
+                difference=-record.system_quantity,
+                status='checked',
+                checked_at=now,
+                checked_by=user_id
+            ))
+        
+        db.session.flush()
+        with_difference = db.and_(
+            record.inventory_id == self.id,
+            record.actual_quantity.isnot(None),
+            record.difference != 0
+        )
+        differences = dict(db.session.query(record.item_id, record.difference).filter(with_difference).all())
+        
+        operations = []
+        if differences:
+            # Блокируем строки товаров в порядке id, чтобы не было взаимных блокировок;
+            # товары берутся подзапросом по записям, без списка ID в параметрах
+            quantities = db.session.query(WarehouseItem.id, WarehouseItem.current_quantity).filter(
+                WarehouseItem.id.in_(db.select(record.item_id).where(with_difference))
+            ).order_by(WarehouseItem.id).with_for_update().all()
+            
+            updates = []
+            for item_id, current_quantity in quantities:
+                before = current_quantity or 0
+                after = max(before + differences[item_id], 0)
+                if after == before:
+                    continue
+                updates.append({'id': item_id, 'current_quantity': after, 'last_operation_at': now, 'updated_at': now})
+                operations.append({
+                    'item_id': item_id,
+                    'operation_type': 'adjust',
+                    'quantity_before': before,
+                    'quantity_after': after,
+                    'quantity_change': after - before,
+                    'reason': 'Инвентаризация',
+                    'comment': self.name,
+                    'document_number': f'INV-{self.id}',
+                    'user_id': user_id,
+                    'ip_address': ip_address,
+                    'created_at': now
+                })
+            
+            if updates:
+                db.session.execute(db.update(WarehouseItem), updates)
+            WarehouseOperation.bulk_create(operations)
+            
+            db.session.execute(db.update(record).where(with_difference).values(status='adjusted'))
+        
+        return len(operations)
 
 
 class WarehouseInventoryRecord(db.Model):
@@ -1677,6 +1909,10 @@ class WarehouseInventoryRecord(db.Model):
     checked_by = db.Column(db.Integer, db.ForeignKey('admins.id'))
     checker = db.relationship('Admin')
     
+    __table_args__ = (
+        db.UniqueConstraint('inventory_id', 'item_id', name='unique_inventory_item'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -1720,8 +1956,12 @@ class WarehouseItem(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_operation_at = db.Column(db.DateTime)
 
-    def to_dict(self, include_categories=True):
-        """Безопасная версия to_dict без ссылок на старое поле category"""
+    def to_dict(self, include_categories=True, categories=None, category_path=None):
+        """Безопасная версия to_dict без ссылок на старое поле category
+
+        categories и category_path можно передать заранее загруженными
+        (см. serialize_many), тогда запросы к базе не выполняются.
+        """
         try:
             data = {
                 'id': self.id,
@@ -1745,7 +1985,8 @@ class WarehouseItem(db.Model):
             # Добавляем информацию о категориях с обработкой ошибок
             if include_categories:
                 try:
-                    categories = self.get_categories()
+                    if categories is None:
+                        categories = self.get_categories()
                     data['categories'] = []
                     data['category_ids'] = []
                     data['category_names'] = []
@@ -1769,7 +2010,10 @@ class WarehouseItem(db.Model):
                                 'name': main_category.name,
                                 'color': getattr(main_category, 'color', '#6366f1')
                             }
-                            data['category_path'] = main_category.get_full_path()
+                            data['category_path'] = (
+                                category_path if category_path is not None
+                                else main_category.get_full_path()
+                            )
                         except Exception as e:
                             print(f"Ошибка создания основной категории: {e}")
                             data['category'] = None
@@ -1787,9 +2031,7 @@ class WarehouseItem(db.Model):
                     data['category_path'] = ''
             
             # Статусы для UI
-            data['is_low_stock'] = (self.current_quantity or 0) <= (self.min_quantity or 0)
-            data['is_out_of_stock'] = (self.current_quantity or 0) == 0
-            data['is_overstocked'] = (self.current_quantity or 0) > (self.max_quantity or 1000)
+            data.update(self.stock_flags(self.current_quantity))
             
             return data
             
@@ -1809,6 +2051,59 @@ class WarehouseItem(db.Model):
                 'error': str(e)
             }
     
+    def stock_flags(self, quantity):
+        """Статусы остатка для UI при количестве quantity (текущем или на дату)"""
+        quantity = quantity or 0
+        return {
+            'is_low_stock': quantity <= (self.min_quantity or 0),
+            'is_out_of_stock': quantity == 0,
+            'is_overstocked': quantity > (self.max_quantity or 1000)
+        }
+    
+    @classmethod
+    def serialize_many(cls, items, include_categories=True):
+        """Сериализовать список товаров фиксированным числом запросов
+
+        Связи товар-категория загружаются одним запросом на всю страницу,
+        пути основных категорий - ещё одним, дальше всё собирается в памяти.
+        """
+        if not include_categories:
+            return [item.to_dict(include_categories=False) for item in items]
+
+        categories_map = cls.load_categories_map([item.id for item in items])
+        main_category_ids = {categories[0].id for categories in categories_map.values() if categories}
+        paths = WarehouseCategory.get_full_paths(main_category_ids)
+
+        result = []
+        for item in items:
+            categories = categories_map.get(item.id, [])
+            category_path = paths.get(categories[0].id, categories[0].name) if categories else ''
+            result.append(item.to_dict(categories=categories, category_path=category_path))
+        return result
+
+    @staticmethod
+    def load_categories_map(item_ids):
+        """Получить категории для набора товаров одним запросом: {item_id: [категории]}"""
+        item_ids = list(item_ids)
+        categories_map = {item_id: [] for item_id in item_ids}
+        if not item_ids:
+            return categories_map
+
+        try:
+            rows = db.session.query(WarehouseItemCategory.item_id, WarehouseCategory).join(
+                WarehouseCategory,
+                WarehouseCategory.id == WarehouseItemCategory.category_id
+            ).filter(
+                WarehouseItemCategory.item_id.in_(item_ids)
+            ).order_by(WarehouseItemCategory.id).all()
+        except Exception as e:
+            print(f"Ошибка получения категорий для товаров: {e}")
+            return categories_map
+
+        for item_id, category in rows:
+            categories_map[item_id].append(category)
+        return categories_map
+
     def get_categories(self):
         """Безопасное получение категорий товара"""
         try:
@@ -1819,7 +2114,9 @@ class WarehouseItem(db.Model):
             categories = db.session.query(WarehouseCategory).join(
                 WarehouseItemCategory,
                 WarehouseCategory.id == WarehouseItemCategory.category_id
-            ).filter(WarehouseItemCategory.item_id == self.id).all()
+            ).filter(
+                WarehouseItemCategory.item_id == self.id
+            ).order_by(WarehouseItemCategory.id).all()
             
             return categories
             
@@ -1882,30 +2179,107 @@ class WarehouseItem(db.Model):
             return False
 
     def update_quantity(self, new_quantity, operation_type, reason=None, user_id=None):
-        """Обновить количество товара с записью операции"""
+        """Установить абсолютное количество товара с записью операции.
+        
+        Строка товара блокируется (SELECT ... FOR UPDATE), поэтому
+        quantity_before в журнале совпадает с реальным остатком даже при
+        параллельных запросах.
+        """
         try:
-            old_quantity = self.current_quantity or 0
-            self.current_quantity = new_quantity
-            self.last_operation_at = datetime.utcnow()
-            self.updated_at = datetime.utcnow()
+            table = WarehouseItem.__table__
+            old_quantity = db.session.execute(
+                db.select(table.c.current_quantity)
+                .where(table.c.id == self.id)
+                .with_for_update()
+            ).scalar() or 0
             
-            # Создаем запись об операции
-            operation = WarehouseOperation(
-                item_id=self.id,
-                operation_type=operation_type,
-                quantity_before=old_quantity,
-                quantity_after=new_quantity,
-                quantity_change=new_quantity - old_quantity,
-                reason=reason,
-                user_id=user_id
+            now = datetime.utcnow()
+            db.session.execute(
+                db.update(table).where(table.c.id == self.id)
+                .values(current_quantity=new_quantity, last_operation_at=now, updated_at=now)
+            )
+            return self._record_quantity_change(
+                old_quantity, new_quantity, operation_type, reason, user_id, now
             )
-            
-            db.session.add(operation)
-            return operation
         except Exception as e:
             print(f"Ошибка обновления количества товара {self.id}: {e}")
             raise
 
+    def change_quantity(self, delta, operation_type, reason=None, user_id=None, check_available=False):
+        """Атомарно изменить количество товара на delta с записью операции.
+        
+        Изменение выполняется одним UPDATE ... SET current_quantity =
+        current_quantity + :delta, так что параллельные поступления и
+        списания не затирают друг друга. При check_available списание
+        проходит только если свободного остатка (без резерва) достаточно,
+        иначе выбрасывается ValueError.
+        """
+        now = datetime.utcnow()
+        table = WarehouseItem.__table__
+        current = func.coalesce(table.c.current_quantity, 0)
+        stmt = db.update(table).where(table.c.id == self.id).values(
+            current_quantity=current + delta,
+            last_operation_at=now,
+            updated_at=now
+        )
+        if check_available and delta < 0:
+            stmt = stmt.where(current - func.coalesce(table.c.reserved_quantity, 0) >= -delta)
+        
+        try:
+            if db.session.get_bind().dialect.update_returning:
+                new_quantity = db.session.execute(
+                    stmt.returning(table.c.current_quantity)
+                ).scalar()
+            else:
+                # Без RETURNING читаем результат под блокировкой строки
+                result = db.session.execute(stmt)
+                new_quantity = None
+                if result.rowcount:
+                    new_quantity = db.session.execute(
+                        db.select(table.c.current_quantity)
+                        .where(table.c.id == self.id)
+                        .with_for_update()
+                    ).scalar()
+        except Exception as e:
+            print(f"Ошибка изменения количества товара {self.id}: {e}")
+            raise
+        
+        if new_quantity is None:
+            row = db.session.execute(
+                db.select(table.c.current_quantity, table.c.reserved_quantity)
+                .where(table.c.id == self.id)
+            ).first()
+            available = (row[0] or 0) - (row[1] or 0) if row else 0
+            raise ValueError(f'Недостаточно товара на складе. Доступно: {available} {self.unit}')
+        
+        return self._record_quantity_change(
+            new_quantity - delta, new_quantity, operation_type, reason, user_id, now
+        )
+
+    def _record_quantity_change(self, old_quantity, new_quantity, operation_type, reason, user_id, now):
+        """Синхронизировать объект с БД и добавить запись журнала в ту же транзакцию"""
+        set_committed_value(self, 'current_quantity', new_quantity)
+        set_committed_value(self, 'last_operation_at', now)
+        set_committed_value(self, 'updated_at', now)
+        
+        operation = WarehouseOperation(
+            item_id=self.id,
+            operation_type=operation_type,
+            quantity_before=old_quantity,
+            quantity_after=new_quantity,
+            quantity_change=new_quantity - old_quantity,
+            reason=reason,
+            user_id=user_id,
+            created_at=now
+        )
+        db.session.add(operation)
+        
+        # Сразу учитываем операцию в дневной сводке движения
+        WarehouseDailyMovement.record([
+            (now.date(), self.id, operation_type, new_quantity - old_quantity)
+        ])
+        return operation
+
     @classmethod
     def search(cls, query, category_ids=None, status='active'):
         """Поиск товаров с поддержкой множественных категорий"""
@@ -1914,20 +2288,15 @@ class WarehouseItem(db.Model):
             
             if category_ids:
                 # Поиск товаров, которые относятся к любой из указанных категорий
-                search_query = search_query.join(WarehouseItemCategory).filter(
-                    WarehouseItemCategory.category_id.in_(category_ids)
-                ).distinct()
+                search_query = search_query.filter(cls.id.in_(
+                    db.session.query(WarehouseItemCategory.item_id).filter(
+                        WarehouseItemCategory.category_id.in_(category_ids)
+                    )
+                ))
             
             if query:
-                search_filter = f"%{query}%"
-                search_query = search_query.filter(
-                    db.or_(
-                        cls.name.ilike(search_filter),
-                        cls.barcode.ilike(search_filter),
-                        cls.sku.ilike(search_filter),
-                        cls.description.ilike(search_filter)
-                    )
-                )
+                from utils.search import apply_item_search
+                search_query = apply_item_search(search_query, query, rank=True)
             
             return search_query
         except Exception as e:
@@ -1966,94 +2335,1366 @@ class WarehouseOperation(db.Model):
     quantity_after = db.Column(db.Integer, nullable=False)
     quantity_change = db.Column(db.Integer, nullable=False)  # Может быть отрицательным
     
-    # Причина и комментарий
-    reason = db.Column(db.String(100))  # Причина операции
-    comment = db.Column(db.Text)  # Дополнительный комментарий
-    document_number = db.Column(db.String(50))  # Номер документа (накладной, заявки и т.д.)
+    # Причина и комментарий
+    reason = db.Column(db.String(100))  # Причина операции
+    comment = db.Column(db.Text)  # Дополнительный комментарий
+    document_number = db.Column(db.String(50))  # Номер документа (накладной, заявки и т.д.)
+    
+    # Метаданные
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    ip_address = db.Column(db.String(45))  # IP адрес пользователя
+    
+    # Индексы под курсорную пагинацию (created_at, id) и историю по товару.
+    # AUTOINCREMENT: SQLite не переиспользует id операций, перенесённых в архив
+    __table_args__ = (
+        db.Index('ix_warehouse_operations_created_id', 'created_at', 'id'),
+        db.Index('ix_warehouse_operations_item_created', 'item_id', 'created_at'),
+        {'sqlite_autoincrement': True},
+    )
+    
+    @classmethod
+    def bulk_create(cls, rows):
+        """Вставить пачку операций одним executemany и учесть их в дневной сводке
+
+        rows - список словарей с полями WarehouseOperation; created_at по умолчанию - сейчас.
+        """
+        if not rows:
+            return 0
+        
+        now = datetime.utcnow()
+        for row in rows:
+            row.setdefault('created_at', now)
+        
+        db.session.execute(db.insert(cls), rows)
+        WarehouseDailyMovement.record(
+            (row['created_at'].date(), row['item_id'], row['operation_type'], row['quantity_change'])
+            for row in rows
+        )
+        return len(rows)
+    
+    # Поля, доступные в проекции fields= (колонки и связи)
+    COLUMN_FIELDS = (
+        'id', 'item_id', 'user_id', 'operation_type', 'quantity_before', 'quantity_after',
+        'quantity_change', 'reason', 'comment', 'document_number', 'created_at', 'ip_address'
+    )
+    FIELDS = COLUMN_FIELDS + ('operation_description', 'item', 'user')
+    
+    @classmethod
+    def load_options(cls, fields=None, entity=None):
+        """Опции загрузки под проекцию: только нужные колонки и связи одним JOIN
+        
+        entity - сущность запроса (например, aliased-объединение с архивом).
+        """
+        entity = entity or cls
+        include_item = fields is None or 'item' in fields
+        include_user = fields is None or 'user' in fields
+        
+        options = []
+        if fields is not None:
+            columns = {'id', 'created_at'} | (set(fields) & set(cls.COLUMN_FIELDS))
+            if include_item:
+                columns.add('item_id')
+            if include_user:
+                columns.add('user_id')
+            if 'operation_description' in fields:
+                columns.add('operation_type')
+            options.append(load_only(*(getattr(entity, column) for column in cls.COLUMN_FIELDS if column in columns)))
+        
+        if include_item:
+            options.append(joinedload(entity.item).load_only(
+                WarehouseItem.name, WarehouseItem.barcode, WarehouseItem.sku, WarehouseItem.unit
+            ))
+        if include_user:
+            options.append(joinedload(entity.user).load_only(Admin.name, Admin.email))
+        return options
+    
+    @classmethod
+    def serialize_many(cls, operations, include_item=True, include_user=True, fields=None):
+        """Сериализовать список операций фиксированным числом запросов
+        
+        Товары и пользователи, не загруженные JOIN-ом, догружаются одним
+        запросом каждый; категории товаров и их пути - ещё двумя.
+        """
+        if fields is not None:
+            include_item = include_item and 'item' in fields
+            include_user = include_user and 'user' in fields
+        
+        relations = []
+        if include_item:
+            relations.append(('item', WarehouseItem, 'item_id'))
+        if include_user:
+            relations.append(('user', Admin, 'user_id'))
+        
+        # Догружаем связи пачкой: дальше ленивая загрузка берёт их из identity map
+        for relation, model, key in relations:
+            missing = {
+                getattr(operation, key) for operation in operations
+                if relation in db.inspect(operation).unloaded and getattr(operation, key) is not None
+            }
+            if missing:
+                model.query.filter(model.id.in_(missing)).all()
+        
+        categories_map = {}
+        paths = {}
+        if include_item:
+            categories_map = WarehouseItem.load_categories_map({operation.item_id for operation in operations})
+            paths = WarehouseCategory.get_full_paths(
+                {categories[0].id for categories in categories_map.values() if categories}
+            )
+        
+        result = []
+        for operation in operations:
+            categories = categories_map.get(operation.item_id, []) if include_item else None
+            category_path = paths.get(categories[0].id, categories[0].name) if categories else None
+            result.append(operation.to_dict(
+                include_item=include_item,
+                include_user=include_user,
+                categories=categories,
+                category_path=category_path,
+                fields=fields
+            ))
+        return result
+    
+    def to_dict(self, include_item=True, include_user=True, categories=None, category_path=None, fields=None):
+        """Безопасное преобразование в словарь без ссылок на старые поля
+        
+        categories и category_path можно передать заранее загруженными
+        (см. serialize_many), fields - ограничить набор полей ответа.
+        """
+        try:
+            data = {
+                field: getattr(self, field)
+                for field in self.COLUMN_FIELDS
+                if fields is None or field in fields
+            }
+            if 'created_at' in data:
+                data['created_at'] = self.created_at.isoformat() if self.created_at else None
+            
+            if fields is not None:
+                include_item = include_item and 'item' in fields
+                include_user = include_user and 'user' in fields
+            
+            if include_item and self.item:
+                try:
+                    # Получаем категории товара безопасно
+                    if categories is None:
+                        categories = self.item.get_categories()
+                    category_names = [cat.name for cat in categories] if categories else []
+                    
+                    data['item'] = {
+                        'id': self.item.id,
+                        'name': self.item.name,
+                        'barcode': self.item.barcode,
+                        'sku': self.item.sku,
+                        'unit': self.item.unit,
+                        'category_names': category_names
+                    }
+                    
+                    # Для обратной совместимости
+                    if categories:
+                        data['item']['category'] = categories[0].name
+                        data['item']['category_path'] = category_path or categories[0].get_full_path()
+                    else:
+                        data['item']['category'] = 'Без категории'
+                        data['item']['category_path'] = 'Без категории'
+                        
+                except Exception as e:
+                    print(f"Ошибка получения информации о товаре {self.item_id}: {e}")
+                    data['item'] = {
+                        'id': self.item.id,
+                        'name': self.item.name or 'Неизвестный товар',
+                        'category': 'Не определена',
+                        'category_names': []
+                    }
+            
+            if include_user and self.user:
+                data['user'] = {
+                    'id': self.user.id,
+                    'name': self.user.name,
+                    'email': self.user.email
+                }
+            
+            # Читаемое описание операции
+            if fields is None or 'operation_description' in fields:
+                data['operation_description'] = OPERATION_TYPES.get(self.operation_type, self.operation_type)
+            
+            return data
+            
+        except Exception as e:
+            print(f"Ошибка преобразования операции {self.id}: {e}")
+            return {
+                'id': self.id,
+                'error': str(e),
+                'operation_type': getattr(self, 'operation_type', 'unknown'),
+                'item_id': getattr(self, 'item_id', None)
+            }
+
+
+# create_all не добавляет индексы в уже существующую таблицу - на старых
+# базах они создаются при запуске приложения
+OPERATION_INDEXES = {
+    'ix_warehouse_operations_created_id': (
+        'CREATE INDEX IF NOT EXISTS ix_warehouse_operations_created_id '
+        'ON warehouse_operations (created_at, id)'
+    ),
+    'ix_warehouse_operations_item_created': (
+        'CREATE INDEX IF NOT EXISTS ix_warehouse_operations_item_created '
+        'ON warehouse_operations (item_id, created_at)'
+    ),
+}
+
+
+def ensure_operation_indexes():
+    """Создать недостающие индексы warehouse_operations (при запуске приложения)"""
+    for ddl in OPERATION_INDEXES.values():
+        db.session.execute(db.text(ddl))
+    db.session.commit()
+
+# Строк или ID на один запрос: upsert из 200 строк по 5 колонок укладывается
+# в лимит 999 параметров старых сборок SQLite и в 65535 у PostgreSQL
+SQL_CHUNK_SIZE = 200
+
+
+def _chunks(values, chunk_size=SQL_CHUNK_SIZE):
+    """Разбить последовательность на списки не длиннее chunk_size"""
+    values = list(values)
+    for start in range(0, len(values), chunk_size):
+        yield values[start:start + chunk_size]
+
+
+def _upsert_increment(table, rows, keys, increments, chunk_size=SQL_CHUNK_SIZE):
+    """Вставить строки, а для существующих ключей прибавить значения колонок increments
+
+    SQLite и PostgreSQL - INSERT ... ON CONFLICT DO UPDATE пачками по chunk_size
+    строк; прочие СУБД - UPDATE существующей строки, иначе INSERT.
+    """
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        
+        for chunk in _chunks(rows, chunk_size):
+            stmt = dialect_insert(table).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=list(keys),
+                set_={column: table.c[column] + stmt.excluded[column] for column in increments}
+            )
+            db.session.execute(stmt)
+        return
+    
+    for row in rows:
+        result = db.session.execute(
+            table.update().where(
+                *(table.c[key] == row[key] for key in keys)
+            ).values({column: table.c[column] + row[column] for column in increments})
+        )
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(**row))
+
+
+class WarehouseDailyMovement(db.Model):
+    """Дневная сводка движения товаров (предагрегат операций для аналитики)"""
+    __tablename__ = 'warehouse_daily_movement'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False, index=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), nullable=False)
+    operation_type = db.Column(db.String(20), nullable=False)
+    
+    operations_count = db.Column(db.Integer, nullable=False, default=0)  # Количество операций
+    quantity_total = db.Column(db.Integer, nullable=False, default=0)    # Сумма abs(quantity_change)
+    
+    __table_args__ = (
+        db.UniqueConstraint('date', 'item_id', 'operation_type', name='unique_daily_movement'),
+    )
+    
+    @classmethod
+    def record(cls, operations):
+        """Учесть операции в сводке
+
+        operations - итерируемое из кортежей (date, item_id, operation_type, quantity_change).
+        Операции с одинаковым ключом схлопываются, затем выполняется upsert.
+        """
+        operations = list(operations)
+        totals = {}
+        for date, item_id, operation_type, quantity_change in operations:
+            key = (date, item_id, operation_type)
+            count, quantity = totals.get(key, (0, 0))
+            totals[key] = (count + 1, quantity + abs(quantity_change or 0))
+        
+        if not totals:
+            return
+        
+        # Те же изменения количества - в дневную сводку стоимости склада
+        WarehouseDailyValuation.record(
+            (date, item_id, quantity_change) for date, item_id, _, quantity_change in operations
+        )
+        
+        rows = [
+            {
+                'date': date,
+                'item_id': item_id,
+                'operation_type': operation_type,
+                'operations_count': count,
+                'quantity_total': quantity
+            }
+            for (date, item_id, operation_type), (count, quantity) in totals.items()
+        ]
+        
+        _upsert_increment(
+            cls.__table__, rows,
+            keys=('date', 'item_id', 'operation_type'),
+            increments=('operations_count', 'quantity_total')
+        )
+    
+    @classmethod
+    def rebuild(cls, date_from=None, date_to=None):
+        """Пересчитать сводку по истории операций (полностью или за дни [date_from, date_to))
+        
+        Учитываются и живые, и архивные операции.
+        """
+        table = cls.__table__
+        since = datetime.combine(date_from, datetime.min.time()) if date_from else None
+        operations = WarehouseOperationArchive.ledger(since)
+        operation_date = func.date(operations.c.created_at)
+        
+        delete_stmt = table.delete()
+        source = db.select(
+            operation_date,
+            operations.c.item_id,
+            operations.c.operation_type,
+            func.count(operations.c.id),
+            func.coalesce(func.sum(func.abs(operations.c.quantity_change)), 0)
+        )
+        
+        if date_from:
+            delete_stmt = delete_stmt.where(table.c.date >= date_from)
+            source = source.where(operations.c.created_at >= since)
+        
+        if date_to:
+            delete_stmt = delete_stmt.where(table.c.date < date_to)
+            source = source.where(operations.c.created_at < datetime.combine(date_to, datetime.min.time()))
+        
+        source = source.group_by(
+            operation_date,
+            operations.c.item_id,
+            operations.c.operation_type
+        )
+        
+        db.session.execute(delete_stmt)
+        result = db.session.execute(table.insert().from_select(
+            ['date', 'item_id', 'operation_type', 'operations_count', 'quantity_total'],
+            source
+        ))
+        return result.rowcount
+    
+    @classmethod
+    def is_current(cls):
+        """Учтены ли в сводке все операции журнала (живые и архивные)
+        
+        На существующей базе create_all создаёт сводку пустой - её нужно заполнить.
+        """
+        operations = WarehouseOperationArchive.ledger(None)
+        recorded = db.session.query(func.coalesce(func.sum(cls.operations_count), 0)).scalar()
+        expected = db.session.query(func.count()).select_from(operations).filter(
+            operations.c.created_at.isnot(None)
+        ).scalar()
+        return recorded == expected
+
+
+def sync_daily_movement():
+    """Пересчитать дневную сводку движения, если она расходится с журналом (при запуске приложения)
+
+    Возвращает количество строк после пересчёта или None, если он не понадобился.
+    """
+    if WarehouseDailyMovement.is_current():
+        return None
+    rows_count = WarehouseDailyMovement.rebuild()
+    db.session.commit()
+    return rows_count
+
+
+class WarehouseDailyValuation(db.Model):
+    """Дневная сводка стоимости склада по корневым категориям
+    
+    Хранятся изменения за день (value_change, quantity_change); стоимость на
+    дату - накопленная сумма изменений до неё включительно. Товар относится к
+    корню своей основной (первой) категории, category_id = 0 - без категории.
+    """
+    __tablename__ = 'warehouse_daily_valuation'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False, index=True)
+    category_id = db.Column(db.Integer, nullable=False, default=0)
+    
+    value_change = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    quantity_change = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('date', 'category_id', name='unique_daily_valuation'),
+    )
+    
+    @classmethod
+    def item_roots(cls, item_ids=None):
+        """Корневая категория и себестоимость товаров: {item_id: (root_id, cost_price)}
+        
+        item_ids=None - все товары одним запросом без списка ID, иначе по
+        запросу на каждые SQL_CHUNK_SIZE товаров.
+        """
+        if item_ids is None:
+            return cls._item_roots_chunk(None)
+        
+        roots = {}
+        for chunk_ids in _chunks(item_ids):
+            roots.update(cls._item_roots_chunk(chunk_ids))
+        return roots
+    
+    @staticmethod
+    def _item_roots_chunk(item_ids):
+        first_link = db.select(
+            WarehouseItemCategory.item_id,
+            func.min(WarehouseItemCategory.id).label('link_id')
+        ).group_by(WarehouseItemCategory.item_id)
+        if item_ids is not None:
+            first_link = first_link.where(WarehouseItemCategory.item_id.in_(item_ids))
+        first_link = first_link.subquery()
+        
+        root = aliased(WarehouseCategory)
+        roots = db.select(
+            WarehouseCategoryClosure.descendant_id,
+            WarehouseCategoryClosure.ancestor_id.label('root_id')
+        ).join(root, root.id == WarehouseCategoryClosure.ancestor_id).where(
+            root.parent_id.is_(None)
+        ).subquery()
+        
+        query = db.session.query(
+            WarehouseItem.id, roots.c.root_id, WarehouseItem.cost_price
+        ).outerjoin(
+            first_link, first_link.c.item_id == WarehouseItem.id
+        ).outerjoin(
+            WarehouseItemCategory, WarehouseItemCategory.id == first_link.c.link_id
+        ).outerjoin(
+            roots, roots.c.descendant_id == WarehouseItemCategory.category_id
+        )
+        if item_ids is not None:
+            query = query.filter(WarehouseItem.id.in_(item_ids))
+        rows = query.all()
+        
+        return {item_id: (root_id or 0, Decimal(cost_price or 0)) for item_id, root_id, cost_price in rows}
+    
+    @classmethod
+    def record(cls, changes):
+        """Учесть изменения количества: changes - кортежи (date, item_id, quantity_change)"""
+        changes = [change for change in changes if change[2]]
+        if not changes:
+            return
+        
+        roots = cls.item_roots({item_id for _, item_id, _ in changes})
+        values = []
+        for date, item_id, quantity_change in changes:
+            root_id, cost_price = roots.get(item_id, (0, Decimal(0)))
+            values.append((date, root_id, cost_price * quantity_change, quantity_change))
+        cls.record_values(values)
+    
+    @classmethod
+    def record_values(cls, changes):
+        """Upsert изменений стоимости: changes - кортежи (date, category_id, value_change, quantity_change)"""
+        totals = {}
+        for date, category_id, value_change, quantity_change in changes:
+            value, quantity = totals.get((date, category_id), (Decimal(0), 0))
+            totals[(date, category_id)] = (value + Decimal(value_change), quantity + quantity_change)
+        
+        rows = [
+            {'date': date, 'category_id': category_id, 'value_change': value, 'quantity_change': quantity}
+            for (date, category_id), (value, quantity) in totals.items()
+            if value or quantity
+        ]
+        _upsert_increment(
+            cls.__table__, rows,
+            keys=('date', 'category_id'),
+            increments=('value_change', 'quantity_change')
+        )
+    
+    @classmethod
+    def record_moves(cls, roots_before):
+        """Перенести стоимость товаров, сменивших корневую категорию
+        
+        roots_before - результат item_roots() до изменения категорий.
+        """
+        if not roots_before:
+            return
+        
+        today = datetime.utcnow().date()
+        quantities = {}
+        for item_ids in _chunks(roots_before):
+            quantities.update(db.session.query(WarehouseItem.id, WarehouseItem.current_quantity).filter(
+                WarehouseItem.id.in_(item_ids)
+            ).all())
+        
+        changes = []
+        for item_id, (root_id, cost_price) in cls.item_roots(roots_before).items():
+            old_root_id = roots_before[item_id][0]
+            quantity = quantities.get(item_id) or 0
+            if old_root_id != root_id and quantity:
+                changes.append((today, old_root_id, -cost_price * quantity, -quantity))
+                changes.append((today, root_id, cost_price * quantity, quantity))
+        cls.record_values(changes)
+    
+    @classmethod
+    def series(cls, date_from, date_to):
+        """Стоимость на конец каждого дня: (начальные остатки {category_id: (value, quantity)}, дневные изменения)"""
+        opening = {
+            category_id: (Decimal(value or 0), int(quantity or 0))
+            for category_id, value, quantity in db.session.query(
+                cls.category_id, func.sum(cls.value_change), func.sum(cls.quantity_change)
+            ).filter(cls.date < date_from).group_by(cls.category_id).all()
+        }
+        
+        daily = db.session.query(
+            cls.date, cls.category_id, cls.value_change, cls.quantity_change
+        ).filter(
+            cls.date >= date_from,
+            cls.date <= date_to
+        ).order_by(cls.date).all()
+        return opening, daily
+    
+    @classmethod
+    def is_consistent(cls):
+        """Сходится ли накопленная стоимость с текущими остатками
+        
+        Расхождение означает изменения мимо учёта (или сводку, которая ещё не
+        строилась) - тогда её нужно пересобрать.
+        """
+        recorded = db.session.query(func.coalesce(func.sum(cls.value_change), 0)).scalar()
+        actual = db.session.query(func.coalesce(func.sum(
+            func.coalesce(WarehouseItem.current_quantity, 0) * func.coalesce(WarehouseItem.cost_price, 0)
+        ), 0)).scalar()
+        return abs(Decimal(str(recorded)) - Decimal(str(actual))) < Decimal('0.01')
+    
+    @classmethod
+    def rebuild(cls):
+        """Пересобрать сводку по журналу операций (живому и архивному)
+        
+        История себестоимости не хранится, поэтому прошлые дни оцениваются по
+        текущей себестоимости; стоимость на сегодня совпадает с остатками.
+        """
+        db.session.execute(cls.__table__.delete())
+        
+        operations = WarehouseOperationArchive.ledger(None)
+        operation_date = func.date(operations.c.created_at)
+        ledger = db.session.query(
+            operation_date, operations.c.item_id, func.sum(operations.c.quantity_change)
+        ).group_by(operation_date, operations.c.item_id).all()
+        
+        items = db.session.query(WarehouseItem.id, WarehouseItem.current_quantity).all()
+        roots = cls.item_roots()
+        
+        changes = []
+        ledger_totals = {}
+        first_date = datetime.utcnow().date()
+        for day, item_id, quantity_change in ledger:
+            if isinstance(day, str):  # SQLite возвращает date() строкой
+                day = datetime.strptime(day, '%Y-%m-%d').date()
+            root_id, cost_price = roots.get(item_id, (0, Decimal(0)))
+            changes.append((day, root_id, cost_price * (quantity_change or 0), quantity_change or 0))
+            ledger_totals[item_id] = ledger_totals.get(item_id, 0) + (quantity_change or 0)
+            first_date = min(first_date, day)
+        
+        # Остаток, не объяснённый журналом (данные до начала учёта), - на первый день
+        for item_id, current_quantity in items:
+            opening = (current_quantity or 0) - ledger_totals.get(item_id, 0)
+            if opening:
+                root_id, cost_price = roots.get(item_id, (0, Decimal(0)))
+                changes.append((first_date, root_id, cost_price * opening, opening))
+        
+        cls.record_values(changes)
+        return db.session.query(func.count(cls.id)).scalar()
+
+
+@event.listens_for(db.session, 'before_flush')
+def _record_cost_price_revaluation(session, flush_context, instances):
+    # Смена себестоимости меняет стоимость остатка без операций склада
+    changes = []
+    for obj in session.dirty:
+        if not isinstance(obj, WarehouseItem):
+            continue
+        history = db.inspect(obj).attrs.cost_price.history
+        if not history.has_changes() or not history.deleted:
+            continue
+        old_price = Decimal(history.deleted[0] or 0)
+        new_price = Decimal(obj.cost_price or 0)
+        if old_price != new_price and obj.current_quantity:
+            changes.append((obj.id, (new_price - old_price) * obj.current_quantity))
+    
+    if changes:
+        today = datetime.utcnow().date()
+        roots = WarehouseDailyValuation.item_roots([item_id for item_id, _ in changes])
+        WarehouseDailyValuation.record_values(
+            (today, roots.get(item_id, (0, None))[0], value, 0) for item_id, value in changes
+        )
+
+
+class WarehouseOperationArchive(db.Model):
+    """Архив старых операций склада (перенесены из warehouse_operations)"""
+    __tablename__ = 'warehouse_operations_archive'
+    
+    # id сохраняется из исходной таблицы
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('admins.id'), nullable=True)
+    
+    operation_type = db.Column(db.String(20), nullable=False)
+    quantity_before = db.Column(db.Integer, nullable=False)
+    quantity_after = db.Column(db.Integer, nullable=False)
+    quantity_change = db.Column(db.Integer, nullable=False)
+    
+    reason = db.Column(db.String(100))
+    comment = db.Column(db.Text)
+    document_number = db.Column(db.String(50))
+    
+    created_at = db.Column(db.DateTime)
+    ip_address = db.Column(db.String(45))
+    
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_warehouse_operations_archive_created_id', 'created_at', 'id'),
+        db.Index('ix_warehouse_operations_archive_item_created', 'item_id', 'created_at'),
+    )
+    
+    # Общие с warehouse_operations колонки
+    COLUMNS = (
+        'id', 'item_id', 'user_id', 'operation_type', 'quantity_before', 'quantity_after',
+        'quantity_change', 'reason', 'comment', 'document_number', 'created_at', 'ip_address'
+    )
+    
+    # Оценка места на строку без текстовых полей: числа, дата и два индекса
+    ROW_OVERHEAD_BYTES = 96
+    
+    @classmethod
+    def archived_until(cls):
+        """Время самой поздней архивной операции (None - архив пуст)"""
+        return db.session.execute(db.select(func.max(cls.created_at))).scalar()
+    
+    @staticmethod
+    def live_since():
+        """Время самой ранней операции в warehouse_operations (None - таблица пуста)"""
+        return db.session.execute(db.select(func.min(WarehouseOperation.created_at))).scalar()
+    
+    @classmethod
+    def ledger(cls, since=None):
+        """Таблица операций для запросов с created_at >= since
+        
+        Если окно запроса не доходит до архива - только warehouse_operations,
+        иначе UNION ALL живых и архивных операций с теми же колонками.
+        """
+        live = WarehouseOperation.__table__
+        archived_until = cls.archived_until()
+        if archived_until is None or (since is not None and since > archived_until):
+            return live
+        
+        archive = cls.__table__
+        return db.union_all(
+            db.select(*[live.c[name] for name in cls.COLUMNS]),
+            db.select(*[archive.c[name] for name in cls.COLUMNS])
+        ).subquery('warehouse_operations_all')
+    
+    @classmethod
+    def operation_entity(cls, with_archive=False):
+        """Сущность для ORM-запросов операций: WarehouseOperation или её alias над UNION с архивом"""
+        if not with_archive:
+            return WarehouseOperation
+        source = cls.ledger()
+        if source is WarehouseOperation.__table__:
+            return WarehouseOperation
+        return aliased(WarehouseOperation, source)
+    
+    @staticmethod
+    def _live_reuses_ids():
+        """Может ли БД выдать новой операции id удалённой (SQLite-таблица без AUTOINCREMENT)"""
+        if db.session.get_bind().dialect.name != 'sqlite':
+            return False
+        table_sql = db.session.execute(
+            db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': WarehouseOperation.__tablename__}
+        ).scalar()
+        return 'AUTOINCREMENT' not in (table_sql or '').upper()
+    
+    @classmethod
+    def archive(cls, cutoff, dry_run=False):
+        """Перенести в архив операции с created_at < cutoff
+        
+        Перед переносом пересчитывается дневная сводка за архивируемые дни и
+        сохраняется снимок остатков на cutoff, чтобы аналитике и запросам
+        "на дату" после cutoff не нужен был архив. Возвращает отчёт; при
+        dry_run ничего не меняется.
+        """
+        live = WarehouseOperation.__table__
+        condition = live.c.created_at < cutoff
+        if cls._live_reuses_ids():
+            # Таблица создана без AUTOINCREMENT: последняя по id операция не
+            # переносится, иначе SQLite выдаст её id новой операции
+            max_id = db.select(func.max(live.c.id)).scalar_subquery()
+            condition = db.and_(condition, live.c.id < max_id)
+        
+        text_bytes = sum(
+            func.coalesce(func.length(live.c[name]), 0)
+            for name in ('operation_type', 'reason', 'comment', 'document_number', 'ip_address')
+        )
+        operations_count, first_at, last_at, days_count, text_total = db.session.execute(
+            db.select(
+                func.count(live.c.id),
+                func.min(live.c.created_at),
+                func.max(live.c.created_at),
+                func.count(func.distinct(func.date(live.c.created_at))),
+                func.coalesce(func.sum(text_bytes), 0)
+            ).where(condition)
+        ).one()
+        
+        report = {
+            'cutoff': cutoff.isoformat(),
+            'operations': operations_count,
+            'first_operation_at': first_at.isoformat() if first_at else None,
+            'last_operation_at': last_at.isoformat() if last_at else None,
+            'days': days_count,
+            'estimated_bytes': operations_count * cls.ROW_OVERHEAD_BYTES + int(text_total or 0),
+            'dry_run': dry_run
+        }
+        
+        if dry_run or not operations_count:
+            return report
+        
+        WarehouseDailyMovement.rebuild(date_from=first_at.date(), date_to=last_at.date() + timedelta(days=1))
+        WarehouseStockSnapshot.take(as_of=cutoff)
+        
+        db.session.execute(cls.__table__.insert().from_select(
+            list(cls.COLUMNS) + ['archived_at'],
+            db.select(*[live.c[name] for name in cls.COLUMNS], db.literal(datetime.utcnow())).where(condition)
+        ))
+        db.session.execute(live.delete().where(condition))
+        return report
+
+
+class WarehouseStockSnapshot(db.Model):
+    """Снимок остатков товаров на момент времени (для запросов "на дату")"""
+    __tablename__ = 'warehouse_stock_snapshots'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # Снимок учитывает все операции с created_at < as_of
+    as_of = db.Column(db.DateTime, nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('item_id', 'as_of', name='unique_item_stock_snapshot'),
+        db.Index('ix_warehouse_stock_snapshots_as_of', 'as_of'),
+    )
+    
+    @classmethod
+    def take(cls, as_of=None):
+        """Сохранить остатки всех товаров на момент as_of (по умолчанию - начало текущих суток)
+        
+        Остаток считается от текущего количества назад по операциям после as_of.
+        Повторный снимок на тот же момент перезаписывается. Возвращает число строк.
+        """
+        if as_of is None:
+            as_of = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+        
+        operations = WarehouseOperationArchive.ledger(as_of)
+        changes_since = db.select(
+            func.coalesce(func.sum(operations.c.quantity_change), 0)
+        ).where(
+            operations.c.item_id == WarehouseItem.id,
+            operations.c.created_at >= as_of
+        ).scalar_subquery()
+        
+        source = db.select(
+            db.literal(as_of),
+            WarehouseItem.id,
+            func.coalesce(WarehouseItem.current_quantity, 0) - changes_since,
+            db.literal(datetime.utcnow())
+        ).where(
+            db.or_(WarehouseItem.created_at.is_(None), WarehouseItem.created_at < as_of)
+        )
+        
+        table = cls.__table__
+        db.session.execute(table.delete().where(table.c.as_of == as_of))
+        result = db.session.execute(table.insert().from_select(
+            ['as_of', 'item_id', 'quantity', 'created_at'], source
+        ))
+        return result.rowcount
+    
+    @classmethod
+    def quantity_as_of(cls, as_of):
+        """Выражение остатка товара на момент as_of и подзапрос ближайшего снимка
+        
+        Возвращает (quantity, snapshot): snapshot нужно присоединить к запросу
+        товаров через outerjoin по snapshot.c.item_id. Если снимок до as_of есть,
+        к нему добавляются только операции между снимком и as_of; иначе остаток
+        считается от текущего количества назад по операциям после as_of.
+        """
+        latest = db.select(
+            cls.item_id,
+            func.max(cls.as_of).label('as_of')
+        ).where(cls.as_of <= as_of).group_by(cls.item_id).subquery()
+        
+        snapshot = db.select(cls.item_id, cls.as_of, cls.quantity).join(
+            latest, db.and_(cls.item_id == latest.c.item_id, cls.as_of == latest.c.as_of)
+        ).subquery()
+        
+        # Архив нужен, только если самый ранний используемый момент (as_of или
+        # снимок до него) раньше последней архивной операции
+        earliest_snapshot = db.session.execute(
+            db.select(func.min(cls.as_of)).where(cls.as_of <= as_of)
+        ).scalar()
+        operations = WarehouseOperationArchive.ledger(min(as_of, earliest_snapshot or as_of))
+        changes = func.coalesce(func.sum(operations.c.quantity_change), 0)
+        changes_after_snapshot = db.select(changes).where(
+            operations.c.item_id == WarehouseItem.id,
+            operations.c.created_at >= snapshot.c.as_of,
+            operations.c.created_at < as_of
+        ).scalar_subquery()
+        changes_after_as_of = db.select(changes).where(
+            operations.c.item_id == WarehouseItem.id,
+            operations.c.created_at >= as_of
+        ).scalar_subquery()
+        
+        quantity = db.case(
+            (snapshot.c.quantity.isnot(None), snapshot.c.quantity + changes_after_snapshot),
+            else_=func.coalesce(WarehouseItem.current_quantity, 0) - changes_after_as_of
+        )
+        return quantity, snapshot
+
+
+class DataVersion(db.Model):
+    """Счётчики версий данных для инвалидации кешей между процессами
+
+    Версии увеличиваются после коммита изменивших данные транзакций, в
+    отдельной короткой транзакции: строка счётчика не блокируется на время
+    записи и не выстраивает параллельные операции склада в очередь.
+    """
+    __tablename__ = 'data_versions'
+    
+    key = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @classmethod
+    def get(cls, key):
+        """Текущая версия (0, если данные ещё не менялись)"""
+        return db.session.execute(
+            db.select(cls.version).where(cls.key == key)
+        ).scalar() or 0
+    
+    @classmethod
+    def bump(cls, *keys, connection=None):
+        """Увеличить версии в транзакции connection (по умолчанию - текущей сессии)"""
+        connection = connection or db.session
+        table = cls.__table__
+        now = datetime.utcnow()
+        for key in keys:
+            result = connection.execute(
+                table.update().where(table.c.key == key).values(
+                    version=table.c.version + 1,
+                    updated_at=now
+                )
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(key=key, version=1, updated_at=now))
+
+
+# Таблицы, изменения которых делают устаревшим снимок дашборда склада
+WAREHOUSE_VERSIONED_TABLES = {
+    'warehouse_items',
+    'warehouse_categories',
+    'warehouse_item_categories',
+    'warehouse_operations',
+}
+
+# Таблицы, от которых зависит дерево категорий со счётчиками товаров
+CATEGORY_TREE_TABLES = {
+    'warehouse_items',
+    'warehouse_categories',
+    'warehouse_item_categories',
+}
+
+
+# Таблицы, от которых зависит статистика лидов
+LEADS_VERSIONED_TABLES = {'leads'}
+
+
+def _changed_version_keys(session):
+    keys = set()
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table in LEADS_VERSIONED_TABLES:
+            keys.add('leads')
+        if table in WAREHOUSE_VERSIONED_TABLES:
+            keys.add('warehouse')
+        if table in CATEGORY_TREE_TABLES:
+            # Для изменённого товара на счётчики влияет только смена статуса
+            if table != 'warehouse_items' or obj not in session.dirty \
+                    or db.inspect(obj).attrs.status.history.has_changes():
+                keys.add('warehouse_categories')
+    return keys
+
+
+def _pending_version_keys(session):
+    """Ключи версий, изменённые в текущей транзакции сессии; увеличиваются после коммита"""
+    return session.info.setdefault('data_version_keys', set())
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_data_versions(session, flush_context):
+    keys = _changed_version_keys(session)
+    if keys:
+        _pending_version_keys(session).update(keys)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _collect_data_versions_bulk(orm_execute_state):
+    # Массовые insert/update/delete через ORM (query.delete(), insert(Model)) идут мимо flush
+    if orm_execute_state.is_select:
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None:
+        return
+    table = mapper.local_table.name
+    keys = []
+    if table in LEADS_VERSIONED_TABLES:
+        keys.append('leads')
+    if table in WAREHOUSE_VERSIONED_TABLES:
+        keys.append('warehouse')
+    if table in CATEGORY_TREE_TABLES:
+        keys.append('warehouse_categories')
+    if keys:
+        _pending_version_keys(orm_execute_state.session).update(keys)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _bump_data_versions(session):
+    keys = session.info.pop('data_version_keys', None)
+    if not keys:
+        return
+    # Данные уже закоммичены; если увеличить версию не удалось, кеши обновятся по max_age
+    try:
+        with db.engine.begin() as connection:
+            DataVersion.bump(*sorted(keys), connection=connection)
+    except Exception as e:
+        print(f"⚠️ Не удалось обновить версии данных {sorted(keys)}: {e}")
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_data_versions(session):
+    session.info.pop('data_version_keys', None)
+
+
+class BarcodeLookupCache(db.Model):
+    """Кеш ответов внешнего сервиса штрих-кодов (включая отрицательные)"""
+    __tablename__ = 'barcode_lookup_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    barcode = db.Column(db.String(100), unique=True, nullable=False, index=True)
+    found = db.Column(db.Boolean, nullable=False, default=False)  # False - сервис не знает код
+    data = db.Column(db.JSON)  # Ответ сервиса для найденных кодов
+    
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    @classmethod
+    def get_fresh(cls, barcodes):
+        """Непросроченные записи кеша: {barcode: запись}"""
+        if not barcodes:
+            return {}
+        entries = cls.query.filter(
+            cls.barcode.in_(barcodes),
+            cls.expires_at > datetime.utcnow()
+        ).all()
+        return {entry.barcode: entry for entry in entries}
+    
+    @classmethod
+    def store(cls, results, positive_ttl, negative_ttl):
+        """Сохранить результаты запросов {barcode: данные или None}
+        
+        Записи пишутся в точке сохранения текущей транзакции; коммит - за
+        вызывающим кодом. Запись в кеш не критична: при гонке с параллельным
+        запросом (уникальный штрих-код) откатывается только точка сохранения.
+        """
+        if not results:
+            return
+        
+        now = datetime.utcnow()
+        try:
+            with db.session.begin_nested():
+                existing = {
+                    entry.barcode: entry
+                    for entry in cls.query.filter(cls.barcode.in_(list(results))).all()
+                }
+                for barcode, data in results.items():
+                    entry = existing.get(barcode)
+                    if entry is None:
+                        entry = cls(barcode=barcode)
+                        db.session.add(entry)
+                    entry.found = data is not None
+                    entry.data = data
+                    entry.fetched_at = now
+                    entry.expires_at = now + (positive_ttl if data is not None else negative_ttl)
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить кеш штрих-кодов: {e}")
+
+
+class WarehouseScanSession(db.Model):
+    """Сессия сканирования: сканы копятся на сервере и проводятся одной пачкой"""
+    __tablename__ = 'warehouse_scan_sessions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('admins.id'), nullable=True)
+    user = db.relationship('Admin')
+    
+    operation_type = db.Column(db.String(20), nullable=False)  # add, remove
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, committed, cancelled
+    reason = db.Column(db.String(100))
+    comment = db.Column(db.Text)
+    document_number = db.Column(db.String(50))
+    
+    scans_count = db.Column(db.Integer, nullable=False, default=0)  # Сколько сканов пришло всего
+    result = db.Column(db.JSON)  # Итог проведения: количество операций и ошибки
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    committed_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'operation_type': self.operation_type,
+            'operation_description': OPERATION_TYPES.get(self.operation_type, self.operation_type),
+            'status': self.status,
+            'reason': self.reason,
+            'comment': self.comment,
+            'document_number': self.document_number,
+            'scans_count': self.scans_count,
+            'result': self.result,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'committed_at': self.committed_at.isoformat() if self.committed_at else None
+        }
+    
+    def add_scans(self, scans):
+        """Учесть сканы: scans - итерируемое из (barcode, quantity)
+        
+        Повторные штрих-коды схлопываются в одну строку с суммой количества,
+        строки сессии обновляются одним upsert. Возвращает число сканов.
+        """
+        totals = {}
+        for barcode, quantity in scans:
+            totals[barcode] = totals.get(barcode, 0) + quantity
+        if not totals:
+            return 0
+        
+        item_ids = {}
+        for barcodes in _chunks(totals):
+            item_ids.update(db.session.query(WarehouseItem.barcode, WarehouseItem.id).filter(
+                WarehouseItem.barcode.in_(barcodes)
+            ).all())
+        
+        rows = [
+            {'session_id': self.id, 'barcode': barcode, 'item_id': item_ids.get(barcode), 'quantity': quantity}
+            for barcode, quantity in totals.items()
+        ]
+        _upsert_increment(
+            WarehouseScanSessionLine.__table__, rows,
+            keys=('session_id', 'barcode'), increments=('quantity',)
+        )
+        
+        scans_count = sum(totals.values())
+        self.scans_count = (self.scans_count or 0) + scans_count
+        return scans_count
+    
+    def get_lines(self):
+        """Строки сессии с товарами: [(строка, товар или None)]"""
+        return db.session.query(WarehouseScanSessionLine, WarehouseItem).outerjoin(
+            WarehouseItem, WarehouseItem.id == WarehouseScanSessionLine.item_id
+        ).filter(
+            WarehouseScanSessionLine.session_id == self.id
+        ).order_by(WarehouseScanSessionLine.id).all()
+    
+    def resolve_unknown_barcodes(self):
+        """Привязать к товарам штрих-коды, которых не было в базе на момент скана"""
+        line = WarehouseScanSessionLine
+        db.session.execute(db.update(line).where(
+            line.session_id == self.id,
+            line.item_id.is_(None)
+        ).values(item_id=db.select(WarehouseItem.id).where(
+            WarehouseItem.barcode == line.barcode
+        ).scalar_subquery()))
+
+
+class WarehouseScanSessionLine(db.Model):
+    """Строка сессии сканирования: суммарное количество по штрих-коду"""
+    __tablename__ = 'warehouse_scan_session_lines'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('warehouse_scan_sessions.id'), nullable=False)
+    barcode = db.Column(db.String(100), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), nullable=True)  # NULL - код не найден
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'barcode', name='unique_scan_session_barcode'),
+    )
+
+
+class WarehouseItemForecast(db.Model):
+    """Прогноз расхода товара: скорость расхода, дни до нуля и точка заказа
+    
+    Таблица целиком пересчитывается задачей прогноза (utils.forecast).
+    """
+    __tablename__ = 'warehouse_item_forecasts'
+    
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), primary_key=True)
+    item = db.relationship('WarehouseItem')
+    
+    window_days = db.Column(db.Integer, nullable=False)
+    average_daily_usage = db.Column(db.Float, nullable=False, default=0)  # Скользящее среднее за окно
+    ewma_daily_usage = db.Column(db.Float, nullable=False, default=0)     # Экспоненциальное среднее
+    usage_std = db.Column(db.Float, nullable=False, default=0)
+    
+    available_quantity = db.Column(db.Integer, nullable=False, default=0)
+    days_to_stockout = db.Column(db.Float, index=True)  # NULL - расхода нет
+    stockout_date = db.Column(db.Date)
+    reorder_point = db.Column(db.Integer, nullable=False, default=0)
+    suggested_order = db.Column(db.Integer, nullable=False, default=0)
+    
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'item_id': self.item_id,
+            'window_days': self.window_days,
+            'average_daily_usage': round(self.average_daily_usage, 3),
+            'ewma_daily_usage': round(self.ewma_daily_usage, 3),
+            'usage_std': round(self.usage_std, 3),
+            'available_quantity': self.available_quantity,
+            'days_to_stockout': round(self.days_to_stockout, 1) if self.days_to_stockout is not None else None,
+            'stockout_date': self.stockout_date.isoformat() if self.stockout_date else None,
+            'reorder_point': self.reorder_point,
+            'suggested_order': self.suggested_order,
+            'needs_reorder': self.available_quantity <= self.reorder_point and self.ewma_daily_usage > 0,
+            'computed_at': self.computed_at.isoformat() if self.computed_at else None
+        }
+
+
+class WarehouseReservation(db.Model):
+    """Резерв товара под заявку на период [start_date, end_date] включительно"""
+    __tablename__ = 'warehouse_reservations'
+    
+    MAX_PERIOD_DAYS = 31  # Резерв раскладывается по дням, длинные периоды не нужны
+    
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), nullable=False)
+    item = db.relationship('WarehouseItem', backref='reservations')
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'), nullable=True, index=True)
+    booking = db.relationship('Booking', backref='warehouse_reservations')
+    user_id = db.Column(db.Integer, db.ForeignKey('admins.id'), nullable=True)
+    
+    quantity = db.Column(db.Integer, nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='active')  # active, released
+    comment = db.Column(db.Text)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    released_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_warehouse_reservations_item_period', 'item_id', 'start_date', 'end_date'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'item_id': self.item_id,
+            'item_name': self.item.name if self.item else None,
+            'booking_id': self.booking_id,
+            'user_id': self.user_id,
+            'quantity': self.quantity,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'status': self.status,
+            'comment': self.comment,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'released_at': self.released_at.isoformat() if self.released_at else None
+        }
+    
+    @classmethod
+    def validate_period(cls, start_date, end_date):
+        if end_date < start_date:
+            raise ValueError('Дата окончания резерва раньше даты начала')
+        if (end_date - start_date).days >= cls.MAX_PERIOD_DAYS:
+            raise ValueError(f'Период резерва не может быть длиннее {cls.MAX_PERIOD_DAYS} дней')
+    
+    @classmethod
+    def availability(cls, item_ids, start_date, end_date, lock=False):
+        """Свободный остаток товаров на период: {item_id: данные}
+        
+        Пиковый резерв за период берётся из индекса WarehouseReservationDay
+        одним запросом по (item_id, date). При lock=True строки товаров
+        блокируются (SELECT ... FOR UPDATE) до конца транзакции.
+        """
+        cls.validate_period(start_date, end_date)
+        item_ids = sorted(set(item_ids))
+        if not item_ids:
+            return {}
+        
+        items_query = WarehouseItem.query.filter(WarehouseItem.id.in_(item_ids)).order_by(WarehouseItem.id)
+        if lock:
+            items_query = items_query.with_for_update().populate_existing()
+        items = items_query.all()
+        
+        peaks = dict(db.session.query(
+            WarehouseReservationDay.item_id,
+            func.max(WarehouseReservationDay.quantity)
+        ).filter(
+            WarehouseReservationDay.item_id.in_(item_ids),
+            WarehouseReservationDay.date >= start_date,
+            WarehouseReservationDay.date <= end_date
+        ).group_by(WarehouseReservationDay.item_id).all())
+        
+        result = {}
+        for item in items:
+            stock = (item.current_quantity or 0) - (item.reserved_quantity or 0)
+            reserved = peaks.get(item.id) or 0
+            result[item.id] = {
+                'item_id': item.id,
+                'name': item.name,
+                'unit': item.unit,
+                'status': item.status,
+                'current_quantity': item.current_quantity or 0,
+                'reserved_for_period': reserved,
+                'available': max(stock - reserved, 0)
+            }
+        return result
+    
+    @classmethod
+    def reserve(cls, lines, start_date, end_date, booking_id=None, user_id=None, comment=None):
+        """Зарезервировать товары на период: lines - {item_id: количество}
+        
+        Возвращает (reservations, conflicts). Если хотя бы одной позиции не
+        хватает, ничего не резервируется и conflicts содержит недостающие позиции.
+        """
+        available = cls.availability(lines, start_date, end_date, lock=True)
+        
+        conflicts = []
+        for item_id, quantity in lines.items():
+            info = available.get(item_id)
+            if info is None or info['status'] != 'active':
+                conflicts.append({'item_id': item_id, 'requested': quantity, 'available': 0,
+                                  'error': 'Товар не найден'})
+            elif info['available'] < quantity:
+                conflicts.append({'item_id': item_id, 'name': info['name'], 'requested': quantity,
+                                  'available': info['available']})
+        
+        if conflicts:
+            return [], conflicts
+        
+        reservations = [
+            cls(
+                item_id=item_id,
+                booking_id=booking_id,
+                user_id=user_id,
+                quantity=quantity,
+                start_date=start_date,
+                end_date=end_date,
+                comment=comment
+            )
+            for item_id, quantity in lines.items()
+        ]
+        db.session.add_all(reservations)
+        WarehouseReservationDay.apply(
+            (item_id, start_date, end_date, quantity) for item_id, quantity in lines.items()
+        )
+        return reservations, []
+    
+    @classmethod
+    def release_many(cls, reservations):
+        """Снять активные резервы и вернуть количество снятых"""
+        active = [reservation for reservation in reservations if reservation.status == 'active']
+        now = datetime.utcnow()
+        for reservation in active:
+            reservation.status = 'released'
+            reservation.released_at = now
+        WarehouseReservationDay.apply(
+            (r.item_id, r.start_date, r.end_date, -r.quantity) for r in active
+        )
+        return len(active)
+    
+    @classmethod
+    def release_for_booking(cls, booking_id):
+        """Снять все активные резервы заявки (например, при её отмене)"""
+        return cls.release_many(cls.query.filter_by(booking_id=booking_id, status='active').all())
+
+
+class WarehouseReservationDay(db.Model):
+    """Индекс резервов по дням: сколько единиц товара занято на дату
+    
+    Каждый активный резерв учтён во всех днях своего периода, поэтому
+    проверка «свободен ли товар X на дату D» - поиск по первичному ключу.
+    """
+    __tablename__ = 'warehouse_reservation_days'
     
-    # Метаданные
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    ip_address = db.Column(db.String(45))  # IP адрес пользователя
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse_items.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
     
-    def to_dict(self, include_item=True, include_user=True):
-        """Безопасное преобразование в словарь без ссылок на старые поля"""
-        try:
-            data = {
-                'id': self.id,
-                'item_id': self.item_id,
-                'user_id': self.user_id,
-                'operation_type': self.operation_type,
-                'quantity_before': self.quantity_before,
-                'quantity_after': self.quantity_after,
-                'quantity_change': self.quantity_change,
-                'reason': self.reason,
-                'comment': self.comment,
-                'document_number': self.document_number,
-                'created_at': self.created_at.isoformat() if self.created_at else None,
-                'ip_address': self.ip_address
-            }
-            
-            if include_item and self.item:
-                try:
-                    # Получаем категории товара безопасно
-                    categories = self.item.get_categories()
-                    category_names = [cat.name for cat in categories] if categories else []
-                    
-                    data['item'] = {
-                        'id': self.item.id,
-                        'name': self.item.name,
-                        'barcode': self.item.barcode,
-                        'sku': self.item.sku,
-                        'unit': self.item.unit,
-                        'category_names': category_names
-                    }
-                    
-                    # Для обратной совместимости
-                    if categories:
-                        data['item']['category'] = categories[0].name
-                        data['item']['category_path'] = categories[0].get_full_path()
-                    else:
-                        data['item']['category'] = 'Без категории'
-                        data['item']['category_path'] = 'Без категории'
-                        
-                except Exception as e:
-                    print(f"Ошибка получения информации о товаре {self.item_id}: {e}")
-                    data['item'] = {
-                        'id': self.item.id,
-                        'name': self.item.name or 'Неизвестный товар',
-                        'category': 'Не определена',
-                        'category_names': []
-                    }
-            
-            if include_user and self.user:
-                data['user'] = {
-                    'id': self.user.id,
-                    'name': self.user.name,
-                    'email': self.user.email
-                }
-            
-            # Читаемое описание операции
-            operation_descriptions = {
-                'add': 'Поступление',
-                'remove': 'Списание',
-                'transfer': 'Перемещение',
-                'adjust': 'Корректировка',
-                'reserve': 'Резервирование',
-                'unreserve': 'Снятие резерва'
-            }
-            
-            data['operation_description'] = operation_descriptions.get(self.operation_type, self.operation_type)
-            
-            return data
-            
-        except Exception as e:
-            print(f"Ошибка преобразования операции {self.id}: {e}")
-            return {
-                'id': self.id,
-                'error': str(e),
-                'operation_type': getattr(self, 'operation_type', 'unknown'),
-                'item_id': getattr(self, 'item_id', None)
-            }
+    @classmethod
+    def apply(cls, changes):
+        """Учесть изменения резервов: changes - кортежи (item_id, start_date, end_date, delta)"""
+        totals = {}
+        for item_id, start_date, end_date, delta in changes:
+            day = start_date
+            while day <= end_date:
+                totals[(item_id, day)] = totals.get((item_id, day), 0) + delta
+                day += timedelta(days=1)
+        
+        rows = [
+            {'item_id': item_id, 'date': day, 'quantity': quantity}
+            for (item_id, day), quantity in totals.items() if quantity
+        ]
+        if not rows:
+            return
+        
+        table = cls.__table__
+        _upsert_increment(table, rows, keys=('item_id', 'date'), increments=('quantity',))
+        
+        # Освободившиеся дни не храним
+        for item_ids in _chunks({row['item_id'] for row in rows}):
+            db.session.execute(table.delete().where(
+                table.c.item_id.in_(item_ids),
+                table.c.quantity <= 0
+            ))
+    
+    @classmethod
+    def rebuild(cls):
+        """Пересобрать индекс по активным резервам. Возвращает количество учтённых резервов"""
+        db.session.execute(cls.__table__.delete())
+        active = db.session.query(
+            WarehouseReservation.item_id,
+            WarehouseReservation.start_date,
+            WarehouseReservation.end_date,
+            WarehouseReservation.quantity
+        ).filter(WarehouseReservation.status == 'active').all()
+        cls.apply(tuple(row) for row in active)
+        return len(active)
+
 
 # Дополнительные функции для работы с моделями
 
@@ -2293,11 +3934,21 @@ def clear_warehouse_data():
     """Очистить все данные склада"""
     try:
         # Удаляем в правильном порядке из-за внешних ключей
+        WarehouseItemForecast.query.delete()
+        WarehouseDailyValuation.query.delete()
+        WarehouseScanSessionLine.query.delete()
+        WarehouseScanSession.query.delete()
+        WarehouseReservationDay.query.delete()
+        WarehouseReservation.query.delete()
         WarehouseOperation.query.delete()
+        WarehouseOperationArchive.query.delete()
+        WarehouseDailyMovement.query.delete()
+        WarehouseStockSnapshot.query.delete()
         WarehouseInventoryRecord.query.delete()
         WarehouseInventory.query.delete()
         WarehouseItemCategory.query.delete()  # Новая таблица связи
         WarehouseItem.query.delete()
+        WarehouseCategoryClosure.query.delete()
         WarehouseCategory.query.delete()
         
         db.session.commit()
@@ -2377,10 +4028,20 @@ def clear_warehouse_data():
     """Очистить все данные склада"""
     try:
         # Удаляем в правильном порядке из-за внешних ключей
+        WarehouseItemForecast.query.delete()
+        WarehouseDailyValuation.query.delete()
+        WarehouseScanSessionLine.query.delete()
+        WarehouseScanSession.query.delete()
+        WarehouseReservationDay.query.delete()
+        WarehouseReservation.query.delete()
         WarehouseOperation.query.delete()
+        WarehouseOperationArchive.query.delete()
+        WarehouseDailyMovement.query.delete()
+        WarehouseStockSnapshot.query.delete()
         WarehouseInventoryRecord.query.delete()
         WarehouseInventory.query.delete()
         WarehouseItem.query.delete()
+        WarehouseCategoryClosure.query.delete()
         WarehouseCategory.query.delete()
         
         db.session.commit()
@@ -2495,12 +4156,55 @@ class WarehouseCategory(db.Model):
     
     def get_full_path(self):
         """Получить полный путь категории"""
-        path = [self.name]
-        parent = self.parent
-        while parent:
-            path.insert(0, parent.name)
-            parent = parent.parent
-        return ' > '.join(path)
+        return WarehouseCategory.get_full_paths([self.id]).get(self.id, self.name)
+
+    @classmethod
+    def get_full_paths(cls, category_ids):
+        """Получить полные пути для набора категорий одним запросом: {category_id: 'A > B > C'}"""
+        category_ids = list(category_ids)
+        if not category_ids:
+            return {}
+
+        rows = db.session.query(
+            WarehouseCategoryClosure.descendant_id,
+            cls.name
+        ).join(
+            cls, cls.id == WarehouseCategoryClosure.ancestor_id
+        ).filter(
+            WarehouseCategoryClosure.descendant_id.in_(category_ids)
+        ).order_by(
+            WarehouseCategoryClosure.descendant_id,
+            WarehouseCategoryClosure.depth.desc()
+        ).all()
+
+        names = {}
+        for category_id, name in rows:
+            names.setdefault(category_id, []).append(name)
+        return {category_id: ' > '.join(path) for category_id, path in names.items()}
+    
+    @classmethod
+    def get_items_counts(cls):
+        """Количество активных товаров по всем категориям одним запросом
+        
+        Возвращает {category_id: (с подкатегориями, только в самой категории)}.
+        Товар, привязанный к нескольким категориям поддерева, считается один раз.
+        """
+        closure = WarehouseCategoryClosure
+        rows = db.session.query(
+            closure.ancestor_id,
+            func.count(func.distinct(WarehouseItemCategory.item_id)),
+            func.count(func.distinct(db.case(
+                (closure.depth == 0, WarehouseItemCategory.item_id)
+            )))
+        ).join(
+            WarehouseItemCategory, WarehouseItemCategory.category_id == closure.descendant_id
+        ).join(
+            WarehouseItem, WarehouseItem.id == WarehouseItemCategory.item_id
+        ).filter(
+            WarehouseItem.status == 'active'
+        ).group_by(closure.ancestor_id).all()
+        
+        return {category_id: (total, direct) for category_id, total, direct in rows}
     
     def get_items_count(self, include_subcategories=True):
         """Получить количество товаров в категории"""
@@ -2520,12 +4224,36 @@ class WarehouseCategory(db.Model):
             ).count()
     
     def get_all_child_ids(self):
-        """Получить все ID дочерних категорий рекурсивно"""
-        child_ids = []
-        for child in self.children:
-            child_ids.append(child.id)
-            child_ids.extend(child.get_all_child_ids())
-        return child_ids
+        """Получить все ID дочерних категорий (один запрос к таблице замыкания)"""
+        rows = db.session.query(WarehouseCategoryClosure.descendant_id).filter(
+            WarehouseCategoryClosure.ancestor_id == self.id,
+            WarehouseCategoryClosure.depth > 0
+        ).all()
+        return [descendant_id for descendant_id, in rows]
+
+    @classmethod
+    def get_descendant_ids(cls, category_ids):
+        """Получить ID категорий вместе со всеми их подкатегориями одним запросом"""
+        category_ids = {int(cid) for cid in category_ids if cid is not None}
+        if not category_ids:
+            return []
+
+        rows = db.session.query(WarehouseCategoryClosure.descendant_id).filter(
+            WarehouseCategoryClosure.ancestor_id.in_(category_ids)
+        ).distinct().all()
+
+        # Исходные ID сохраняем даже если категория не найдена (как и раньше)
+        category_ids.update(descendant_id for descendant_id, in rows)
+        return list(category_ids)
+
+    def subtree_contains(self, category_id):
+        """Проверить, входит ли category_id в поддерево категории (включая её саму)"""
+        if category_id is None:
+            return False
+        return db.session.query(WarehouseCategoryClosure.query.filter(
+            WarehouseCategoryClosure.ancestor_id == self.id,
+            WarehouseCategoryClosure.descendant_id == category_id
+        ).exists()).scalar()
 
     @classmethod
     def find_or_create_by_name(cls, name, parent_id=None):
@@ -2543,9 +4271,162 @@ class WarehouseCategory(db.Model):
             )
             db.session.add(category)
             db.session.flush()  # Получаем ID
-        
+
         return category
 
+    @classmethod
+    def resolve_names(cls, names):
+        """Найти или создать корневые категории по списку имён: {name: id}
+        
+        Существующие категории ищутся одним запросом, недостающие создаются
+        одним flush (вместо flush на каждое имя в find_or_create_by_name).
+        """
+        names = {name.strip() for name in names if name and name.strip()}
+        if not names:
+            return {}
+        
+        resolved = dict(db.session.query(cls.name, cls.id).filter(
+            cls.name.in_(names),
+            cls.parent_id.is_(None)
+        ).all())
+        
+        missing = [
+            cls(name=name, parent_id=None, color='#6366f1')  # Цвет по умолчанию
+            for name in sorted(names - resolved.keys())
+        ]
+        if missing:
+            db.session.add_all(missing)
+            db.session.flush()  # Получаем ID
+            resolved.update({category.name: category.id for category in missing})
+        
+        return resolved
+
+
+class WarehouseCategoryClosure(db.Model):
+    """Таблица замыкания иерархии категорий: все пары предок-потомок с глубиной"""
+    __tablename__ = 'warehouse_category_closure'
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('warehouse_categories.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('warehouse_categories.id'), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False, default=0)  # 0 - сама категория, 1 - прямой потомок и т.д.
+
+    @classmethod
+    def rebuild(cls):
+        """Полностью пересобрать таблицу замыкания по полю parent_id"""
+        parents = dict(db.session.query(WarehouseCategory.id, WarehouseCategory.parent_id).all())
+
+        rows = []
+        for category_id in parents:
+            ancestor_id, depth, seen = category_id, 0, set()
+            # Поднимаемся к корню; seen защищает от зацикленных данных
+            while ancestor_id is not None and ancestor_id not in seen:
+                seen.add(ancestor_id)
+                rows.append({'ancestor_id': ancestor_id, 'descendant_id': category_id, 'depth': depth})
+                ancestor_id = parents.get(ancestor_id)
+                depth += 1
+
+        db.session.query(cls).delete()
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+        return len(rows)
+
+    @classmethod
+    def is_current(cls):
+        """Есть ли в замыкании ссылка на себя для каждой категории
+
+        На существующей базе create_all создаёт таблицу пустой - её нужно заполнить.
+        """
+        categories = db.session.query(func.count(WarehouseCategory.id)).scalar()
+        self_links = db.session.query(func.count()).select_from(cls).filter(cls.depth == 0).scalar()
+        return self_links >= categories
+
+
+def sync_category_closure():
+    """Заполнить таблицу замыкания категорий, если она не покрывает все категории (при запуске приложения)
+
+    Возвращает количество связей после пересборки или None, если она не понадобилась.
+    """
+    if WarehouseCategoryClosure.is_current():
+        return None
+    links_count = WarehouseCategoryClosure.rebuild()
+    db.session.commit()
+    return links_count
+
+
+def _closure_insert_node(connection, category_id, parent_id):
+    """Добавить в замыкание новую категорию: ссылку на себя и на всех предков родителя"""
+    closure = WarehouseCategoryClosure.__table__
+    connection.execute(closure.insert().values(ancestor_id=category_id, descendant_id=category_id, depth=0))
+    if parent_id is not None:
+        connection.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            db.select(
+                closure.c.ancestor_id,
+                db.literal(category_id),
+                closure.c.depth + 1
+            ).where(closure.c.descendant_id == parent_id)
+        ))
+
+
+@event.listens_for(WarehouseCategory, 'after_insert')
+def _closure_after_category_insert(mapper, connection, target):
+    _closure_insert_node(connection, target.id, target.parent_id)
+
+
+@event.listens_for(WarehouseCategory, 'after_update')
+def _closure_after_category_update(mapper, connection, target):
+    closure = WarehouseCategoryClosure.__table__
+
+    current_parent_id = connection.execute(
+        db.select(closure.c.ancestor_id).where(
+            closure.c.descendant_id == target.id,
+            closure.c.depth == 1
+        )
+    ).scalar()
+    if current_parent_id == target.parent_id:
+        return
+
+    subtree = db.select(closure.c.descendant_id).where(closure.c.ancestor_id == target.id)
+    if target.parent_id is not None and connection.execute(
+        db.select(closure.c.descendant_id).where(
+            closure.c.ancestor_id == target.id,
+            closure.c.descendant_id == target.parent_id
+        )
+    ).first():
+        raise ValueError('Нельзя переместить категорию внутрь её собственной подкатегории')
+
+    # Отрываем поддерево от старых предков...
+    connection.execute(closure.delete().where(
+        closure.c.descendant_id.in_(subtree),
+        closure.c.ancestor_id.not_in(subtree)
+    ))
+
+    # ...и подвешиваем к новым: каждый предок нового родителя x каждый узел поддерева
+    if target.parent_id is not None:
+        supertree = closure.alias('supertree')
+        subtree_links = closure.alias('subtree_links')
+        connection.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            db.select(
+                supertree.c.ancestor_id,
+                subtree_links.c.descendant_id,
+                supertree.c.depth + subtree_links.c.depth + 1
+            ).select_from(
+                supertree.join(subtree_links, db.true())
+            ).where(
+                supertree.c.descendant_id == target.parent_id,
+                subtree_links.c.ancestor_id == target.id
+            )
+        ))
+
+
+@event.listens_for(WarehouseCategory, 'before_delete')
+def _closure_before_category_delete(mapper, connection, target):
+    closure = WarehouseCategoryClosure.__table__
+    connection.execute(closure.delete().where(
+        db.or_(closure.c.descendant_id == target.id, closure.c.ancestor_id == target.id)
+    ))
+
 
 # models/lead.py
 class Lead(db.Model):
@@ -2603,6 +4484,11 @@ class Lead(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     converted_at = db.Column(db.DateTime)  # Дата конверсии в заявку
     
+    __table_args__ = (
+        db.Index('ix_leads_created_at', 'created_at'),
+        db.Index('ix_leads_follow_up_status', 'next_follow_up', 'status'),
+    )
+    
     # Связи
     bookings = db.relationship('Booking', backref='source_lead', lazy='dynamic')
     
@@ -2661,11 +4547,8 @@ class Lead(db.Model):
             # Добавляем информацию о дне рождения
             if self.birthday:
                 today = datetime.utcnow().date()
-                this_year_birthday = self.birthday.replace(year=today.year)
-                if this_year_birthday < today:
-                    next_birthday = self.birthday.replace(year=today.year + 1)
-                else:
-                    next_birthday = this_year_birthday
+                this_year_birthday = birthday_in_year(self.birthday, today.year)
+                next_birthday = next_birthday_date(self.birthday, today)
                 
                 data.update({
                     'days_until_birthday': (next_birthday - today).days,
@@ -2749,6 +4632,55 @@ class Lead(db.Model):
         
         self.updated_at = datetime.utcnow()
     
+    # Поля, которые можно менять массово
+    BULK_UPDATE_FIELDS = ('status', 'temperature', 'assigned_to', 'source', 'next_follow_up', 'tags', 'notes')
+    
+    @classmethod
+    def bulk_update_values(cls, data):
+        """Значения разрешённых полей для массового обновления (по тем же правилам, что update_from_dict)"""
+        values = {
+            field: data[field]
+            for field in ('status', 'temperature', 'assigned_to', 'source', 'notes')
+            if field in data
+        }
+        
+        if data.get('next_follow_up'):
+            try:
+                values['next_follow_up'] = datetime.fromisoformat(str(data['next_follow_up']).replace('Z', ''))
+            except ValueError:
+                pass
+        
+        if 'tags' in data:
+            if isinstance(data['tags'], str):
+                values['tags'] = [t.strip() for t in data['tags'].split(',') if t.strip()]
+            else:
+                values['tags'] = data['tags']
+        
+        return values
+    
+    @classmethod
+    def bulk_update(cls, lead_ids, data, chunk_size=1000):
+        """Массово обновить разрешённые поля лидов. Возвращает количество обновлённых лидов.
+        
+        Значения одинаковы для всех лидов, поэтому поля меняются одним
+        UPDATE ... WHERE id IN (...) на пачку из chunk_size лидов, без
+        загрузки лидов в ORM. Оценка качества при массовой смене источника
+        не пересчитывается.
+        """
+        values = cls.bulk_update_values(data)
+        if not values:
+            return 0
+        values['updated_at'] = datetime.utcnow()
+        
+        lead_ids = list(dict.fromkeys(lead_ids))
+        updated = 0
+        for start in range(0, len(lead_ids), chunk_size):
+            chunk = lead_ids[start:start + chunk_size]
+            result = db.session.execute(db.update(cls).where(cls.id.in_(chunk)).values(**values))
+            updated += result.rowcount
+        
+        return updated
+    
     def convert_to_booking(self, booking_data=None):
         """Конвертировать лид в заявку"""
         if self.status == 'converted':
@@ -2857,73 +4789,142 @@ class Lead(db.Model):
         self.quality_score = min(score, 100)
         return self.quality_score
     
+    FUNNEL_STATUSES = ('new', 'contacted', 'interested', 'qualified', 'converted')
+    OVERDUE_STATUSES = ('new', 'contacted', 'interested')
+    
+    @staticmethod
+    def _seconds_between(start, end):
+        """Разница двух дат в секундах на стороне СУБД"""
+        if db.session.get_bind().dialect.name == 'sqlite':
+            return (func.julianday(end) - func.julianday(start)) * 86400
+        return func.extract('epoch', end - start)
+    
     @classmethod
     def get_stats(cls, period_days=30):
-        """Получить статистику лидов"""
-        date_from = datetime.utcnow() - timedelta(days=period_days)
-        
-        # Общая статистика
-        total = cls.query.filter(cls.created_at >= date_from).count()
-        converted = cls.query.filter(
-            cls.created_at >= date_from,
-            cls.status == 'converted'
-        ).count()
-        
-        # По статусам
-        status_stats = db.session.query(
-            cls.status,
-            func.count(cls.id).label('count')
-        ).filter(cls.created_at >= date_from).group_by(cls.status).all()
+        """Получить статистику лидов за период.
         
-        # По источникам
-        source_stats = db.session.query(
-            cls.source,
-            func.count(cls.id).label('count')
-        ).filter(cls.created_at >= date_from).group_by(cls.source).all()
+        Счётчики за период (статусы, источники, температура, менеджеры, среднее
+        время до конверсии) считаются одним запросом по индексу created_at с
+        условной агрегацией; группы сворачиваются в Python. Просроченные
+        контакты не зависят от периода и считаются отдельным COUNT по индексу
+        (next_follow_up, status).
+        """
+        now = datetime.utcnow()
+        with_conversion_time = db.and_(cls.status == 'converted', cls.converted_at.isnot(None))
         
-        # По температуре
-        temperature_stats = db.session.query(
+        rows = db.session.query(
+            cls.status,
+            cls.source,
             cls.temperature,
-            func.count(cls.id).label('count')
-        ).filter(cls.created_at >= date_from).group_by(cls.temperature).all()
+            Admin.id,
+            Admin.name,
+            func.count(cls.id),
+            func.count(db.case((with_conversion_time, 1))),
+            func.sum(db.case((with_conversion_time, cls._seconds_between(cls.created_at, cls.converted_at))))
+        ).outerjoin(Admin, Admin.id == cls.assigned_to).filter(
+            cls.created_at >= now - timedelta(days=period_days)
+        ).group_by(
+            cls.status, cls.source, cls.temperature, Admin.id, Admin.name
+        ).all()
+        
+        overdue = db.session.query(func.count(cls.id)).filter(
+            cls.next_follow_up < now,
+            cls.status.in_(cls.OVERDUE_STATUSES)
+        ).scalar()
+        
+        total = 0
+        conversion_count = 0
+        conversion_seconds = 0.0
+        statuses, sources, temperatures, managers = {}, {}, {}, {}
+        
+        for status, source, temperature, admin_id, admin_name, count, timed, seconds in rows:
+            total += count
+            conversion_count += timed
+            conversion_seconds += float(seconds or 0)
+            statuses[status] = statuses.get(status, 0) + count
+            sources[source] = sources.get(source, 0) + count
+            temperatures[temperature] = temperatures.get(temperature, 0) + count
+            if admin_id is not None:
+                manager = managers.setdefault(admin_id, {'name': admin_name, 'leads_count': 0, 'converted_count': 0})
+                manager['leads_count'] += count
+                if status == 'converted':
+                    manager['converted_count'] += count
+        
+        converted_total = statuses.get('converted', 0)
+        avg_conversion_time_hours = conversion_seconds / conversion_count / 3600 if conversion_count else 0
         
         return {
             'total': total,
-            'converted': converted,
-            'conversion_rate': round((converted / total * 100), 1) if total > 0 else 0,
-            'statuses': [{'status': s, 'count': c} for s, c in status_stats],
-            'sources': [{'source': s, 'count': c} for s, c in source_stats],
-            'temperatures': [{'temperature': t, 'count': c} for t, c in temperature_stats]
+            'converted': converted_total,
+            'conversion_rate': round((converted_total / total * 100), 1) if total > 0 else 0,
+            'statuses': [{'status': s, 'count': c} for s, c in statuses.items()],
+            'sources': [{'source': s, 'count': c} for s, c in sources.items()],
+            'temperatures': [{'temperature': t, 'count': c} for t, c in temperatures.items()],
+            'funnel': {status: statuses.get(status, 0) for status in cls.FUNNEL_STATUSES},
+            'overdue_leads_count': overdue,
+            'avg_conversion_time_hours': round(avg_conversion_time_hours, 1),
+            'managers': [
+                {
+                    **manager,
+                    'conversion_rate': round((manager['converted_count'] / manager['leads_count'] * 100), 1)
+                }
+                for _, manager in sorted(managers.items())
+            ]
         }
     
+    BIRTHDAY_STATUSES = ('new', 'contacted', 'interested', 'qualified')
+    
+    @classmethod
+    def birthday_filter(cls, days_ahead=30, today=None):
+        """Условие "день рождения в ближайшие days_ahead дней" по индексу lead_birthdays"""
+        today = today or datetime.utcnow().date()
+        return cls.id.in_(
+            db.select(LeadBirthday.lead_id).where(LeadBirthday.upcoming(today, days_ahead))
+        )
+    
+    @classmethod
+    def birthday_leads_query(cls, days_ahead=30, today=None):
+        """Запрос лидов в работе с ближайшими днями рождения, от ближайшего к дальнему"""
+        today = today or datetime.utcnow().date()
+        today_key = LeadBirthday.key(today)
+        key = LeadBirthday.birthday_key
+        
+        return cls.query.join(LeadBirthday, LeadBirthday.lead_id == cls.id).filter(
+            LeadBirthday.upcoming(today, days_ahead),
+            cls.status.in_(cls.BIRTHDAY_STATUSES)
+        ).order_by(
+            # Дни рождения после перехода через новый год - в конец списка
+            db.case((key < today_key, key + 10000), else_=key),
+            cls.id
+        )
+    
     @classmethod
     def get_birthday_leads(cls, days_ahead=30):
         """Получить лидов с днями рождения в ближайшие дни"""
-        today = datetime.utcnow().date()
-        target_date = today + timedelta(days=days_ahead)
-        
-        # Сложный запрос для поиска дней рождения с учетом года
-        leads = cls.query.filter(
-            cls.birthday.isnot(None),
-            cls.status.in_(['new', 'contacted', 'interested', 'qualified'])
-        ).all()
-        
-        birthday_leads = []
-        for lead in leads:
-            if lead.birthday:
-                # Проверяем день рождения в этом и следующем году
-                this_year = lead.birthday.replace(year=today.year)
-                next_year = lead.birthday.replace(year=today.year + 1)
-                
-                if today <= this_year <= target_date or today <= next_year <= target_date:
-                    birthday_leads.append(lead)
-        
-        return birthday_leads
+        return cls.birthday_leads_query(days_ahead).all()
     
     @classmethod
     def find_by_phone(cls, phone):
-        """Найти лид по номеру телефона"""
-        return cls.query.filter(cls.phone == phone).first()
+        """Найти лид по номеру телефона (без учёта формата записи)"""
+        return cls.find_by_phones([phone]).get(LeadPhone.key(phone))
+    
+    @classmethod
+    def find_by_phones(cls, phones):
+        """Найти лидов по списку телефонов одним запросом: {нормализованный телефон: лид}
+        
+        Если телефон есть у нескольких лидов, берётся самый ранний.
+        """
+        keys = {LeadPhone.key(phone) for phone in phones if phone} - {''}
+        if not keys:
+            return {}
+        
+        found = {}
+        rows = db.session.query(LeadPhone.phone, cls).join(cls, cls.id == LeadPhone.lead_id).filter(
+            LeadPhone.phone.in_(keys)
+        ).order_by(cls.id).all()
+        for phone, lead in rows:
+            found.setdefault(phone, lead)
+        return found
     
     @classmethod
     def create_from_booking(cls, booking):
@@ -2932,6 +4933,38 @@ class Lead(db.Model):
         if existing_lead:
             return existing_lead
         
+        return cls._from_booking(booking)
+    
+    @classmethod
+    def create_from_bookings(cls, bookings, chunk_size=1000):
+        """Связать заявки с лидами, создав недостающих.
+        
+        Телефоны ищутся одним запросом на пачку из chunk_size заявок; заявки
+        с одним телефоном получают одного лида. Возвращает список созданных лидов.
+        """
+        bookings = list(bookings)
+        leads = {}
+        created = []
+        for start in range(0, len(bookings), chunk_size):
+            chunk = bookings[start:start + chunk_size]
+            leads.update(cls.find_by_phones(
+                booking.phone for booking in chunk if LeadPhone.key(booking.phone) not in leads
+            ))
+            for booking in chunk:
+                key = LeadPhone.key(booking.phone)
+                lead = leads.get(key) if key else None
+                if lead is None:
+                    lead = cls._from_booking(booking)
+                    db.session.add(lead)
+                    created.append(lead)
+                    if key:
+                        leads[key] = lead
+                else:
+                    booking.source_lead = lead
+        return created
+    
+    @classmethod
+    def _from_booking(cls, booking):
         lead = cls(
             name=booking.name,
             phone=booking.phone,
@@ -2951,35 +4984,232 @@ class Lead(db.Model):
         
         return lead
 
+def birthday_in_year(birthday, year):
+    """Дата дня рождения в году year; 29 февраля в невисокосный год - 28 февраля"""
+    if birthday.month == 2 and birthday.day == 29 and not calendar.isleap(year):
+        return birthday.replace(year=year, day=28)
+    return birthday.replace(year=year)
+
+
+def next_birthday_date(birthday, today):
+    """Ближайший день рождения начиная с today (включительно)"""
+    this_year = birthday_in_year(birthday, today.year)
+    if this_year >= today:
+        return this_year
+    return birthday_in_year(birthday, today.year + 1)
+
+
+class LeadIndexMixin:
+    """Индексная таблица по полю лида: ключ key(значение source_field) хранится в колонке key_column
+
+    Индекс поддерживается ORM-событиями лида и refresh() после массовых запросов.
+    Сверка с таблицей leads - при запуске приложения (sync_lead_indexes) или
+    командой flask rebuild-lead-indexes, но не на пути запроса.
+    """
+    source_field = None
+    key_column = None
+
+    @classmethod
+    def make_row(cls, lead_id, value):
+        return {'lead_id': lead_id, cls.key_column: cls.key(value)}
+
+    @classmethod
+    def _source_rows(cls, connection, lead_ids=None):
+        source = getattr(Lead, cls.source_field)
+        query = db.select(Lead.id, source).where(source.isnot(None))
+        if lead_ids is not None:
+            query = query.where(Lead.id.in_(lead_ids))
+        return [cls.make_row(lead_id, value) for lead_id, value in connection.execute(query)]
+
+    @classmethod
+    def rebuild(cls, connection=None):
+        """Пересобрать индекс по таблице лидов. Возвращает количество записей"""
+        connection = connection or db.session
+        connection.execute(cls.__table__.delete())
+        rows = cls._source_rows(connection)
+        if rows:
+            connection.execute(cls.__table__.insert(), rows)
+        return len(rows)
+
+    @classmethod
+    def refresh(cls, lead_ids, connection=None):
+        """Обновить записи индекса для лидов, изменённых массовыми запросами мимо ORM-событий"""
+        lead_ids = list(lead_ids)
+        if not lead_ids:
+            return
+        connection = connection or db.session
+        table = cls.__table__
+        connection.execute(table.delete().where(table.c.lead_id.in_(lead_ids)))
+        rows = cls._source_rows(connection, lead_ids)
+        if rows:
+            connection.execute(table.insert(), rows)
+
+    @classmethod
+    def is_current(cls, connection=None):
+        """Совпадают ли записи индекса (лид и ключ) с тем, что строится по таблице лидов"""
+        connection = connection or db.session
+        table = cls.__table__
+        indexed = set(connection.execute(db.select(table.c.lead_id, table.c[cls.key_column])).all())
+        expected = {(row['lead_id'], row[cls.key_column]) for row in cls._source_rows(connection)}
+        return indexed == expected
+
+
+class LeadBirthday(LeadIndexMixin, db.Model):
+    """Индекс дней рождения лидов: ключ MMDD для поиска диапазоном без учёта года"""
+    __tablename__ = 'lead_birthdays'
+    source_field = 'birthday'
+
+    key_column = 'birthday_key'
+
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), primary_key=True)
+    birthday_key = db.Column(db.Integer, nullable=False, index=True)  # месяц * 100 + день
+
+    @staticmethod
+    def key(value):
+        return value.month * 100 + value.day
+
+    @classmethod
+    def key_ranges(cls, today, days_ahead):
+        """Диапазоны ключей [(от, до)] для дней с today по today + days_ahead"""
+        if days_ahead >= 365:
+            return [(101, 1231)]
+        end = today + timedelta(days=max(days_ahead, 0))
+
+        if end.year == today.year:
+            ranges = [(cls.key(today), cls.key(end))]
+        else:
+            # Окно переходит через новый год
+            ranges = [(cls.key(today), 1231), (101, cls.key(end))]
+
+        # В невисокосный год родившиеся 29 февраля празднуют 28-го
+        return [
+            (low, 229 if high == 228 and not calendar.isleap(year) else high)
+            for (low, high), year in zip(ranges, (today.year, end.year))
+        ]
+
+    @classmethod
+    def upcoming(cls, today, days_ahead):
+        """Условие на ключ: день рождения в ближайшие days_ahead дней (диапазоны по индексу)"""
+        return db.or_(*(
+            cls.birthday_key.between(low, high) for low, high in cls.key_ranges(today, days_ahead)
+        ))
+
+
+class LeadPhone(LeadIndexMixin, db.Model):
+    """Индекс нормализованных телефонов лидов: поиск дублей независимо от формата записи"""
+    __tablename__ = 'lead_phones'
+    source_field = 'phone'
+
+    key_column = 'phone'
+
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), primary_key=True)
+    phone = db.Column(db.String(20), nullable=False, index=True)
+
+    @staticmethod
+    def key(phone):
+        return format_phone_number(phone) or ''
+
+
+LEAD_INDEXES = (LeadBirthday, LeadPhone)
+
+
+def refresh_lead_indexes(lead_ids):
+    """Обновить индексы лидов после массовой вставки или обновления"""
+    lead_ids = list(lead_ids)
+    for index in LEAD_INDEXES:
+        index.refresh(lead_ids)
+
+
+# Индексы таблицы leads под статистику по периоду и просроченные контакты;
+# на старых базах create_all их не добавляет
+LEADS_TABLE_INDEXES = {
+    'ix_leads_created_at': 'CREATE INDEX IF NOT EXISTS ix_leads_created_at ON leads (created_at)',
+    'ix_leads_follow_up_status': (
+        'CREATE INDEX IF NOT EXISTS ix_leads_follow_up_status ON leads (next_follow_up, status)'
+    ),
+}
+
+
+def ensure_leads_table_indexes():
+    """Создать недостающие индексы таблицы leads (при запуске приложения)"""
+    for ddl in LEADS_TABLE_INDEXES.values():
+        db.session.execute(db.text(ddl))
+    db.session.commit()
+
+
+def sync_lead_indexes():
+    """Сверить индексы лидов с таблицей leads и пересобрать разошедшиеся (при запуске приложения)"""
+    rebuilt = {}
+    for index in LEAD_INDEXES:
+        if not index.is_current():
+            rebuilt[index.__tablename__] = index.rebuild()
+    db.session.commit()
+    return rebuilt
+
+
+def _lead_index_replace(connection, index, target):
+    table = index.__table__
+    connection.execute(table.delete().where(table.c.lead_id == target.id))
+    value = getattr(target, index.source_field)
+    if value is not None:
+        connection.execute(table.insert().values(**index.make_row(target.id, value)))
+
+
+@event.listens_for(Lead, 'after_insert')
+def _lead_indexes_after_insert(mapper, connection, target):
+    for index in LEAD_INDEXES:
+        if getattr(target, index.source_field) is not None:
+            _lead_index_replace(connection, index, target)
+
+
+@event.listens_for(Lead, 'after_update')
+def _lead_indexes_after_update(mapper, connection, target):
+    state = db.inspect(target)
+    for index in LEAD_INDEXES:
+        if state.attrs[index.source_field].history.has_changes():
+            _lead_index_replace(connection, index, target)
+
+
+@event.listens_for(Lead, 'before_delete')
+def _lead_indexes_before_delete(mapper, connection, target):
+    for index in LEAD_INDEXES:
+        table = index.__table__
+        connection.execute(table.delete().where(table.c.lead_id == target.id))
+
+
 # Обновленные функции для статистики
 def get_warehouse_stats():
-
-    """Получить общую статистику склада"""
-    total_items = WarehouseItem.query.filter(WarehouseItem.status == 'active').count()
-    total_categories = WarehouseCategory.query.count()
-    low_stock_items = len(WarehouseItem.get_low_stock_items())
-    out_of_stock_items = WarehouseItem.query.filter(
-        WarehouseItem.current_quantity == 0,
-        WarehouseItem.status == 'active'
-    ).count()
-    
-    # Общая стоимость склада
-    total_value = db.session.query(
-        func.sum(WarehouseItem.current_quantity * WarehouseItem.cost_price)
-    ).filter(WarehouseItem.status == 'active').scalar() or 0
-    
-    # Операции за последние 30 дней
+    """Получить общую статистику склада (одним запросом)"""
     thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    recent_operations = WarehouseOperation.query.filter(
-        WarehouseOperation.created_at >= thirty_days_ago
-    ).count()
+    active = WarehouseItem.status == 'active'
+    
+    row = db.session.query(
+        func.count(db.case((active, 1))),
+        func.count(db.case((
+            db.and_(active, WarehouseItem.current_quantity <= WarehouseItem.min_quantity), 1
+        ))),
+        func.count(db.case((
+            db.and_(active, WarehouseItem.current_quantity == 0), 1
+        ))),
+        # Общая стоимость склада
+        func.coalesce(func.sum(db.case((
+            active, WarehouseItem.current_quantity * WarehouseItem.cost_price
+        ))), 0),
+        db.select(func.count(WarehouseCategory.id)).scalar_subquery(),
+        # Операции за последние 30 дней
+        db.select(func.count(WarehouseOperation.id)).where(
+            WarehouseOperation.created_at >= thirty_days_ago
+        ).scalar_subquery()
+    ).one()
+    
+    total_items, low_stock_items, out_of_stock_items, total_value, total_categories, recent_operations = row
     
     return {
         'total_items': total_items,
         'total_categories': total_categories,
         'low_stock_items': low_stock_items,
         'out_of_stock_items': out_of_stock_items,
-        'total_value': float(total_value),
+        'total_value': float(total_value or 0),
         'recent_operations': recent_operations
     }
 # Добавьте эти функции в конец models/__init__.py
@@ -3104,18 +5334,8 @@ def migrate_bookings_to_leads():
             )
         ).all()
         
-        created_leads = 0
-        for booking in bookings_without_leads:
-            existing_lead = Lead.find_by_phone(booking.phone)
-            
-            if not existing_lead:
-                # Создаем нового лида
-                lead = Lead.create_from_booking(booking)
-                db.session.add(lead)
-                created_leads += 1
-            else:
-                # Связываем с существующим лидом
-                booking.lead_id = existing_lead.id
+        # Существующие лиды находятся по телефону пачками, остальные создаются
+        created_leads = len(Lead.create_from_bookings(bookings_without_leads))
         
         db.session.commit()
         print(f"✅ Создано {created_leads} лидов из заявок")
@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 from datetime import datetime, timedelta
-from models import db, Booking, Review, Service
+from models import db, Booking, Review, Service, WarehouseReservation
 from sqlalchemy import func, desc
 
 admin_bp = Blueprint('admin', __name__)
@@ -136,6 +136,12 @@ def update_booking_status(booking_id):
         if 'message' in data:
             booking.message = data['message']
         
+        # Отменённая заявка освобождает зарезервированный реквизит
+        if new_status == 'cancelled' and old_status != 'cancelled':
+            released = WarehouseReservation.release_for_booking(booking.id)
+            if released:
+                print(f"📌 Снято резервов склада: {released}")
+        
         db.session.commit()
         print("✅ Изменения сохранены в БД")
         
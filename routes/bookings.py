@@ -2,7 +2,7 @@
 
 from flask import Blueprint, request, jsonify
 from datetime import datetime, date, time
-from models import db, Booking, Service, Lead
+from models import db, Booking, Service, Lead, WarehouseReservation
 from utils.validators import validate_booking_data
 from utils.email_utils import send_booking_notification as send_email_notification
 import asyncio
@@ -377,6 +377,12 @@ def update_booking(booking_id):
         if 'message' in data:
             booking.message = data['message']
         
+        # Отменённая заявка освобождает зарезервированный реквизит
+        if booking.status == 'cancelled' and old_status != 'cancelled':
+            released = WarehouseReservation.release_for_booking(booking.id)
+            if released:
+                print(f"📌 Снято резервов склада: {released}")
+        
         db.session.commit()
         print("✅ Изменения сохранены в БД")
         
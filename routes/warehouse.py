@@ -1,18 +1,37 @@
 # routes/warehouse.py - Полностью обновленные эндпоинты
-from flask import Blueprint, request, jsonify, Response
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from sqlalchemy import desc, func, or_, and_
-from models import db, WarehouseItem, WarehouseCategory, WarehouseOperation, Admin, WarehouseItemCategory
-from utils.barcode import get_product_from_service_online
+from sqlalchemy.orm import joinedload
+from models import (
+    db, WarehouseItem, WarehouseCategory, WarehouseOperation, Admin, WarehouseItemCategory,
+    WarehouseCategoryClosure, WarehouseDailyMovement, DataVersion, WarehouseStockSnapshot,
+    WarehouseOperationArchive, WarehouseReservation, Booking, WarehouseItemForecast,
+    WarehouseInventory, WarehouseInventoryRecord, WarehouseScanSession, WarehouseDailyValuation
+)
+from utils.barcode import lookup_barcodes
+from utils.search import apply_item_search
+from utils.cache import SnapshotCache
+from utils.forecast import compute_forecasts
+from utils.warehouse_import import (
+    read_item_rows, import_item_rows,
+    DEFAULT_BATCH_SIZE as DEFAULT_IMPORT_BATCH_SIZE, MAX_BATCH_SIZE as MAX_IMPORT_BATCH_SIZE
+)
 from datetime import datetime, timedelta
 import csv
 import io
 import json
 import requests
-from utils.helpers import get_client_ip
+from utils.helpers import get_client_ip, encode_cursor, decode_cursor
 
 warehouse_bp = Blueprint('warehouse', __name__)
 
+# Размер пачки товаров при потоковом экспорте
+EXPORT_CHUNK_SIZE = 500
+
+# Снимок дашборда: пересчёт не чаще раза в 5 секунд и не реже раза в минуту
+_dashboard_snapshot = SnapshotCache(min_interval=5, max_age=60)
+
 # ============ DASHBOARD / ГЛАВНАЯ ============
 
 @warehouse_bp.route('/dashboard', methods=['GET'])
@@ -20,50 +39,104 @@ warehouse_bp = Blueprint('warehouse', __name__)
 def get_warehouse_dashboard():
     """Получить данные для главной страницы склада"""
     try:
-        from models import get_warehouse_stats
-        stats = get_warehouse_stats()
-        
-        # Последние операции
-        recent_operations = WarehouseOperation.query.order_by(
-            desc(WarehouseOperation.created_at)
-        ).limit(10).all()
-        
-        # Товары с низким остатком
-        low_stock_items = WarehouseItem.get_low_stock_items()
-        
-        # Самые активные товары за последние 30 дней
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        active_items = db.session.query(
-            WarehouseItem.id,
-            WarehouseItem.name,
-            func.count(WarehouseOperation.id).label('operation_count')
-        ).join(WarehouseOperation).filter(
-            WarehouseOperation.created_at >= thirty_days_ago
-        ).group_by(WarehouseItem.id).order_by(
-            desc(func.count(WarehouseOperation.id))
-        ).limit(5).all()
-        
-        return jsonify({
-            'stats': stats,
-            'recent_operations': [op.to_dict() for op in recent_operations],
-            'low_stock_items': [item.to_dict() for item in low_stock_items[:5]],
-            'active_items': [
-                {
-                    'id': item_id,
-                    'name': name,
-                    'operation_count': count
-                }
-                for item_id, name, count in active_items
-            ]
-        })
+        # Снимок пересчитывается только после изменений данных склада
+        version = DataVersion.get('warehouse')
+        return jsonify(_dashboard_snapshot.get(version, _build_dashboard_snapshot))
         
     except Exception as e:
         print(f"❌ Ошибка dashboard: {e}")
         return jsonify({'error': f'Ошибка получения данных: {str(e)}'}), 500
 
 
+def _build_dashboard_snapshot():
+    """Собрать данные дашборда склада"""
+    from models import get_warehouse_stats
+    stats = get_warehouse_stats()
+    
+    # Последние операции
+    recent_operations = WarehouseOperation.query.options(
+        *WarehouseOperation.load_options()
+    ).order_by(desc(WarehouseOperation.created_at)).limit(10).all()
+    
+    # Товары с низким остатком (общее количество уже посчитано в stats)
+    low_stock_items = WarehouseItem.query.filter(
+        WarehouseItem.current_quantity <= WarehouseItem.min_quantity,
+        WarehouseItem.status == 'active'
+    ).order_by(WarehouseItem.id).limit(5).all()
+    
+    # Самые активные товары за последние 30 дней (по дневной сводке)
+    thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).date()
+    operation_count = func.sum(WarehouseDailyMovement.operations_count)
+    active_items = db.session.query(
+        WarehouseItem.id,
+        WarehouseItem.name,
+        operation_count.label('operation_count')
+    ).join(
+        WarehouseDailyMovement, WarehouseDailyMovement.item_id == WarehouseItem.id
+    ).filter(
+        WarehouseDailyMovement.date >= thirty_days_ago
+    ).group_by(WarehouseItem.id, WarehouseItem.name).order_by(
+        desc(operation_count)
+    ).limit(5).all()
+    
+    return {
+        'stats': stats,
+        'recent_operations': WarehouseOperation.serialize_many(recent_operations),
+        'low_stock_items': WarehouseItem.serialize_many(low_stock_items),
+        'active_items': [
+            {
+                'id': item_id,
+                'name': name,
+                'operation_count': int(count) if count else 0
+            }
+            for item_id, name, count in active_items
+        ]
+    }
+
+
 # ============ КАТЕГОРИИ ============
 
+def _category_tree_etag():
+    """ETag дерева категорий - меняется вместе с версией данных категорий"""
+    return f'categories-{DataVersion.get("warehouse_categories")}'
+
+
+def _not_modified_response(etag):
+    """Ответ 304, если у клиента актуальная версия, иначе None"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def _etag_response(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _load_category_tree():
+    """Все категории и счётчики товаров (два запроса), сгруппированные по родителю"""
+    categories = WarehouseCategory.query.order_by(WarehouseCategory.name).all()
+    children = {}
+    for category in categories:
+        children.setdefault(category.parent_id, []).append(category)
+    return categories, children, WarehouseCategory.get_items_counts()
+
+
+def _category_tree_node(category, children, counts):
+    """Категория со всем поддеревом и количеством товаров (с подкатегориями)"""
+    data = category.to_dict()
+    data['items_count'] = counts.get(category.id, (0, 0))[0]
+    data['children'] = [
+        _category_tree_node(child, children, counts)
+        for child in children.get(category.id, [])
+    ]
+    return data
+
+
 @warehouse_bp.route('/categories', methods=['GET'])
 @jwt_required()
 def get_categories():
@@ -74,46 +147,26 @@ def get_categories():
         
         print(f"📂 GET categories: parent_id={parent_id}, include_children={include_children}")
         
-        query = WarehouseCategory.query
-        
-        if parent_id is not None:
-            query = query.filter(WarehouseCategory.parent_id == parent_id)
-        else:
-            query = query.filter(WarehouseCategory.parent_id.is_(None))
+        etag = _category_tree_etag()
+        not_modified = _not_modified_response(etag)
+        if not_modified:
+            return not_modified
         
-        categories = query.order_by(WarehouseCategory.name).all()
+        categories, children, counts = _load_category_tree()
         
-        # Добавляем информацию о количестве товаров в каждой категории
+        # Количество товаров: с подкатегориями или только в самой категории
         result = []
-        for category in categories:
-            try:
-                cat_data = category.to_dict(include_children=include_children)
-                
-                # Подсчитываем товары в категории (включая подкатегории) через связь many-to-many
-                category_ids = [category.id]
-                if include_children:
-                    category_ids.extend(category.get_all_child_ids())
-                
-                items_count = db.session.query(WarehouseItem).join(WarehouseItemCategory).filter(
-                    WarehouseItemCategory.category_id.in_(category_ids),
-                    WarehouseItem.status == 'active'
-                ).distinct().count()
-                
-                cat_data['items_count'] = items_count
-                result.append(cat_data)
-                
-            except Exception as e:
-                print(f"❌ Ошибка обработки категории {category.id}: {e}")
-                # Добавляем категорию с базовой информацией
-                result.append({
-                    'id': category.id,
-                    'name': category.name,
-                    'items_count': 0,
-                    'error': str(e)
-                })
+        for category in children.get(parent_id, []):
+            cat_data = category.to_dict()
+            if include_children:
+                cat_data['children'] = [child.to_dict() for child in children.get(category.id, [])]
+            
+            items_count, direct_items_count = counts.get(category.id, (0, 0))
+            cat_data['items_count'] = items_count if include_children else direct_items_count
+            result.append(cat_data)
         
         print(f"✅ Возвращаем {len(result)} категорий")
-        return jsonify({'categories': result})
+        return _etag_response({'categories': result}, etag)
         
     except Exception as e:
         print(f"❌ Критическая ошибка get_categories: {e}")
@@ -150,6 +203,90 @@ def create_category():
         return jsonify({'error': f'Ошибка создания категории: {str(e)}'}), 500
 
 
+def _category_item_ids(category_ids, subtree=False):
+    """ID товаров, привязанных к категориям (с subtree - и к их подкатегориям)"""
+    if subtree:
+        category_ids = WarehouseCategory.get_descendant_ids(category_ids)
+    rows = db.session.query(WarehouseItemCategory.item_id).filter(
+        WarehouseItemCategory.category_id.in_(category_ids)
+    ).distinct().all()
+    return [item_id for item_id, in rows]
+
+
+@warehouse_bp.route('/categories/<int:category_id>', methods=['PUT'])
+@jwt_required()
+def update_category(category_id):
+    """Обновить категорию (в том числе переместить в другую родительскую)"""
+    try:
+        category = WarehouseCategory.query.get_or_404(category_id)
+        data = request.get_json()
+
+        if 'name' in data:
+            if not data['name'] or not data['name'].strip():
+                return jsonify({'error': 'Название категории обязательно'}), 400
+            category.name = data['name'].strip()
+
+        if 'description' in data:
+            category.description = (data['description'] or '').strip()
+
+        if 'color' in data:
+            category.color = data['color']
+
+        if 'parent_id' in data and data['parent_id'] != category.parent_id:
+            new_parent_id = data['parent_id']
+            if new_parent_id is not None:
+                if not WarehouseCategory.query.get(new_parent_id):
+                    return jsonify({'error': 'Родительская категория не найдена'}), 404
+                if category.subtree_contains(new_parent_id):
+                    return jsonify({'error': 'Нельзя переместить категорию внутрь её собственной подкатегории'}), 400
+            # Товары поддерева могут сменить корневую категорию - переносим их стоимость в сводке
+            roots_before = WarehouseDailyValuation.item_roots(_category_item_ids([category.id], subtree=True))
+            category.parent_id = new_parent_id
+            db.session.flush()  # таблица замыкания обновляется при flush
+            WarehouseDailyValuation.record_moves(roots_before)
+
+        db.session.commit()
+
+        return jsonify({
+            'message': 'Категория обновлена успешно',
+            'category': category.to_dict()
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка обновления категории: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/categories/<int:category_id>', methods=['DELETE'])
+@jwt_required()
+def delete_category(category_id):
+    """Удалить категорию (только без подкатегорий)"""
+    try:
+        category = WarehouseCategory.query.get_or_404(category_id)
+
+        if category.children.count() > 0:
+            return jsonify({'error': 'Нельзя удалить категорию с подкатегориями'}), 400
+
+        # Корневая категория товаров до снятия - для переноса стоимости в сводке
+        roots_before = WarehouseDailyValuation.item_roots(_category_item_ids([category_id]))
+
+        # Снимаем категорию с товаров
+        WarehouseItemCategory.query.filter(
+            WarehouseItemCategory.category_id == category_id
+        ).delete()
+
+        db.session.delete(category)
+        db.session.flush()
+        WarehouseDailyValuation.record_moves(roots_before)
+        db.session.commit()
+
+        return jsonify({'message': 'Категория удалена успешно'})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка удаления категории: {str(e)}'}), 500
+
+
 @warehouse_bp.route('/categories/search', methods=['GET'])
 @jwt_required()
 def search_categories():
@@ -243,28 +380,12 @@ def create_item():
         if data.get('category_ids'):
             category_ids.extend(data['category_ids'])
         
-        if data.get('category_names'):
-            for category_name in data['category_names']:
-                if category_name and category_name.strip():
-                    category = WarehouseCategory.find_or_create_by_name(
-                        name=category_name.strip()
-                    )
-                    category_ids.append(category.id)
-        
+        # Категории по именам (selectedCategories - из AddItemModal) - одним запросом
+        category_names = list(data.get('category_names') or [])
+        category_names.extend(data.get('selectedCategories') or [])
         if data.get('category_name'):
-            category = WarehouseCategory.find_or_create_by_name(
-                name=data['category_name'].strip()
-            )
-            category_ids.append(category.id)
-        
-        # selectedCategories из фронтенда (AddItemModal)
-        if data.get('selectedCategories'):
-            for category_name in data['selectedCategories']:
-                if category_name and category_name.strip():
-                    category = WarehouseCategory.find_or_create_by_name(
-                        name=category_name.strip()
-                    )
-                    category_ids.append(category.id)
+            category_names.append(data['category_name'])
+        category_ids.extend(WarehouseCategory.resolve_names(category_names).values())
         
         # Убираем дублирующиеся ID
         category_ids = list(set(category_ids))
@@ -290,9 +411,13 @@ def create_item():
                 quantity_change=initial_quantity,
                 reason='Начальный остаток',
                 user_id=current_user_id,
-                ip_address=get_client_ip(request)
+                ip_address=get_client_ip(request),
+                created_at=datetime.utcnow()
             )
             db.session.add(operation)
+            WarehouseDailyMovement.record([
+                (operation.created_at.date(), item.id, 'add', initial_quantity)
+            ])
         
         db.session.commit()
         
@@ -310,6 +435,44 @@ def create_item():
         return jsonify({'error': f'Ошибка создания товара: {str(e)}'}), 500
 
 
+@warehouse_bp.route('/items/import', methods=['POST'])
+@jwt_required()
+def import_items():
+    """Импорт каталога товаров из CSV/XLSX
+
+    Товары с существующим штрих-кодом или артикулом обновляются, остальные
+    создаются. Ошибки отдельных строк возвращаются в отчёте.
+    """
+    try:
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            return jsonify({'error': 'Файл не передан'}), 400
+        
+        batch_size = max(1, min(request.args.get('batch_size', DEFAULT_IMPORT_BATCH_SIZE, type=int), MAX_IMPORT_BATCH_SIZE))
+        
+        print(f"📥 POST /items/import - импорт каталога из {upload.filename}")
+        
+        report = import_item_rows(
+            read_item_rows(upload),
+            user_id=get_jwt_identity(),
+            ip_address=get_client_ip(request),
+            batch_size=batch_size
+        )
+        
+        print(f"✅ Импорт завершён: создано {report['created']}, обновлено {report['updated']}, ошибок {report['errors_count']}")
+        return jsonify({
+            'message': f"Импорт завершён: создано {report['created']}, обновлено {report['updated']}, ошибок {report['errors_count']}",
+            **report
+        })
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка импорта каталога: {e}")
+        return jsonify({'error': f'Ошибка импорта каталога: {str(e)}'}), 500
+
+
 @warehouse_bp.route('/items', methods=['GET'])
 @jwt_required()
 def get_items():
@@ -355,42 +518,26 @@ def get_items():
         # Фильтр по категориям через many-to-many связь
         if category_ids:
             try:
-                # Получаем все дочерние категории для каждой выбранной категории
-                all_category_ids = []
-                for cat_id in category_ids:
-                    all_category_ids.append(cat_id)
-                    # Получаем категорию и её дочерние элементы
-                    category = WarehouseCategory.query.get(cat_id)
-                    if category:
-                        child_ids = category.get_all_child_ids()
-                        all_category_ids.extend(child_ids)
-                        print(f"📁 Категория {cat_id} ({category.name}): +{len(child_ids)} дочерних")
-                
-                # Убираем дубликаты
-                all_category_ids = list(set(all_category_ids))
+                # Выбранные категории вместе со всеми подкатегориями (один запрос)
+                all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
                 print(f"📋 Все категории для поиска: {all_category_ids}")
                 
-                # Используем связь many-to-many
-                query = query.join(WarehouseItemCategory).filter(
-                    WarehouseItemCategory.category_id.in_(all_category_ids)
-                ).distinct()
+                # Используем связь many-to-many (подзапрос вместо JOIN + DISTINCT,
+                # чтобы не мешать сортировке по релевантности)
+                query = query.filter(WarehouseItem.id.in_(
+                    db.session.query(WarehouseItemCategory.item_id).filter(
+                        WarehouseItemCategory.category_id.in_(all_category_ids)
+                    )
+                ))
                 
             except Exception as e:
                 print(f"❌ Ошибка фильтрации по категориям: {e}")
                 # Продолжаем без фильтра по категориям
                 pass
         
-        # Поиск по тексту
+        # Поиск по тексту (sort_by=relevance - по релевантности)
         if search:
-            search_filter = f"%{search}%"
-            query = query.filter(
-                or_(
-                    WarehouseItem.name.ilike(search_filter),
-                    WarehouseItem.barcode.ilike(search_filter),
-                    WarehouseItem.sku.ilike(search_filter),
-                    WarehouseItem.description.ilike(search_filter)
-                )
-            )
+            query = apply_item_search(query, search, rank=(sort_by == 'relevance'))
             print(f"🔎 Поиск по тексту: '{search}'")
         
         # Фильтр по остаткам
@@ -450,24 +597,8 @@ def get_items():
             print(f"❌ Ошибка пагинации: {e}")
             return jsonify({'error': f'Ошибка пагинации: {str(e)}'}), 500
         
-        # Преобразуем товары в словари
-        items_data = []
-        for item in pagination.items:
-            try:
-                item_dict = item.to_dict(include_categories=True)
-                items_data.append(item_dict)
-            except Exception as e:
-                print(f"❌ Ошибка преобразования товара {item.id}: {e}")
-                # Добавляем базовую информацию
-                items_data.append({
-                    'id': item.id,
-                    'name': item.name or 'Без названия',
-                    'current_quantity': item.current_quantity or 0,
-                    'unit': item.unit or 'шт',
-                    'status': item.status or 'active',
-                    'categories': [],
-                    'category_names': []
-                })
+        # Преобразуем товары в словари (категории загружаются пачкой на всю страницу)
+        items_data = WarehouseItem.serialize_many(pagination.items)
         
         result = {
             'items': items_data,
@@ -511,13 +642,15 @@ def get_item(item_id):
         item = WarehouseItem.query.get_or_404(item_id)
         
         # Получаем последние операции с товаром
-        recent_operations = WarehouseOperation.query.filter(
+        recent_operations = WarehouseOperation.query.options(
+            *WarehouseOperation.load_options()
+        ).filter(
             WarehouseOperation.item_id == item_id
         ).order_by(desc(WarehouseOperation.created_at)).limit(10).all()
         
         return jsonify({
             'item': item.to_dict(),
-            'recent_operations': [op.to_dict() for op in recent_operations]
+            'recent_operations': WarehouseOperation.serialize_many(recent_operations)
         })
         
     except Exception as e:
@@ -558,6 +691,8 @@ def update_item(item_id):
         
         # Обработка категорий
         if any(key in data for key in ['category_ids', 'selectedCategories', 'category_names']):
+            # Корневая категория до изменения - для переноса стоимости в сводке
+            roots_before = WarehouseDailyValuation.item_roots([item.id])
             category_ids = []
             
             if data.get('category_ids'):
@@ -583,6 +718,7 @@ def update_item(item_id):
             category_ids = list(set(category_ids))
             if category_ids:
                 item.set_categories(category_ids)
+                WarehouseDailyValuation.record_moves(roots_before)
         
         item.updated_at = datetime.utcnow()
         db.session.commit()
@@ -644,36 +780,31 @@ def search_items():
         except (ValueError, TypeError):
             category_ids = []
         
-        from sqlalchemy import func
-
-        search_filter = f"%{query}%"
-        search_query = WarehouseItem.query.filter(
-            WarehouseItem.status == 'active'
-        ).filter(
-            or_(
-                func.lower(WarehouseItem.name).like(func.lower(search_filter)),
-                func.lower(WarehouseItem.barcode).like(func.lower(search_filter)),
-                func.lower(WarehouseItem.sku).like(func.lower(search_filter)),
-                func.lower(WarehouseItem.description).like(func.lower(search_filter))
-            )
+        search_query = apply_item_search(
+            WarehouseItem.query.filter(WarehouseItem.status == 'active'),
+            query,
+            rank=True
         )
         
-        # Фильтр по категориям
+        # Фильтр по категориям (включая подкатегории)
         if category_ids:
-            categories = WarehouseCategory.query.filter(WarehouseCategory.id.in_(category_ids)).all()
-            all_category_ids = set()
-            for category in categories:
-                all_category_ids.add(category.id)
-                all_category_ids.update(category.get_all_child_ids())
-
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
+            search_query = search_query.filter(
+                WarehouseItem.id.in_(
+                    db.session.query(WarehouseItemCategory.item_id).filter(
+                        WarehouseItemCategory.category_id.in_(all_category_ids)
+                    )
+                )
+            )
         
         items = search_query.limit(limit).all()
+        categories_map = WarehouseItem.load_categories_map([item.id for item in items])
         
         result_items = []
         for item in items:
             try:
-                # Получаем категории товара
-                categories = item.get_categories()
+                # Категории загружены одним запросом на все найденные товары
+                categories = categories_map.get(item.id, [])
                 category_names = [cat.name for cat in categories] if categories else []
                 
                 result_items.append({
@@ -716,7 +847,15 @@ def get_stock():
         sort_by = request.args.get('sort_by', 'name')
         sort_order = request.args.get('sort_order', 'asc')
         
-        print(f"📦 GET /stock - params: category_ids={category_ids}, category_id={category_id}")
+        # Остатки на дату: ?as_of=2026-01-01 (на конец дня) или точное время ISO
+        as_of = None
+        if request.args.get('as_of'):
+            try:
+                as_of = _parse_as_of(request.args['as_of'])
+            except ValueError:
+                return jsonify({'error': 'Неверный формат as_of (ожидается YYYY-MM-DD)'}), 400
+        
+        print(f"📦 GET /stock - params: category_ids={category_ids}, category_id={category_id}, as_of={as_of}")
         
         # Объединяем category_ids
         if category_id:
@@ -729,57 +868,55 @@ def get_stock():
             category_ids = []
         
         query = WarehouseItem.query.filter(WarehouseItem.status == 'active')
+        quantity = WarehouseItem.current_quantity
+        
+        if as_of:
+            # Ближайший снимок + операции после него (без полного прохода по журналу)
+            quantity, snapshot = WarehouseStockSnapshot.quantity_as_of(as_of)
+            query = query.filter(
+                or_(WarehouseItem.created_at.is_(None), WarehouseItem.created_at < as_of)
+            ).outerjoin(
+                snapshot, snapshot.c.item_id == WarehouseItem.id
+            ).add_columns(quantity.label('quantity_as_of'))
         
         # Фильтр по категориям через many-to-many связь
         if category_ids:
-            # Получаем все дочерние категории
-            all_category_ids = []
-            for cat_id in category_ids:
-                all_category_ids.append(cat_id)
-                category = WarehouseCategory.query.get(cat_id)
-                if category:
-                    all_category_ids.extend(category.get_all_child_ids())
-            
-            all_category_ids = list(set(all_category_ids))
-            query = query.join(WarehouseItemCategory).filter(
-                WarehouseItemCategory.category_id.in_(all_category_ids)
-            ).distinct()
+            # Выбранные категории вместе со всеми подкатегориями (один запрос)
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
+            query = query.filter(WarehouseItem.id.in_(
+                db.session.query(WarehouseItemCategory.item_id).filter(
+                    WarehouseItemCategory.category_id.in_(all_category_ids)
+                )
+            ))
         
         if search:
-            search_filter = f"%{search}%"
-            query = query.filter(
-                or_(
-                    WarehouseItem.name.ilike(search_filter),
-                    WarehouseItem.barcode.ilike(search_filter),
-                    WarehouseItem.sku.ilike(search_filter)
-                )
-            )
+            query = apply_item_search(query, search, rank=(sort_by == 'relevance'))
         
         # Фильтр по остаткам
         if stock_filter == 'low':
             query = query.filter(
                 and_(
-                    WarehouseItem.current_quantity > 0,
-                    WarehouseItem.current_quantity <= WarehouseItem.min_quantity
+                    quantity > 0,
+                    quantity <= WarehouseItem.min_quantity
                 )
             )
         elif stock_filter == 'out':
-            query = query.filter(WarehouseItem.current_quantity == 0)
+            query = query.filter(quantity == 0)
         elif stock_filter == 'overstocked':
-            query = query.filter(WarehouseItem.current_quantity > WarehouseItem.max_quantity)
+            query = query.filter(quantity > WarehouseItem.max_quantity)
         elif stock_filter == 'normal':
             query = query.filter(
                 and_(
-                    WarehouseItem.current_quantity > WarehouseItem.min_quantity,
-                    WarehouseItem.current_quantity <= WarehouseItem.max_quantity
+                    quantity > WarehouseItem.min_quantity,
+                    quantity <= WarehouseItem.max_quantity
                 )
             )
         
         # Сортировка
         if sort_by == 'quantity':
-            sort_column = WarehouseItem.current_quantity
+            sort_column = quantity
         elif sort_by == 'value':
-            sort_column = WarehouseItem.current_quantity * WarehouseItem.cost_price
+            sort_column = quantity * WarehouseItem.cost_price
         elif hasattr(WarehouseItem, sort_by):
             sort_column = getattr(WarehouseItem, sort_by)
         else:
@@ -797,12 +934,25 @@ def get_stock():
             error_out=False
         )
         
-        # Добавляем расчетные поля
+        # В режиме as_of строки выборки - пары (товар, остаток на дату)
+        if as_of:
+            page_items = [row[0] for row in pagination.items]
+            quantities = {row[0].id: row[1] for row in pagination.items}
+        else:
+            page_items = pagination.items
+            quantities = {}
+        
+        # Добавляем расчетные поля (категории загружаются пачкой на всю страницу)
         items_data = []
-        for item in pagination.items:
+        for item, item_dict in zip(page_items, WarehouseItem.serialize_many(page_items)):
             try:
-                item_dict = item.to_dict(include_categories=True)
-                item_dict['total_value'] = item.current_quantity * (item.cost_price or 0)
+                if as_of:
+                    # Поля считаются от остатка на дату; резервы на прошлую дату не хранятся - их не отдаём
+                    item_dict['current_quantity'] = quantities[item.id]
+                    item_dict.update(item.stock_flags(quantities[item.id]))
+                    item_dict.pop('reserved_quantity', None)
+                    item_dict.pop('available_quantity', None)
+                item_dict['total_value'] = item_dict['current_quantity'] * (item.cost_price or 0)
                 items_data.append(item_dict)
             except Exception as e:
                 print(f"❌ Ошибка обработки товара {item.id} в остатках: {e}")
@@ -818,11 +968,14 @@ def get_stock():
                     'category_names': []
                 })
         
-        # Статистика по текущей выборке
+        # Стоимость считается по всей выборке, а не только по текущей странице
         total_items = pagination.total
-        total_value = sum(item['total_value'] for item in items_data)
+        total_value = query.order_by(None).with_entities(
+            func.coalesce(func.sum(quantity * func.coalesce(WarehouseItem.cost_price, 0)), 0)
+        ).scalar()
         
         return jsonify({
+            'as_of': as_of.isoformat() if as_of else None,
             'items': items_data,
             'pagination': {
                 'page': page,
@@ -834,7 +987,8 @@ def get_stock():
             },
             'summary': {
                 'total_items': total_items,
-                'total_value': total_value
+                'total_value': float(total_value or 0),
+                'page_value': float(sum(item['total_value'] for item in items_data))
             }
         })
         
@@ -843,6 +997,14 @@ def get_stock():
         return jsonify({'error': f'Ошибка получения остатков: {str(e)}'}), 500
 
 
+def _parse_as_of(value):
+    """Момент времени для запросов "на дату": дата означает конец этого дня"""
+    value = value.strip()
+    if len(value) == 10:
+        return datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)
+    return datetime.fromisoformat(value)
+
+
 # ============ ОПЕРАЦИИ ============
 
 @warehouse_bp.route('/operations', methods=['GET'])
@@ -871,64 +1033,102 @@ def get_operations():
         except (ValueError, TypeError):
             category_ids = []
         
-        query = WarehouseOperation.query
+        date_from_obj = None
+        if date_from:
+            try:
+                date_from_obj = datetime.strptime(date_from, '%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': 'Неверный формат даты date_from'}), 400
+        
+        # Проекция ?fields=id,operation_type,item - только нужные колонки и связи
+        fields = None
+        if request.args.get('fields'):
+            fields = {field.strip() for field in request.args['fields'].split(',') if field.strip()}
+            unknown = fields - set(WarehouseOperation.FIELDS)
+            if unknown:
+                return jsonify({
+                    'error': f"Неизвестные поля: {', '.join(sorted(unknown))}",
+                    'available_fields': list(WarehouseOperation.FIELDS)
+                }), 400
+        
+        # Курсор разбирается заранее: по нему решается, нужен ли архив
+        cursor_position = None
+        if request.args.get('cursor'):
+            try:
+                cursor_position = _decode_operations_cursor(request.args['cursor'])
+            except (ValueError, TypeError):
+                return jsonify({'error': 'Неверный курсор пагинации'}), 400
+        
+        # Архив читается только по явному запросу: ?include_archive=1, date_from
+        # раньше конца архива или курсор, дошедший до конца живой таблицы.
+        # Иначе запрос идёт по индексу (created_at, id) warehouse_operations
+        with_archive = False
+        archive_from = None
+        archived_until = WarehouseOperationArchive.archived_until()
+        if archived_until is not None:
+            live_since = WarehouseOperationArchive.live_since()
+            with_archive = (
+                request.args.get('include_archive', 'false').lower() in ('1', 'true')
+                or (date_from_obj is not None and date_from_obj <= archived_until)
+                or live_since is None
+                or (cursor_position is not None and cursor_position[0] <= live_since)
+            )
+            if not with_archive:
+                archive_from = live_since
+        Operation = WarehouseOperationArchive.operation_entity(with_archive)
+        query = db.session.query(Operation).options(
+            *WarehouseOperation.load_options(fields, entity=Operation)
+        )
         
         # Фильтры
         if item_id:
-            query = query.filter(WarehouseOperation.item_id == item_id)
+            query = query.filter(Operation.item_id == item_id)
         
         if operation_type:
-            query = query.filter(WarehouseOperation.operation_type == operation_type)
+            query = query.filter(Operation.operation_type == operation_type)
         
         if user_id:
-            query = query.filter(WarehouseOperation.user_id == user_id)
+            query = query.filter(Operation.user_id == user_id)
         
-        if date_from:
-            try:
-                date_from_obj = datetime.strptime(date_from, '%Y-%m-%d')
-                query = query.filter(WarehouseOperation.created_at >= date_from_obj)
-            except ValueError:
-                return jsonify({'error': 'Неверный формат даты date_from'}), 400
+        if date_from_obj:
+            query = query.filter(Operation.created_at >= date_from_obj)
         
         if date_to:
             try:
                 date_to_obj = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
-                query = query.filter(WarehouseOperation.created_at < date_to_obj)
+                query = query.filter(Operation.created_at < date_to_obj)
             except ValueError:
                 return jsonify({'error': 'Неверный формат даты date_to'}), 400
         
         # Фильтр по категориям товаров
         if category_ids:
-            # Получаем все дочерние категории
-            all_category_ids = []
-            for cat_id in category_ids:
-                all_category_ids.append(cat_id)
-                category = WarehouseCategory.query.get(cat_id)
-                if category:
-                    all_category_ids.extend(category.get_all_child_ids())
-            
-            all_category_ids = list(set(all_category_ids))
+            # Выбранные категории вместе со всеми подкатегориями (один запрос)
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
             
             # Фильтруем операции по товарам из выбранных категорий
             item_ids_in_categories = db.session.query(WarehouseItemCategory.item_id).filter(
                 WarehouseItemCategory.category_id.in_(all_category_ids)
             ).distinct().subquery()
             
-            query = query.filter(WarehouseOperation.item_id.in_(item_ids_in_categories))
+            query = query.filter(Operation.item_id.in_(item_ids_in_categories))
         
         if search:
             search_filter = f"%{search}%"
-            query = query.join(WarehouseItem).filter(
+            query = query.join(WarehouseItem, WarehouseItem.id == Operation.item_id).filter(
                 or_(
                     WarehouseItem.name.ilike(search_filter),
                     WarehouseItem.barcode.ilike(search_filter),
-                    WarehouseOperation.reason.ilike(search_filter),
-                    WarehouseOperation.comment.ilike(search_filter)
+                    Operation.reason.ilike(search_filter),
+                    Operation.comment.ilike(search_filter)
                 )
             )
         
+        # Курсорная пагинация по (created_at, id): ?cursor= (пустой курсор - первая страница)
+        if 'cursor' in request.args:
+            return _get_operations_by_cursor(query, Operation, cursor_position, per_page, fields, archive_from)
+        
         # Сортировка по дате (новые первые)
-        query = query.order_by(desc(WarehouseOperation.created_at))
+        query = query.order_by(desc(Operation.created_at))
         
         # Пагинация
         pagination = query.paginate(
@@ -938,7 +1138,7 @@ def get_operations():
         )
         
         return jsonify({
-            'operations': [op.to_dict() for op in pagination.items],
+            'operations': WarehouseOperation.serialize_many(pagination.items, fields=fields),
             'pagination': {
                 'page': page,
                 'pages': pagination.pages,
@@ -953,6 +1153,73 @@ def get_operations():
         return jsonify({'error': f'Ошибка получения операций: {str(e)}'}), 500
 
 
+def _decode_operations_cursor(cursor):
+    """Позиция (created_at, id) из курсора операций; ValueError/TypeError - неверный курсор"""
+    created_at, operation_id = decode_cursor(cursor)
+    return datetime.fromisoformat(created_at), int(operation_id)
+
+
+def _get_operations_by_cursor(query, Operation, cursor_position, per_page, fields=None, archive_from=None):
+    """Страница операций по курсору без COUNT и OFFSET
+
+    Операции без created_at (старые записи до появления поля) в курсорную
+    выдачу не попадают: у них нет ключа сортировки, и индекс (created_at, id)
+    остаётся пригодным для поиска. Они видны в постраничном режиме (?page=).
+    
+    archive_from - время самой ранней живой операции, если запрос идёт без
+    архива, а архив не пуст: когда живые операции кончаются, следующий
+    курсор ведёт в архив.
+    """
+    query = query.filter(Operation.created_at.isnot(None))
+    if cursor_position:
+        created_at, operation_id = cursor_position
+        query_page = query.filter(
+            or_(
+                Operation.created_at < created_at,
+                and_(
+                    Operation.created_at == created_at,
+                    Operation.id < operation_id
+                )
+            )
+        )
+    else:
+        query_page = query
+    
+    # Берём на одну запись больше, чтобы узнать, есть ли следующая страница
+    operations = query_page.order_by(
+        desc(Operation.created_at),
+        desc(Operation.id)
+    ).limit(per_page + 1).all()
+    
+    has_next = len(operations) > per_page
+    operations = operations[:per_page]
+    
+    next_cursor = None
+    if has_next and operations:
+        last = operations[-1]
+        next_cursor = encode_cursor([last.created_at.isoformat(), last.id])
+    elif archive_from is not None:
+        # Все архивные операции старше archive_from: курсор (archive_from, 0)
+        # продолжает выдачу с архива и подключает его в следующем запросе
+        has_next = True
+        next_cursor = encode_cursor([archive_from.isoformat(), 0])
+    
+    pagination = {
+        'per_page': per_page,
+        'next_cursor': next_cursor,
+        'has_next': has_next
+    }
+    
+    # Полный подсчёт - только по запросу, он дорогой на большой таблице
+    if request.args.get('include_total', 'false').lower() == 'true':
+        pagination['total'] = query.order_by(None).count()
+    
+    return jsonify({
+        'operations': WarehouseOperation.serialize_many(operations, fields=fields),
+        'pagination': pagination
+    })
+
+
 @warehouse_bp.route('/operations/add-stock', methods=['POST'])
 @jwt_required()
 def add_stock():
@@ -971,12 +1238,9 @@ def add_stock():
         
         item = WarehouseItem.query.get_or_404(data['item_id'])
         
-        # Обновляем количество
-        old_quantity = item.current_quantity
-        new_quantity = old_quantity + quantity
-        
-        operation = item.update_quantity(
-            new_quantity=new_quantity,
+        # Атомарное увеличение остатка в БД
+        operation = item.change_quantity(
+            quantity,
             operation_type='add',
             reason=data.get('reason', 'Поступление'),
             user_id=current_user_id
@@ -1017,23 +1281,19 @@ def remove_stock():
         
         item = WarehouseItem.query.get_or_404(data['item_id'])
         
-        # Проверяем достаточность остатков
-        available_quantity = item.current_quantity - (item.reserved_quantity or 0)
-        if quantity > available_quantity:
-            return jsonify({
-                'error': f'Недостаточно товара на складе. Доступно: {available_quantity} {item.unit}'
-            }), 400
-        
-        # Обновляем количество
-        old_quantity = item.current_quantity
-        new_quantity = old_quantity - quantity
-        
-        operation = item.update_quantity(
-            new_quantity=new_quantity,
-            operation_type='remove',
-            reason=data.get('reason', 'Списание'),
-            user_id=current_user_id
-        )
+        # Проверка остатка и списание - одним условным UPDATE,
+        # чтобы параллельные списания не увели остаток в минус
+        try:
+            operation = item.change_quantity(
+                -quantity,
+                operation_type='remove',
+                reason=data.get('reason', 'Списание'),
+                user_id=current_user_id,
+                check_available=True
+            )
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 400
         
         operation.comment = data.get('comment', '')
         operation.document_number = data.get('document_number', '')
@@ -1052,94 +1312,497 @@ def remove_stock():
         return jsonify({'error': f'Ошибка списания товара: {str(e)}'}), 500
 
 
-# ============ УТИЛИТЫ И УПРАВЛЕНИЕ КАТЕГОРИЯМИ ТОВАРОВ ============
+# ============ РЕЗЕРВЫ ПОД ЗАЯВКИ ============
 
-@warehouse_bp.route('/items/<int:item_id>/categories', methods=['GET'])
+def _parse_reservation_lines(items):
+    """Позиции запроса [{item_id, quantity}] -> {item_id: количество}"""
+    if not items or not isinstance(items, list):
+        raise ValueError('Список товаров обязателен')
+    
+    lines = {}
+    for entry in items:
+        item_id = int(entry['item_id'])
+        quantity = int(entry.get('quantity', 1))
+        if quantity <= 0:
+            raise ValueError('Количество должно быть положительным')
+        lines[item_id] = lines.get(item_id, 0) + quantity
+    return lines
+
+
+def _parse_reservation_period(data, booking=None):
+    """Период резерва из запроса; по умолчанию - дата мероприятия заявки"""
+    start_date = data.get('start_date')
+    end_date = data.get('end_date')
+    
+    if start_date:
+        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+    elif booking and booking.event_date:
+        start_date = booking.event_date
+    else:
+        raise ValueError('Укажите дату начала резерва или заявку с датой мероприятия')
+    
+    end_date = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else start_date
+    WarehouseReservation.validate_period(start_date, end_date)
+    return start_date, end_date
+
+
+@warehouse_bp.route('/reservations', methods=['GET'])
 @jwt_required()
-def get_item_categories(item_id):
-    """Получить категории товара"""
+def get_reservations():
+    """Список резервов с фильтрами по товару, заявке и периоду"""
     try:
-        item = WarehouseItem.query.get_or_404(item_id)
-        categories = item.get_categories()
+        query = WarehouseReservation.query.options(joinedload(WarehouseReservation.item))
+        
+        status = request.args.get('status', 'active')
+        if status != 'all':
+            query = query.filter(WarehouseReservation.status == status)
+        
+        item_id = request.args.get('item_id', type=int)
+        if item_id:
+            query = query.filter(WarehouseReservation.item_id == item_id)
+        
+        booking_id = request.args.get('booking_id', type=int)
+        if booking_id:
+            query = query.filter(WarehouseReservation.booking_id == booking_id)
+        
+        # Пересечение с периодом [date_from, date_to]
+        date_from = request.args.get('date_from')
+        if date_from:
+            query = query.filter(WarehouseReservation.end_date >= datetime.strptime(date_from, '%Y-%m-%d').date())
+        date_to = request.args.get('date_to')
+        if date_to:
+            query = query.filter(WarehouseReservation.start_date <= datetime.strptime(date_to, '%Y-%m-%d').date())
+        
+        limit = min(request.args.get('limit', 200, type=int), 1000)
+        reservations = query.order_by(
+            WarehouseReservation.start_date, WarehouseReservation.id
+        ).limit(limit).all()
         
         return jsonify({
-            'item_id': item_id,
-            'categories': [cat.to_dict() for cat in categories]
+            'reservations': [reservation.to_dict() for reservation in reservations],
+            'total': len(reservations)
         })
         
+    except ValueError as e:
+        return jsonify({'error': f'Неверный формат даты: {str(e)}'}), 400
     except Exception as e:
-        return jsonify({'error': f'Ошибка получения категорий товара: {str(e)}'}), 500
+        return jsonify({'error': f'Ошибка получения резервов: {str(e)}'}), 500
 
 
-@warehouse_bp.route('/items/<int:item_id>/categories', methods=['POST'])
+@warehouse_bp.route('/reservations', methods=['POST'])
 @jwt_required()
-def add_item_categories(item_id):
-    """Добавить категории к товару"""
+def create_reservations():
+    """Зарезервировать список товаров под заявку (всё или ничего)"""
     try:
-        item = WarehouseItem.query.get_or_404(item_id)
-        data = request.get_json()
+        data = request.get_json() or {}
         
-        category_ids = data.get('category_ids', [])
-        if not category_ids:
-            return jsonify({'error': 'Не указаны категории'}), 400
+        booking = None
+        if data.get('booking_id'):
+            booking = Booking.query.get_or_404(data['booking_id'])
+            if booking.status == 'cancelled':
+                return jsonify({'error': 'Заявка отменена'}), 400
         
-        # Добавляем категории
-        for category_id in category_ids:
-            item.add_category(category_id)
+        try:
+            lines = _parse_reservation_lines(data.get('items'))
+            start_date, end_date = _parse_reservation_period(data, booking)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'error': f'Некорректные данные резерва: {str(e)}'}), 400
+        
+        reservations, conflicts = WarehouseReservation.reserve(
+            lines,
+            start_date,
+            end_date,
+            booking_id=booking.id if booking else None,
+            user_id=get_jwt_identity(),
+            comment=data.get('comment')
+        )
+        
+        if conflicts:
+            db.session.rollback()
+            return jsonify({
+                'error': 'Недостаточно свободного товара на выбранные даты',
+                'conflicts': conflicts
+            }), 409
         
         db.session.commit()
         
+        print(f"📌 Зарезервировано позиций: {len(reservations)} на {start_date} - {end_date}")
         return jsonify({
-            'message': f'Добавлены категории к товару "{item.name}"',
-            'item': item.to_dict()
-        })
+            'message': f'Зарезервировано позиций: {len(reservations)}',
+            'reservations': [reservation.to_dict() for reservation in reservations]
+        }), 201
         
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': f'Ошибка добавления категорий: {str(e)}'}), 500
+        return jsonify({'error': f'Ошибка резервирования: {str(e)}'}), 500
 
 
-@warehouse_bp.route('/items/<int:item_id>/categories', methods=['PUT'])
+@warehouse_bp.route('/reservations/<int:reservation_id>/release', methods=['POST'])
 @jwt_required()
-def set_item_categories(item_id):
-    """Установить категории товара (заменить все существующие)"""
+def release_reservation(reservation_id):
+    """Снять резерв"""
     try:
-        item = WarehouseItem.query.get_or_404(item_id)
-        data = request.get_json()
-        
-        category_ids = data.get('category_ids', [])
+        reservation = WarehouseReservation.query.get_or_404(reservation_id)
+        if reservation.status != 'active':
+            return jsonify({'error': 'Резерв уже снят'}), 400
         
-        # Устанавливаем категории (заменяем все существующие)
-        item.set_categories(category_ids)
+        WarehouseReservation.release_many([reservation])
         db.session.commit()
         
         return jsonify({
-            'message': f'Обновлены категории товара "{item.name}"',
-            'item': item.to_dict()
+            'message': 'Резерв снят',
+            'reservation': reservation.to_dict()
         })
         
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': f'Ошибка обновления категорий: {str(e)}'}), 500
+        return jsonify({'error': f'Ошибка снятия резерва: {str(e)}'}), 500
 
 
-@warehouse_bp.route('/items/<int:item_id>/categories', methods=['DELETE'])
+@warehouse_bp.route('/reservations/availability', methods=['POST'])
 @jwt_required()
-def remove_item_categories(item_id):
-    """Удалить категории у товара"""
+def check_availability():
+    """Свободный остаток списка товаров на период (без резервирования)"""
     try:
-        item = WarehouseItem.query.get_or_404(item_id)
-        data = request.get_json()
-        
-        category_ids = data.get('category_ids', [])
-        if not category_ids:
-            return jsonify({'error': 'Не указаны категории для удаления'}), 400
+        data = request.get_json() or {}
         
-        # Удаляем категории
-        for category_id in category_ids:
-            item.remove_category(category_id)
+        booking = None
+        if data.get('booking_id'):
+            booking = Booking.query.get_or_404(data['booking_id'])
         
-        db.session.commit()
+        try:
+            lines = _parse_reservation_lines(data.get('items'))
+            start_date, end_date = _parse_reservation_period(data, booking)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'error': f'Некорректные данные запроса: {str(e)}'}), 400
+        
+        available = WarehouseReservation.availability(lines, start_date, end_date)
+        
+        items = []
+        for item_id, quantity in lines.items():
+            info = available.get(item_id) or {'item_id': item_id, 'available': 0, 'error': 'Товар не найден'}
+            items.append({
+                **info,
+                'requested': quantity,
+                'is_available': info.get('status') == 'active' and info['available'] >= quantity
+            })
+        
+        return jsonify({
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+            'all_available': all(item['is_available'] for item in items),
+            'items': items
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка проверки доступности: {str(e)}'}), 500
+
+
+# ============ ИНВЕНТАРИЗАЦИЯ ============
+
+INVENTORY_COUNTS_BATCH_LIMIT = 5000
+
+
+@warehouse_bp.route('/inventories', methods=['GET'])
+@jwt_required()
+def get_inventories():
+    """Список инвентаризаций"""
+    try:
+        query = WarehouseInventory.query.options(
+            joinedload(WarehouseInventory.creator),
+            joinedload(WarehouseInventory.completer)
+        )
+        
+        status = request.args.get('status')
+        if status:
+            query = query.filter(WarehouseInventory.status == status)
+        
+        inventories = query.order_by(desc(WarehouseInventory.created_at)).limit(100).all()
+        return jsonify({'inventories': [inventory.to_dict() for inventory in inventories]})
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения инвентаризаций: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/inventories', methods=['POST'])
+@jwt_required()
+def create_inventory():
+    """Создать инвентаризацию и сразу начать её (start=false - только запланировать)"""
+    try:
+        data = request.get_json() or {}
+        if not data.get('name', '').strip():
+            return jsonify({'error': 'Название инвентаризации обязательно'}), 400
+        
+        inventory = WarehouseInventory(
+            name=data['name'].strip(),
+            description=data.get('description', ''),
+            status='planned',
+            created_by=int(get_jwt_identity())
+        )
+        db.session.add(inventory)
+        db.session.flush()
+        
+        records_count = 0
+        if data.get('start', True):
+            records_count = inventory.start(data.get('category_ids'))
+        
+        db.session.commit()
+        
+        print(f"📋 Инвентаризация #{inventory.id} создана, позиций: {records_count}")
+        return jsonify({
+            'message': 'Инвентаризация создана',
+            'inventory': inventory.to_dict()
+        }), 201
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка создания инвентаризации: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/inventories/<int:inventory_id>', methods=['GET'])
+@jwt_required()
+def get_inventory(inventory_id):
+    """Инвентаризация со сводкой и страницей записей"""
+    try:
+        inventory = WarehouseInventory.query.get_or_404(inventory_id)
+        page = request.args.get('page', 1, type=int)
+        per_page = min(request.args.get('per_page', 100, type=int), 500)
+        
+        query = WarehouseInventoryRecord.query.options(
+            joinedload(WarehouseInventoryRecord.item),
+            joinedload(WarehouseInventoryRecord.checker)
+        ).filter(WarehouseInventoryRecord.inventory_id == inventory.id)
+        
+        # pending - ещё не посчитаны, difference - с расхождением
+        record_filter = request.args.get('filter')
+        if record_filter == 'pending':
+            query = query.filter(WarehouseInventoryRecord.actual_quantity.is_(None))
+        elif record_filter == 'difference':
+            query = query.filter(
+                WarehouseInventoryRecord.actual_quantity.isnot(None),
+                WarehouseInventoryRecord.difference != 0
+            )
+        
+        records = query.order_by(WarehouseInventoryRecord.id).paginate(
+            page=page, per_page=per_page, error_out=False
+        )
+        
+        return jsonify({
+            'inventory': inventory.to_dict(),
+            'summary': inventory.get_summary(),
+            'records': [record.to_dict() for record in records.items],
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'total': records.total,
+                'pages': records.pages
+            }
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения инвентаризации: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/inventories/<int:inventory_id>/start', methods=['POST'])
+@jwt_required()
+def start_inventory(inventory_id):
+    """Начать запланированную инвентаризацию"""
+    try:
+        inventory = WarehouseInventory.query.get_or_404(inventory_id)
+        data = request.get_json(silent=True) or {}
+        
+        try:
+            records_count = inventory.start(data.get('category_ids'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        db.session.commit()
+        return jsonify({
+            'message': f'Инвентаризация начата, позиций: {records_count}',
+            'inventory': inventory.to_dict()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка начала инвентаризации: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/inventories/<int:inventory_id>/counts', methods=['POST'])
+@jwt_required()
+def submit_inventory_counts(inventory_id):
+    """Передать пачку подсчётов: [{item_id | barcode, quantity, increment, comment}]"""
+    try:
+        inventory = WarehouseInventory.query.get_or_404(inventory_id)
+        counts = (request.get_json() or {}).get('counts') or []
+        
+        if not isinstance(counts, list) or not counts:
+            return jsonify({'error': 'Список подсчётов не может быть пустым'}), 400
+        if len(counts) > INVENTORY_COUNTS_BATCH_LIMIT:
+            return jsonify({'error': f'Не больше {INVENTORY_COUNTS_BATCH_LIMIT} позиций за запрос'}), 400
+        
+        try:
+            updated, errors = inventory.record_counts(counts, user_id=int(get_jwt_identity()))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        db.session.commit()
+        return jsonify({
+            'message': f'Учтено позиций: {updated}',
+            'updated': updated,
+            'errors': errors,
+            'summary': inventory.get_summary()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка сохранения подсчётов: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/inventories/<int:inventory_id>/complete', methods=['POST'])
+@jwt_required()
+def complete_inventory(inventory_id):
+    """Завершить инвентаризацию и применить корректировки остатков"""
+    try:
+        inventory = db.session.get(WarehouseInventory, inventory_id)
+        if inventory is None:
+            return jsonify({'error': 'Инвентаризация не найдена'}), 404
+        data = request.get_json(silent=True) or {}
+        
+        try:
+            adjustments = inventory.complete(
+                user_id=int(get_jwt_identity()),
+                ip_address=get_client_ip(request),
+                missing_as_zero=bool(data.get('missing_as_zero'))
+            )
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 409
+        
+        db.session.commit()
+        
+        print(f"✅ Инвентаризация #{inventory.id} завершена, корректировок: {adjustments}")
+        return jsonify({
+            'message': f'Инвентаризация завершена, корректировок: {adjustments}',
+            'adjustments': adjustments,
+            'inventory': inventory.to_dict(),
+            'summary': inventory.get_summary()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка завершения инвентаризации: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/inventories/<int:inventory_id>/cancel', methods=['POST'])
+@jwt_required()
+def cancel_inventory(inventory_id):
+    """Отменить инвентаризацию без изменения остатков"""
+    try:
+        inventory = db.session.get(WarehouseInventory, inventory_id)
+        if inventory is None:
+            return jsonify({'error': 'Инвентаризация не найдена'}), 404
+        
+        # Отмена не должна проскочить между проверкой и проведением параллельного завершения
+        if not inventory.claim('cancelled', ('planned', 'in_progress')):
+            db.session.rollback()
+            return jsonify({'error': 'Инвентаризация уже завершена'}), 409
+        
+        db.session.commit()
+        return jsonify({'message': 'Инвентаризация отменена', 'inventory': inventory.to_dict()})
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка отмены инвентаризации: {str(e)}'}), 500
+
+
+# ============ УТИЛИТЫ И УПРАВЛЕНИЕ КАТЕГОРИЯМИ ТОВАРОВ ============
+
+@warehouse_bp.route('/items/<int:item_id>/categories', methods=['GET'])
+@jwt_required()
+def get_item_categories(item_id):
+    """Получить категории товара"""
+    try:
+        item = WarehouseItem.query.get_or_404(item_id)
+        categories = item.get_categories()
+        
+        return jsonify({
+            'item_id': item_id,
+            'categories': [cat.to_dict() for cat in categories]
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения категорий товара: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/items/<int:item_id>/categories', methods=['POST'])
+@jwt_required()
+def add_item_categories(item_id):
+    """Добавить категории к товару"""
+    try:
+        item = WarehouseItem.query.get_or_404(item_id)
+        data = request.get_json()
+        
+        category_ids = data.get('category_ids', [])
+        if not category_ids:
+            return jsonify({'error': 'Не указаны категории'}), 400
+        
+        # Добавляем категории
+        for category_id in category_ids:
+            item.add_category(category_id)
+        
+        db.session.commit()
+        
+        return jsonify({
+            'message': f'Добавлены категории к товару "{item.name}"',
+            'item': item.to_dict()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка добавления категорий: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/items/<int:item_id>/categories', methods=['PUT'])
+@jwt_required()
+def set_item_categories(item_id):
+    """Установить категории товара (заменить все существующие)"""
+    try:
+        item = WarehouseItem.query.get_or_404(item_id)
+        data = request.get_json()
+        
+        category_ids = data.get('category_ids', [])
+        
+        # Устанавливаем категории (заменяем все существующие)
+        item.set_categories(category_ids)
+        db.session.commit()
+        
+        return jsonify({
+            'message': f'Обновлены категории товара "{item.name}"',
+            'item': item.to_dict()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка обновления категорий: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/items/<int:item_id>/categories', methods=['DELETE'])
+@jwt_required()
+def remove_item_categories(item_id):
+    """Удалить категории у товара"""
+    try:
+        item = WarehouseItem.query.get_or_404(item_id)
+        data = request.get_json()
+        
+        category_ids = data.get('category_ids', [])
+        if not category_ids:
+            return jsonify({'error': 'Не указаны категории для удаления'}), 400
+        
+        # Удаляем категории
+        for category_id in category_ids:
+            item.remove_category(category_id)
+        
+        db.session.commit()
         
         return jsonify({
             'message': f'Удалены категории у товара "{item.name}"',
@@ -1177,8 +1840,10 @@ def get_barcode_info():
                 'message': 'Товар найден в базе данных'
             })
         
-        # Получаем данные из внешнего сервиса
-        product_data = get_product_from_service_online(barcode)
+        # Получаем данные из внешнего сервиса (через кеш)
+        results, errors = lookup_barcodes([barcode])
+        db.session.commit()
+        product_data = results.get(barcode)
         if not product_data:
             return jsonify({
                 'success' : False,
@@ -1187,9 +1852,6 @@ def get_barcode_info():
                 'message': 'Информация не найдена во внешнем источнике'
             }), 404
         
-        import time
-        time.sleep(0.5)
-        
         return jsonify({
             'success' : True,
             'found_in_database': False,
@@ -1202,6 +1864,312 @@ def get_barcode_info():
         return jsonify({'error': f'Ошибка получения информации: {str(e)}'}), 500
 
 
+@warehouse_bp.route('/barcode/info/batch', methods=['POST'])
+@jwt_required()
+def get_barcode_info_batch():
+    """Получить информацию по списку штрих-кодов (приёмка партии товаров)"""
+    try:
+        data = request.get_json() or {}
+        
+        # Убираем пустые значения и дубликаты, сохраняя порядок
+        barcodes = list(dict.fromkeys(
+            str(barcode).strip() for barcode in data.get('barcodes', []) if str(barcode).strip()
+        ))
+        
+        if not barcodes:
+            return jsonify({'error': 'Список штрих-кодов обязателен'}), 400
+        
+        limit = current_app.config.get('BARCODE_BATCH_LIMIT', 200)
+        if len(barcodes) > limit:
+            return jsonify({'error': f'Не более {limit} штрих-кодов за один запрос'}), 400
+        
+        # Товары из нашей базы - одним запросом
+        existing_items = WarehouseItem.query.filter(WarehouseItem.barcode.in_(barcodes)).all()
+        items_by_barcode = {
+            item.barcode: item_dict
+            for item, item_dict in zip(existing_items, WarehouseItem.serialize_many(existing_items))
+        }
+        
+        external_barcodes = [barcode for barcode in barcodes if barcode not in items_by_barcode]
+        external, errors = lookup_barcodes(external_barcodes) if external_barcodes else ({}, {})
+        db.session.commit()
+        
+        results = []
+        for barcode in barcodes:
+            if barcode in items_by_barcode:
+                results.append({
+                    'barcode': barcode,
+                    'success': True,
+                    'found_in_database': True,
+                    'item': items_by_barcode[barcode]
+                })
+            elif external.get(barcode):
+                results.append({
+                    'barcode': barcode,
+                    'success': True,
+                    'found_in_database': False,
+                    'external_data': external[barcode]
+                })
+            else:
+                result = {
+                    'barcode': barcode,
+                    'success': False,
+                    'found_in_database': False
+                }
+                if barcode in errors:
+                    result['error'] = 'Внешний сервис недоступен'
+                results.append(result)
+        
+        return jsonify({
+            'results': results,
+            'summary': {
+                'total': len(barcodes),
+                'found_in_database': len(items_by_barcode),
+                'found_external': sum(1 for barcode in external_barcodes if external.get(barcode)),
+                'not_found': sum(1 for result in results if not result['success']),
+                'errors': len(errors)
+            }
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения информации: {str(e)}'}), 500
+
+
+# ============ СЕССИИ СКАНИРОВАНИЯ ============
+
+SCAN_FLUSH_SIZE = 1000  # Сколько разных штрих-кодов копить в памяти до записи в базу
+
+
+def _parse_quantity(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _iter_request_scans():
+    """Сканы из тела запроса: (index, barcode, quantity); quantity None - ошибка в скане
+    
+    JSON {scans: ["код", {barcode, quantity}]} или построчный поток text/plain:
+    "штрих-код" либо "штрих-код количество" (разделители: пробел, ; ,).
+    """
+    if request.is_json:
+        for index, scan in enumerate((request.get_json() or {}).get('scans') or []):
+            if isinstance(scan, dict):
+                barcode, quantity = str(scan.get('barcode', '')).strip(), _parse_quantity(scan.get('quantity', 1))
+            else:
+                barcode, quantity = str(scan).strip(), 1
+            if barcode:
+                yield index, barcode, quantity
+        return
+    
+    # Поток (в т.ч. chunked) читаем построчно, не загружая тело целиком
+    for index, raw_line in enumerate(request.stream):
+        parts = raw_line.decode('utf-8', errors='ignore').replace(';', ' ').replace(',', ' ').split()
+        if parts:
+            yield index, parts[0], _parse_quantity(parts[1]) if len(parts) > 1 else 1
+
+
+def _get_open_scan_session(session_id):
+    # Строка блокируется до коммита: проведение или отмена дождутся приёма сканов
+    session = WarehouseScanSession.query.filter_by(id=session_id).with_for_update().populate_existing().first()
+    if session is None:
+        raise LookupError('Сессия сканирования не найдена')
+    if session.status != 'open':
+        raise ValueError('Сессия сканирования уже закрыта')
+    return session
+
+
+def _claim_scan_session(session_id, status, **values):
+    """Атомарно перевести открытую сессию в status.
+
+    Условный UPDATE ... WHERE status = 'open' пропускает только один запрос:
+    повторное проведение (ретрай ручного терминала, второй клик) получит None.
+    """
+    result = db.session.execute(
+        db.update(WarehouseScanSession).where(
+            WarehouseScanSession.id == session_id,
+            WarehouseScanSession.status == 'open'
+        ).values(status=status, updated_at=datetime.utcnow(), **values),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return None
+    return WarehouseScanSession.query.filter_by(id=session_id).populate_existing().one()
+
+
+def _closed_scan_session_response(session_id):
+    if db.session.get(WarehouseScanSession, session_id) is None:
+        return jsonify({'error': 'Сессия сканирования не найдена'}), 404
+    return jsonify({'error': 'Сессия сканирования уже закрыта'}), 409
+
+
+@warehouse_bp.route('/scan-sessions', methods=['POST'])
+@jwt_required()
+def create_scan_session():
+    """Открыть сессию сканирования (приёмка или списание)"""
+    try:
+        data = request.get_json() or {}
+        operation_type = data.get('operation_type', 'add')
+        if operation_type not in ('add', 'remove'):
+            return jsonify({'error': 'Тип операции должен быть add или remove'}), 400
+        
+        session = WarehouseScanSession(
+            user_id=int(get_jwt_identity()),
+            operation_type=operation_type,
+            reason=data.get('reason') or ('Поступление' if operation_type == 'add' else 'Списание'),
+            comment=data.get('comment', ''),
+            document_number=data.get('document_number', '')
+        )
+        db.session.add(session)
+        db.session.commit()
+        
+        return jsonify({'message': 'Сессия сканирования открыта', 'session': session.to_dict()}), 201
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка открытия сессии: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/scan-sessions/<int:session_id>/scans', methods=['POST'])
+@jwt_required()
+def add_scan_session_scans(session_id):
+    """Передать сканы пачкой (JSON) или потоком (text/plain, по скану на строку)
+    
+    Повторные штрих-коды схлопываются в количество; один commit на запрос.
+    """
+    try:
+        try:
+            session = _get_open_scan_session(session_id)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 409
+        
+        received = 0
+        errors = []
+        pending = {}
+        for index, barcode, quantity in _iter_request_scans():
+            if quantity is None or quantity <= 0 or len(barcode) > 100:
+                errors.append({'index': index, 'barcode': barcode, 'error': 'Некорректный скан'})
+                continue
+            
+            pending[barcode] = pending.get(barcode, 0) + quantity
+            if len(pending) >= SCAN_FLUSH_SIZE:
+                received += session.add_scans(pending.items())
+                pending = {}
+        
+        received += session.add_scans(pending.items())
+        db.session.commit()
+        
+        return jsonify({
+            'received': received,
+            'errors': errors,
+            'session': session.to_dict()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка приёма сканов: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/scan-sessions/<int:session_id>', methods=['GET'])
+@jwt_required()
+def get_scan_session(session_id):
+    """Сессия сканирования с накопленными строками"""
+    try:
+        session = WarehouseScanSession.query.get_or_404(session_id)
+        
+        lines = []
+        for line, item in session.get_lines():
+            data = {'barcode': line.barcode, 'quantity': line.quantity, 'item_id': line.item_id, 'found': item is not None}
+            if item is not None:
+                data['item'] = {
+                    'id': item.id,
+                    'name': item.name,
+                    'unit': item.unit,
+                    'current_quantity': item.current_quantity or 0,
+                    'available_quantity': (item.current_quantity or 0) - (item.reserved_quantity or 0)
+                }
+            lines.append(data)
+        
+        return jsonify({
+            'session': session.to_dict(),
+            'lines': lines,
+            'summary': {
+                'lines': len(lines),
+                'unknown_barcodes': sum(1 for line in lines if not line['found']),
+                'total_quantity': sum(line['quantity'] for line in lines)
+            }
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения сессии: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/scan-sessions/<int:session_id>/commit', methods=['POST'])
+@jwt_required()
+def commit_scan_session(session_id):
+    """Провести сессию: все строки одной пачкой операций в одной транзакции"""
+    try:
+        # Сессия занимается до изменения остатков - склад проводится ровно один раз
+        session = _claim_scan_session(session_id, 'committed', committed_at=datetime.utcnow())
+        if session is None:
+            return _closed_scan_session_response(session_id)
+        
+        session.resolve_unknown_barcodes()
+        
+        items = []
+        unknown = []
+        for line, item in session.get_lines():
+            if item is None:
+                unknown.append(line.barcode)
+            else:
+                items.append({'item_id': item.id, 'quantity': line.quantity, 'reason': session.reason, 'comment': session.comment})
+        
+        result = _apply_bulk_stock_operation(
+            {'items': items, 'document_number': session.document_number},
+            session.operation_type,
+            session.reason,
+            commit=False
+        )
+        result['errors'].extend(f'Штрих-код {barcode} не найден в базе' for barcode in unknown)
+        result['error_count'] = len(result['errors'])
+        
+        session.result = {
+            'success_count': result['success_count'],
+            'error_count': result['error_count'],
+            'errors': result['errors']
+        }
+        db.session.commit()
+        
+        print(f"📦 Сессия сканирования #{session.id} проведена: {result['success_count']} операций")
+        result['session'] = session.to_dict()
+        return jsonify(result)
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка проведения сессии: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/scan-sessions/<int:session_id>/cancel', methods=['POST'])
+@jwt_required()
+def cancel_scan_session(session_id):
+    """Отменить сессию без изменения остатков"""
+    try:
+        session = _claim_scan_session(session_id, 'cancelled')
+        if session is None:
+            return _closed_scan_session_response(session_id)
+        
+        db.session.commit()
+        return jsonify({'message': 'Сессия сканирования отменена', 'session': session.to_dict()})
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка отмены сессии: {str(e)}'}), 500
+
+
 @warehouse_bp.route('/constants', methods=['GET'])
 @jwt_required()
 def get_constants():
@@ -1255,15 +2223,8 @@ def export_stock():
         
         # Фильтр по категориям через many-to-many связь
         if category_ids:
-            # Получаем все дочерние категории
-            all_category_ids = []
-            for cat_id in category_ids:
-                all_category_ids.append(cat_id)
-                category = WarehouseCategory.query.get(cat_id)
-                if category:
-                    all_category_ids.extend(category.get_all_child_ids())
-            
-            all_category_ids = list(set(all_category_ids))
+            # Выбранные категории вместе со всеми подкатегориями (один запрос)
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
             query = query.join(WarehouseItemCategory).filter(
                 WarehouseItemCategory.category_id.in_(all_category_ids)
             ).distinct()
@@ -1281,64 +2242,37 @@ def export_stock():
         elif stock_filter == 'overstocked':
             query = query.filter(WarehouseItem.current_quantity > WarehouseItem.max_quantity)
         
-        items = query.order_by(WarehouseItem.name).all()
+        query = query.order_by(WarehouseItem.name, WarehouseItem.id)
         
-        # Создаем CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Заголовки
-        writer.writerow([
-            'Название', 'Штрих-код', 'Артикул', 'Категории', 'Единица',
-            'Текущее количество', 'Зарезервировано', 'Доступно',
-            'Мин. количество', 'Макс. количество', 'Себестоимость',
-            'Общая стоимость', 'Статус остатков', 'Последняя операция'
-        ])
-        
-        # Данные
-        for item in items:
-            try:
-                # Получаем категории товара
-                categories = item.get_categories()
-                category_names = [cat.name for cat in categories] if categories else ['Без категории']
-                
-                available_qty = item.current_quantity - (item.reserved_quantity or 0)
-                total_value = item.current_quantity * (float(item.cost_price) if item.cost_price else 0)
-                
-                # Определяем статус остатков
-                if item.current_quantity == 0:
-                    stock_status = 'Нет в наличии'
-                elif item.current_quantity <= item.min_quantity:
-                    stock_status = 'Низкий остаток'
-                elif item.current_quantity > item.max_quantity:
-                    stock_status = 'Избыток'
-                else:
-                    stock_status = 'Нормально'
-                
-                writer.writerow([
-                    item.name,
-                    item.barcode or '',
-                    item.sku or '',
-                    ', '.join(category_names),  # Объединяем категории через запятую
-                    item.unit,
-                    item.current_quantity,
-                    item.reserved_quantity or 0,
-                    available_qty,
-                    item.min_quantity,
-                    item.max_quantity,
-                    float(item.cost_price) if item.cost_price else 0,
-                    total_value,
-                    stock_status,
-                    item.last_operation_at.strftime('%Y-%m-%d %H:%M:%S') if item.last_operation_at else ''
-                ])
-            except Exception as e:
-                print(f"❌ Ошибка экспорта товара {item.id}: {e}")
-                continue
-        
-        output.seek(0)
+        def generate():
+            # Небольшой буфер на одну пачку строк - память не зависит от размера каталога
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            
+            # Заголовки отправляем сразу, до первого запроса к товарам
+            writer.writerow([
+                'Название', 'Штрих-код', 'Артикул', 'Категории', 'Единица',
+                'Текущее количество', 'Зарезервировано', 'Доступно',
+                'Мин. количество', 'Макс. количество', 'Себестоимость',
+                'Общая стоимость', 'Статус остатков', 'Последняя операция'
+            ])
+            yield _flush_csv_buffer(buffer)
+            
+            # Товары читаются серверным курсором, категории подгружаются пачками
+            chunk = []
+            for item in query.yield_per(EXPORT_CHUNK_SIZE):
+                chunk.append(item)
+                if len(chunk) >= EXPORT_CHUNK_SIZE:
+                    _write_stock_export_rows(writer, chunk)
+                    chunk = []
+                    yield _flush_csv_buffer(buffer)
+            
+            if chunk:
+                _write_stock_export_rows(writer, chunk)
+                yield _flush_csv_buffer(buffer)
         
         return Response(
-            output.getvalue(),
+            stream_with_context(generate()),
             mimetype='text/csv',
             headers={
                 'Content-Disposition': f'attachment; filename=warehouse_stock_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
@@ -1349,6 +2283,57 @@ def export_stock():
         return jsonify({'error': f'Ошибка экспорта остатков: {str(e)}'}), 500
 
 
+def _flush_csv_buffer(buffer):
+    """Забрать накопленный текст из буфера CSV и очистить его"""
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return data
+
+
+def _write_stock_export_rows(writer, items):
+    """Записать пачку товаров в CSV, загрузив их категории одним запросом"""
+    categories_map = WarehouseItem.load_categories_map([item.id for item in items])
+    
+    for item in items:
+        try:
+            categories = categories_map.get(item.id)
+            category_names = [cat.name for cat in categories] if categories else ['Без категории']
+            
+            available_qty = item.current_quantity - (item.reserved_quantity or 0)
+            total_value = item.current_quantity * (float(item.cost_price) if item.cost_price else 0)
+            
+            # Определяем статус остатков
+            if item.current_quantity == 0:
+                stock_status = 'Нет в наличии'
+            elif item.current_quantity <= item.min_quantity:
+                stock_status = 'Низкий остаток'
+            elif item.current_quantity > item.max_quantity:
+                stock_status = 'Избыток'
+            else:
+                stock_status = 'Нормально'
+            
+            writer.writerow([
+                item.name,
+                item.barcode or '',
+                item.sku or '',
+                ', '.join(category_names),  # Объединяем категории через запятую
+                item.unit,
+                item.current_quantity,
+                item.reserved_quantity or 0,
+                available_qty,
+                item.min_quantity,
+                item.max_quantity,
+                float(item.cost_price) if item.cost_price else 0,
+                total_value,
+                stock_status,
+                item.last_operation_at.strftime('%Y-%m-%d %H:%M:%S') if item.last_operation_at else ''
+            ])
+        except Exception as e:
+            print(f"❌ Ошибка экспорта товара {item.id}: {e}")
+            continue
+
+
 # ============ ДИАГНОСТИКА И ОТЛАДКА ============
 
 @warehouse_bp.route('/debug/status', methods=['GET'])
@@ -1406,6 +2391,19 @@ def warehouse_debug_status():
             if orphaned_relations > 0:
                 status['issues'].append(f"Найдено {orphaned_relations} некорректных связей товар-категория")
                 status['suggestions'].append("Выполните: flask fix-warehouse")
+            
+            # Категории, отсутствующие в таблице замыкания иерархии
+            categories_without_closure = db.session.query(WarehouseCategory).filter(
+                ~WarehouseCategory.id.in_(
+                    db.session.query(WarehouseCategoryClosure.descendant_id).filter(
+                        WarehouseCategoryClosure.depth == 0
+                    )
+                )
+            ).count()
+            
+            if categories_without_closure > 0:
+                status['issues'].append(f"Найдено {categories_without_closure} категорий вне дерева категорий")
+                status['suggestions'].append("Выполните: flask rebuild-category-tree")
                 
         except Exception as e:
             status['issues'].append(f"Ошибка проверки целостности: {e}")
@@ -1478,7 +2476,16 @@ def warehouse_debug_fix():
         except Exception as e:
             results['remaining_issues'].append(f'Ошибка очистки связей: {e}')
         
-        # 4. Создаем примеры данных если их нет
+        # 4. Пересобираем таблицу замыкания иерархии категорий
+        try:
+            links_count = WarehouseCategoryClosure.rebuild()
+            db.session.commit()
+            results['actions_taken'].append(f'Пересобрано дерево категорий ({links_count} связей)')
+        except Exception as e:
+            db.session.rollback()
+            results['remaining_issues'].append(f'Ошибка пересборки дерева категорий: {e}')
+        
+        # 5. Создаем примеры данных если их нет
         try:
             if WarehouseCategory.query.count() == 0:
                 from models import create_sample_warehouse_data
@@ -1516,48 +2523,35 @@ def get_stock_movement_analytics():
         except (ValueError, TypeError):
             category_ids = []
         
-        start_date = datetime.utcnow() - timedelta(days=days)
-        
-        query = WarehouseOperation.query.filter(
-            WarehouseOperation.created_at >= start_date
-        )
+        # Сводка хранится по дням, поэтому окно считается целыми днями
+        start_date = (datetime.utcnow() - timedelta(days=days)).date()
         
         # Фильтр по категориям товаров
+        item_ids_in_categories = None
         if category_ids:
-            # Получаем все дочерние категории
-            all_category_ids = []
-            for cat_id in category_ids:
-                all_category_ids.append(cat_id)
-                category = WarehouseCategory.query.get(cat_id)
-                if category:
-                    all_category_ids.extend(category.get_all_child_ids())
-            
-            all_category_ids = list(set(all_category_ids))
+            # Выбранные категории вместе со всеми подкатегориями (один запрос)
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
             
-            # Фильтруем операции по товарам из выбранных категорий
             item_ids_in_categories = db.session.query(WarehouseItemCategory.item_id).filter(
                 WarehouseItemCategory.category_id.in_(all_category_ids)
-            ).distinct().subquery()
-            
-            query = query.filter(WarehouseOperation.item_id.in_(item_ids_in_categories))
+            ).distinct()
         
-        # Группировка по дням
+        # Группировка по дням из дневной сводки - O(дней), а не O(операций)
         daily_stats = db.session.query(
-            func.date(WarehouseOperation.created_at).label('date'),
-            WarehouseOperation.operation_type,
-            func.count(WarehouseOperation.id).label('count'),
-            func.sum(func.abs(WarehouseOperation.quantity_change)).label('quantity')
+            WarehouseDailyMovement.date.label('date'),
+            WarehouseDailyMovement.operation_type,
+            func.sum(WarehouseDailyMovement.operations_count).label('count'),
+            func.sum(WarehouseDailyMovement.quantity_total).label('quantity')
         ).filter(
-            WarehouseOperation.created_at >= start_date
+            WarehouseDailyMovement.date >= start_date
         )
         
-        # Применяем фильтр по категориям к группировке
-        if category_ids:
-            daily_stats = daily_stats.filter(WarehouseOperation.item_id.in_(item_ids_in_categories))
+        if item_ids_in_categories is not None:
+            daily_stats = daily_stats.filter(WarehouseDailyMovement.item_id.in_(item_ids_in_categories))
         
         daily_stats = daily_stats.group_by(
-            func.date(WarehouseOperation.created_at),
-            WarehouseOperation.operation_type
+            WarehouseDailyMovement.date,
+            WarehouseDailyMovement.operation_type
         ).all()
         
         # Форматируем данные для графиков
@@ -1567,25 +2561,28 @@ def get_stock_movement_analytics():
             if date_str not in chart_data:
                 chart_data[date_str] = {}
             chart_data[date_str][stat.operation_type] = {
-                'count': stat.count,
+                'count': int(stat.count) if stat.count else 0,
                 'quantity': int(stat.quantity) if stat.quantity else 0
             }
         
         # Топ товаров по активности в выбранных категориях
+        operation_count = func.sum(WarehouseDailyMovement.operations_count)
         top_items_query = db.session.query(
             WarehouseItem.id,
             WarehouseItem.name,
-            func.count(WarehouseOperation.id).label('operation_count'),
-            func.sum(func.abs(WarehouseOperation.quantity_change)).label('total_quantity')
-        ).join(WarehouseOperation).filter(
-            WarehouseOperation.created_at >= start_date
+            operation_count.label('operation_count'),
+            func.sum(WarehouseDailyMovement.quantity_total).label('total_quantity')
+        ).join(
+            WarehouseDailyMovement, WarehouseDailyMovement.item_id == WarehouseItem.id
+        ).filter(
+            WarehouseDailyMovement.date >= start_date
         )
         
-        if category_ids:
+        if item_ids_in_categories is not None:
             top_items_query = top_items_query.filter(WarehouseItem.id.in_(item_ids_in_categories))
         
-        top_items = top_items_query.group_by(WarehouseItem.id).order_by(
-            desc(func.count(WarehouseOperation.id))
+        top_items = top_items_query.group_by(WarehouseItem.id, WarehouseItem.name).order_by(
+            desc(operation_count)
         ).limit(10).all()
         
         return jsonify({
@@ -1596,7 +2593,7 @@ def get_stock_movement_analytics():
                 {
                     'id': item_id,
                     'name': name,
-                    'operation_count': count,
+                    'operation_count': int(count) if count else 0,
                     'total_quantity': int(quantity) if quantity else 0
                 }
                 for item_id, name, count, quantity in top_items
@@ -1628,15 +2625,8 @@ def get_low_stock_alerts():
         
         # Если указаны категории, добавляем фильтр
         if category_ids:
-            # Получаем все дочерние категории
-            all_category_ids = []
-            for cat_id in category_ids:
-                all_category_ids.append(cat_id)
-                category = WarehouseCategory.query.get(cat_id)
-                if category:
-                    all_category_ids.extend(category.get_all_child_ids())
-            
-            all_category_ids = list(set(all_category_ids))
+            # Выбранные категории вместе со всеми подкатегориями (один запрос)
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
             
             # Фильтр по категориям
             category_filter = WarehouseItem.id.in_(
@@ -1673,9 +2663,9 @@ def get_low_stock_alerts():
         
         return jsonify({
             'category_filter': category_ids,
-            'low_stock': [item.to_dict() for item in low_stock_items],
-            'out_of_stock': [item.to_dict() for item in out_of_stock_items],
-            'overstocked': [item.to_dict() for item in overstocked_items],
+            'low_stock': WarehouseItem.serialize_many(low_stock_items),
+            'out_of_stock': WarehouseItem.serialize_many(out_of_stock_items),
+            'overstocked': WarehouseItem.serialize_many(overstocked_items),
             'summary': {
                 'low_stock_count': len(low_stock_items),
                 'out_of_stock_count': len(out_of_stock_items),
@@ -1687,69 +2677,203 @@ def get_low_stock_alerts():
         return jsonify({'error': f'Ошибка получения уведомлений: {str(e)}'}), 500
 
 
-# ============ МАССОВЫЕ ОПЕРАЦИИ ============
+@warehouse_bp.route('/analytics/valuation', methods=['GET'])
+@jwt_required()
+def get_valuation_analytics():
+    """Стоимость склада на конец каждого дня: всего и по корневым категориям"""
+    try:
+        today = datetime.utcnow().date()
+        try:
+            date_to = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else today
+            date_from = datetime.strptime(request.args['from'], '%Y-%m-%d').date() \
+                if request.args.get('from') else date_to - timedelta(days=364)
+        except ValueError:
+            return jsonify({'error': 'Неверный формат даты (ожидается YYYY-MM-DD)'}), 400
+        
+        if date_from > date_to:
+            return jsonify({'error': 'Дата начала позже даты окончания'}), 400
+        if (date_to - date_from).days > 3660:
+            return jsonify({'error': 'Период не может быть длиннее 10 лет'}), 400
+        
+        category_id = request.args.get('category_id', type=int)
+        
+        # Сводка пересобирается только командой flask rebuild-valuation, здесь лишь сообщаем о расхождении
+        consistent = WarehouseDailyValuation.is_consistent()
+        if not consistent:
+            print("⚠️ Сводка стоимости склада не сходится с остатками, выполните flask rebuild-valuation")
+        
+        opening, daily = WarehouseDailyValuation.series(date_from, date_to)
+        
+        values = {key: value for key, (value, _) in opening.items()}
+        quantities = {key: quantity for key, (_, quantity) in opening.items()}
+        changes = {}
+        for day, root_id, value_change, quantity_change in daily:
+            changes.setdefault(day, []).append((root_id, value_change, quantity_change))
+        
+        # Накопленная сумма изменений по дням
+        series = []
+        day = date_from
+        while day <= date_to:
+            for root_id, value_change, quantity_change in changes.get(day, []):
+                values[root_id] = values.get(root_id, 0) + (value_change or 0)
+                quantities[root_id] = quantities.get(root_id, 0) + (quantity_change or 0)
+            
+            if category_id is not None:
+                point = {
+                    'date': day.isoformat(),
+                    'value': float(values.get(category_id, 0)),
+                    'quantity': quantities.get(category_id, 0)
+                }
+            else:
+                point = {
+                    'date': day.isoformat(),
+                    'value': float(sum(values.values())),
+                    'quantity': sum(quantities.values()),
+                    'categories': {str(key): float(value) for key, value in values.items() if value}
+                }
+            series.append(point)
+            day += timedelta(days=1)
+        
+        category_names = dict(db.session.query(WarehouseCategory.id, WarehouseCategory.name).filter(
+            WarehouseCategory.id.in_([key for key in values if key])
+        ).all()) if values else {}
+        category_names[0] = 'Без категории'
+        
+        return jsonify({
+            'from': date_from.isoformat(),
+            'to': date_to.isoformat(),
+            'category_id': category_id,
+            'consistent': consistent,
+            'categories': [
+                {'id': key, 'name': category_names.get(key, f'Категория {key}')}
+                for key in sorted(values)
+            ],
+            'series': series
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения стоимости склада: {str(e)}'}), 500
 
-@warehouse_bp.route('/operations/bulk-add', methods=['POST'])
+
+@warehouse_bp.route('/analytics/forecast', methods=['GET'])
 @jwt_required()
-def bulk_add_stock():
-    """Массовое поступление товаров"""
+def get_stock_forecast():
+    """Прогноз расхода: дни до нуля и точка заказа по сохранённому расчёту"""
     try:
-        data = request.get_json()
-        current_user_id = get_jwt_identity()
+        category_ids = request.args.getlist('category_ids')
+        category_id = request.args.get('category_id', type=int)
+        if category_id:
+            category_ids.append(str(category_id))
+        category_ids = [int(cid) for cid in category_ids if cid and str(cid).isdigit()]
         
-        items_data = data.get('items', [])
-        if not items_data:
-            return jsonify({'error': 'Список товаров не может быть пустым'}), 400
+        horizon_days = request.args.get('horizon_days', type=int)
+        only_reorder = request.args.get('only_reorder', 'false').lower() == 'true'
+        limit = min(request.args.get('limit', 100, type=int), 1000)
         
-        operations = []
-        updated_items = []
-        errors = []
+        settings = {
+            'window_days': current_app.config.get('FORECAST_WINDOW_DAYS', 90),
+            'ewma_span_days': current_app.config.get('FORECAST_EWMA_SPAN_DAYS', 14),
+            'lead_time_days': current_app.config.get('FORECAST_LEAD_TIME_DAYS', 7)
+        }
         
-        for item_data in items_data:
-            try:
-                item_id = item_data.get('item_id')
-                quantity = int(item_data.get('quantity', 0))
-                
-                if not item_id or quantity <= 0:
-                    errors.append(f'Неверные данные для товара ID {item_id}')
-                    continue
-                
-                item = WarehouseItem.query.get(item_id)
-                if not item:
-                    errors.append(f'Товар с ID {item_id} не найден')
-                    continue
-                
-                old_quantity = item.current_quantity
-                new_quantity = old_quantity + quantity
-                
-                operation = item.update_quantity(
-                    new_quantity=new_quantity,
-                    operation_type='add',
-                    reason=item_data.get('reason', 'Массовое поступление'),
-                    user_id=current_user_id
+        # GET только читает: расчёт запускают POST /analytics/forecast/refresh и forecast-stock
+        if not db.session.query(WarehouseItemForecast.item_id).first():
+            return jsonify({
+                'forecasts': [],
+                'total': 0,
+                'computed': False,
+                'computed_at': None,
+                'settings': settings
+            })
+        
+        query = db.session.query(WarehouseItemForecast, WarehouseItem).join(
+            WarehouseItem, WarehouseItem.id == WarehouseItemForecast.item_id
+        ).filter(WarehouseItem.status == 'active')
+        
+        if category_ids:
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
+            query = query.filter(WarehouseItem.id.in_(
+                db.session.query(WarehouseItemCategory.item_id).filter(
+                    WarehouseItemCategory.category_id.in_(all_category_ids)
                 )
-                
-                operation.comment = item_data.get('comment', '')
-                operation.document_number = data.get('document_number', '')
-                operation.ip_address = get_client_ip(request)
-                
-                operations.append(operation)
-                updated_items.append(item)
-                
-            except Exception as e:
-                errors.append(f'Ошибка обработки товара ID {item_data.get("item_id")}: {str(e)}')
+            ))
         
-        if operations:
-            db.session.commit()
+        if horizon_days is not None:
+            query = query.filter(WarehouseItemForecast.days_to_stockout <= horizon_days)
+        
+        if only_reorder:
+            query = query.filter(
+                WarehouseItemForecast.ewma_daily_usage > 0,
+                WarehouseItemForecast.available_quantity <= WarehouseItemForecast.reorder_point
+            )
+        
+        rows = query.order_by(
+            WarehouseItemForecast.days_to_stockout.is_(None),
+            WarehouseItemForecast.days_to_stockout,
+            WarehouseItem.name
+        ).limit(limit).all()
+        
+        forecasts = []
+        for forecast, item in rows:
+            data = forecast.to_dict()
+            data['item'] = {
+                'id': item.id,
+                'name': item.name,
+                'barcode': item.barcode,
+                'sku': item.sku,
+                'unit': item.unit,
+                'current_quantity': item.current_quantity or 0,
+                'min_quantity': item.min_quantity or 0,
+                'max_quantity': item.max_quantity or 0
+            }
+            forecasts.append(data)
         
         return jsonify({
-            'message': f'Обработано {len(operations)} товаров',
-            'success_count': len(operations),
-            'error_count': len(errors),
-            'errors': errors,
-            'operations': [op.to_dict() for op in operations]
+            'forecasts': forecasts,
+            'total': len(forecasts),
+            'computed': True,
+            'computed_at': rows[0][0].computed_at.isoformat() if rows else None,
+            'settings': settings
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Ошибка получения прогноза: {str(e)}'}), 500
+
+
+@warehouse_bp.route('/analytics/forecast/refresh', methods=['POST'])
+@jwt_required()
+def refresh_stock_forecast():
+    """Пересчитать прогноз расхода для всех товаров"""
+    try:
+        items_count, elapsed = compute_forecasts()
+        db.session.commit()
+        
+        print(f"📈 Прогноз пересчитан: {items_count} товаров за {elapsed:.3f} с")
+        return jsonify({
+            'message': f'Прогноз пересчитан для {items_count} товаров',
+            'items_count': items_count,
+            'compute_seconds': round(elapsed, 3)
         })
         
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка пересчета прогноза: {str(e)}'}), 500
+
+
+# ============ МАССОВЫЕ ОПЕРАЦИИ ============
+
+@warehouse_bp.route('/operations/bulk-add', methods=['POST'])
+@jwt_required()
+def bulk_add_stock():
+    """Массовое поступление товаров"""
+    try:
+        data = request.get_json()
+        
+        if not data.get('items', []):
+            return jsonify({'error': 'Список товаров не может быть пустым'}), 400
+        
+        return jsonify(_apply_bulk_stock_operation(data, 'add', 'Массовое поступление'))
+        
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Ошибка массового поступления: {str(e)}'}), 500
@@ -1761,71 +2885,132 @@ def bulk_remove_stock():
     """Массовое списание товаров"""
     try:
         data = request.get_json()
-        current_user_id = get_jwt_identity()
         
-        items_data = data.get('items', [])
-        if not items_data:
+        if not data.get('items', []):
             return jsonify({'error': 'Список товаров не может быть пустым'}), 400
         
-        operations = []
-        updated_items = []
-        errors = []
-        
-        for item_data in items_data:
-            try:
-                item_id = item_data.get('item_id')
-                quantity = int(item_data.get('quantity', 0))
-                
-                if not item_id or quantity <= 0:
-                    errors.append(f'Неверные данные для товара ID {item_id}')
-                    continue
-                
-                item = WarehouseItem.query.get(item_id)
-                if not item:
-                    errors.append(f'Товар с ID {item_id} не найден')
-                    continue
-                
-                available_quantity = item.current_quantity - (item.reserved_quantity or 0)
-                if quantity > available_quantity:
-                    errors.append(f'Товар "{item.name}": недостаточно остатков ({available_quantity} доступно)')
-                    continue
-                
-                old_quantity = item.current_quantity
-                new_quantity = old_quantity - quantity
-                
-                operation = item.update_quantity(
-                    new_quantity=new_quantity,
-                    operation_type='remove',
-                    reason=item_data.get('reason', 'Массовое списание'),
-                    user_id=current_user_id
-                )
-                
-                operation.comment = item_data.get('comment', '')
-                operation.document_number = data.get('document_number', '')
-                operation.ip_address = get_client_ip(request)
-                
-                operations.append(operation)
-                updated_items.append(item)
-                
-            except Exception as e:
-                errors.append(f'Ошибка обработки товара ID {item_data.get("item_id")}: {str(e)}')
-        
-        if operations:
-            db.session.commit()
-        
-        return jsonify({
-            'message': f'Обработано {len(operations)} товаров',
-            'success_count': len(operations),
-            'error_count': len(errors),
-            'errors': errors,
-            'operations': [op.to_dict() for op in operations]
-        })
+        return jsonify(_apply_bulk_stock_operation(data, 'remove', 'Массовое списание'))
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Ошибка массового списания: {str(e)}'}), 500
 
 
+def _apply_bulk_stock_operation(data, operation_type, default_reason, commit=True):
+    """Пакетная обработка накладной: один запрос за товарами, одна вставка операций
+
+    Ошибочные строки попадают в errors и не мешают остальным (как и раньше).
+    При commit=False транзакцию завершает вызывающий код.
+    """
+    current_user_id = get_jwt_identity()
+    items_data = data.get('items', [])
+    document_number = data.get('document_number', '')
+    ip_address = get_client_ip(request)
+    
+    # 1. Разбираем строки и собираем ID товаров для одного IN-запроса
+    lines = []
+    for item_data in items_data:
+        try:
+            item_id = item_data.get('item_id')
+            quantity = int(item_data.get('quantity', 0))
+            lines.append((item_data, int(item_id) if item_id else None, quantity, None))
+        except Exception as e:
+            lines.append((item_data, None, 0, f'Ошибка обработки товара ID {item_data.get("item_id")}: {str(e)}'))
+    
+    item_ids = {item_id for _, item_id, quantity, error in lines if item_id and not error}
+    # Строки блокируются до коммита, чтобы параллельные операции
+    # не работали с устаревшими остатками (в порядке id - без взаимоблокировок)
+    items = {
+        item.id: item
+        for item in WarehouseItem.query.filter(WarehouseItem.id.in_(item_ids))
+        .order_by(WarehouseItem.id).with_for_update().populate_existing().all()
+    } if item_ids else {}
+    
+    # 2. Проверяем и применяем строки по порядку в памяти
+    now = datetime.utcnow()
+    quantities = {}
+    operation_rows = []
+    errors = []
+    
+    for item_data, item_id, quantity, error in lines:
+        if error:
+            errors.append(error)
+            continue
+        
+        if not item_id or quantity <= 0:
+            errors.append(f'Неверные данные для товара ID {item_data.get("item_id")}')
+            continue
+        
+        item = items.get(item_id)
+        if not item:
+            errors.append(f'Товар с ID {item_id} не найден')
+            continue
+        
+        old_quantity = quantities.get(item_id, item.current_quantity or 0)
+        
+        if operation_type == 'remove':
+            available_quantity = old_quantity - (item.reserved_quantity or 0)
+            if quantity > available_quantity:
+                errors.append(f'Товар "{item.name}": недостаточно остатков ({available_quantity} доступно)')
+                continue
+            new_quantity = old_quantity - quantity
+        else:
+            new_quantity = old_quantity + quantity
+        
+        quantities[item_id] = new_quantity
+        operation_rows.append({
+            'item_id': item_id,
+            'operation_type': operation_type,
+            'quantity_before': old_quantity,
+            'quantity_after': new_quantity,
+            'quantity_change': new_quantity - old_quantity,
+            'reason': item_data.get('reason', default_reason),
+            'comment': item_data.get('comment', ''),
+            'document_number': document_number,
+            'user_id': current_user_id,
+            'ip_address': ip_address,
+            'created_at': now
+        })
+    
+    # Названия запоминаем до commit, иначе каждый товар перечитается из базы
+    item_labels = {item.id: (item.name, item.unit) for item in items.values()}
+    
+    # 3. Итоговые остатки и одна пакетная вставка операций
+    if operation_rows:
+        for item_id, new_quantity in quantities.items():
+            item = items[item_id]
+            item.current_quantity = new_quantity
+            item.last_operation_at = now
+            item.updated_at = now
+        
+        WarehouseOperation.bulk_create(operation_rows)
+        if commit:
+            db.session.commit()
+    
+    # Компактный ответ без загрузки категорий по каждой операции
+    return {
+        'message': f'Обработано {len(operation_rows)} товаров',
+        'success_count': len(operation_rows),
+        'error_count': len(errors),
+        'errors': errors,
+        'operations': [
+            {
+                'item_id': row['item_id'],
+                'item_name': item_labels[row['item_id']][0],
+                'unit': item_labels[row['item_id']][1],
+                'operation_type': row['operation_type'],
+                'quantity_before': row['quantity_before'],
+                'quantity_after': row['quantity_after'],
+                'quantity_change': row['quantity_change'],
+                'reason': row['reason'],
+                'document_number': row['document_number'],
+                'created_at': row['created_at'].isoformat()
+            }
+            for row in operation_rows
+        ]
+    }
+
+
 # ============ ДОПОЛНИТЕЛЬНЫЕ ЭНДПОИНТЫ ============
 
 @warehouse_bp.route('/categories/hierarchy', methods=['GET'])
@@ -1833,26 +3018,21 @@ def bulk_remove_stock():
 def get_category_hierarchy():
     """Получить полную иерархию категорий"""
     try:
-        # Получаем все категории
-        all_categories = WarehouseCategory.query.order_by(WarehouseCategory.name).all()
-        
-        # Строим иерархию
-        def build_hierarchy(parent_id=None):
-            children = []
-            for category in all_categories:
-                if category.parent_id == parent_id:
-                    cat_data = category.to_dict()
-                    cat_data['items_count'] = category.get_items_count(include_subcategories=True)
-                    cat_data['children'] = build_hierarchy(category.id)
-                    children.append(cat_data)
-            return children
-        
-        hierarchy = build_hierarchy()
+        etag = _category_tree_etag()
+        not_modified = _not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        
+        all_categories, children, counts = _load_category_tree()
+        hierarchy = [
+            _category_tree_node(category, children, counts)
+            for category in children.get(None, [])
+        ]
         
-        return jsonify({
+        return _etag_response({
             'hierarchy': hierarchy,
             'total_categories': len(all_categories)
-        })
+        }, etag)
         
     except Exception as e:
         return jsonify({'error': f'Ошибка получения иерархии: {str(e)}'}), 500
@@ -1905,15 +3085,10 @@ def get_items_by_categories():
             return jsonify({'error': 'Неверный формат ID категорий'}), 400
         
         # Расширяем список категорий подкатегориями если нужно
-        all_category_ids = category_ids.copy()
-        
         if include_subcategories:
-            for cat_id in category_ids:
-                category = WarehouseCategory.query.get(cat_id)
-                if category:
-                    all_category_ids.extend(category.get_all_child_ids())
-        
-        all_category_ids = list(set(all_category_ids))
+            all_category_ids = WarehouseCategory.get_descendant_ids(category_ids)
+        else:
+            all_category_ids = list(set(category_ids))
         
         # Получаем товары
         query = WarehouseItem.query.join(WarehouseItemCategory).filter(
@@ -1927,7 +3102,7 @@ def get_items_by_categories():
             'category_ids': category_ids,
             'all_category_ids': all_category_ids,
             'include_subcategories': include_subcategories,
-            'items': [item.to_dict() for item in items],
+            'items': WarehouseItem.serialize_many(items),
             'total_items': len(items)
         })
         
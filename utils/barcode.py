@@ -1,46 +1,122 @@
 import requests
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+DEFAULT_SERVICE_URL = 'https://service-online.su/text/shtrih-kod/'
+REQUEST_TIMEOUT = 10
+
+# Общая сессия: keep-alive и пул соединений вместо нового TCP/TLS на каждый код
+_session = requests.Session()
+_session.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+})
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+
+
+def fetch_product_from_service_online(barcode: str, service_url: str = None):
+    """Запросить товар во внешнем сервисе.
+
+    Возвращает словарь с данными или None, если товар не найден.
+    Сетевые ошибки пробрасываются - такие ответы нельзя кешировать.
+    """
+    response = _session.get(
+        service_url or DEFAULT_SERVICE_URL,
+        params={'cod': barcode},
+        timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    return parse_service_online_page(response.text, barcode)
 
-def get_product_from_service_online(barcode: str):
-    try:
-        url = f"https://service-online.su/text/shtrih-kod/?cod={barcode}"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Ищем блок с зелёным текстом
-        info_div = soup.find('div', style=lambda value: value and "color: green" in value)
-        if not info_div:
-            return None
-
-        paragraphs = info_div.find_all('p')
-        if len(paragraphs) >= 3:
-            is_valid = 'верный' in paragraphs[0].get_text(strip=True)
-            country = get_info_by_name('Страна производитель ', paragraphs)
-            product_name = get_info_by_name('Это: ', paragraphs)
-            category = get_info_by_name('Категория:', paragraphs)
-
-            return {
-                'barcode': barcode,
-                'isValid': is_valid,
-                'country': country,
-                'name': product_name,
-                'category': category,
-                'source': 'service-online.su'
-            }
 
+def parse_service_online_page(html: str, barcode: str):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Ищем блок с зелёным текстом
+    info_div = soup.find('div', style=lambda value: value and "color: green" in value)
+    if not info_div:
         return None
+
+    paragraphs = info_div.find_all('p')
+    if len(paragraphs) >= 3:
+        is_valid = 'верный' in paragraphs[0].get_text(strip=True)
+        country = get_info_by_name('Страна производитель ', paragraphs)
+        product_name = get_info_by_name('Это: ', paragraphs)
+        category = get_info_by_name('Категория:', paragraphs)
+
+        return {
+            'barcode': barcode,
+            'isValid': is_valid,
+            'country': country,
+            'name': product_name,
+            'category': category,
+            'source': 'service-online.su'
+        }
+
+    return None
+
+
+def get_product_from_service_online(barcode: str, service_url: str = None):
+    try:
+        return fetch_product_from_service_online(barcode, service_url)
     except Exception as e:
         print(f"Service-Online parsing failed: {e}")
         return None
-    
+
+
+def lookup_barcodes(barcodes):
+    """Получить данные по списку штрих-кодов через кеш в БД.
+
+    Возвращает (results, errors): results - {barcode: данные или None},
+    errors - {barcode: текст ошибки} для кодов, которые не удалось запросить.
+    Промахи кеша запрашиваются параллельно; потоки выполняют только HTTP,
+    чтение и запись кеша идут в текущем потоке. Новые записи кеша
+    сохраняются коммитом вызывающего кода.
+    """
+    from models import BarcodeLookupCache
+
+    config = current_app.config
+    cached = BarcodeLookupCache.get_fresh(barcodes)
+    results = {barcode: entry.data if entry.found else None for barcode, entry in cached.items()}
+    misses = [barcode for barcode in barcodes if barcode not in cached]
+    errors = {}
+
+    if not misses:
+        return results, errors
+
+    service_url = config.get('BARCODE_SERVICE_URL') or DEFAULT_SERVICE_URL
+    max_workers = min(config.get('BARCODE_LOOKUP_WORKERS', 8), len(misses))
+    fetched = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_product_from_service_online, barcode, service_url): barcode
+            for barcode in misses
+        }
+        for future in as_completed(futures):
+            barcode = futures[future]
+            try:
+                fetched[barcode] = future.result()
+            except Exception as e:
+                print(f"❌ Ошибка запроса штрих-кода {barcode}: {e}")
+                errors[barcode] = str(e)
+
+    BarcodeLookupCache.store(
+        fetched,
+        positive_ttl=timedelta(days=config.get('BARCODE_CACHE_TTL_DAYS', 30)),
+        negative_ttl=timedelta(hours=config.get('BARCODE_NEGATIVE_CACHE_TTL_HOURS', 24))
+    )
+    results.update(fetched)
+    return results, errors
+
+
 def get_info_by_name(name: str, paragraphs) -> str:
     for paragraph in paragraphs:
         text = paragraph.get_text(strip=True)
         if name in text:
             return text.replace(name, '')
-    return ''
\ No newline at end of file
+    return ''
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class SnapshotCache:
+    """Кеш одного вычисляемого снимка (например, данных дашборда).
+
+    Снимок пересчитывается, когда меняется версия данных (DataVersion) или
+    истекает max_age, но не чаще одного раза в min_interval секунд.
+    Пересчёт выполняет только один поток: остальные в это время получают
+    предыдущий снимок, а если его ещё нет - ждут результат первого потока.
+    """
+
+    def __init__(self, min_interval=5, max_age=60):
+        self.min_interval = min_interval
+        self.max_age = max_age
+        self._condition = threading.Condition()
+        self._value = None
+        self._version = None
+        self._computed_at = 0.0
+        self._computing = False
+
+    def get(self, version, compute):
+        """Вернуть снимок для версии данных version, при необходимости вызвав compute()"""
+        with self._condition:
+            while True:
+                if self._value is not None and not self._is_stale(version):
+                    return self._value
+                if not self._computing:
+                    break
+                if self._value is not None:
+                    # Кто-то уже пересчитывает - отдаём предыдущий снимок
+                    return self._value
+                self._condition.wait()
+            self._computing = True
+
+        value = None
+        try:
+            value = compute()
+        finally:
+            with self._condition:
+                if value is not None:
+                    self._value = value
+                    self._version = version
+                    self._computed_at = time.monotonic()
+                self._computing = False
+                self._condition.notify_all()
+        return value
+
+    def invalidate(self):
+        """Сбросить снимок в этом процессе"""
+        with self._condition:
+            self._value = None
+            self._version = None
+
+    def _is_stale(self, version):
+        age = time.monotonic() - self._computed_at
+        if age < self.min_interval:
+            return False
+        return version != self._version or age >= self.max_age
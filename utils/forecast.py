@@ -0,0 +1,150 @@
+"""Прогноз расхода товаров склада.
+
+Дневной расход берётся из сводки WarehouseDailyMovement (списания), для всех
+товаров за один проход считаются скользящее среднее, экспоненциальное среднее
+(EWMA), разброс, дни до нуля и точка заказа. Расчёт векторизован на NumPy.
+Результат сохраняется в WarehouseItemForecast и отдаётся эндпоинтом
+/analytics/forecast.
+"""
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+
+from models import db, WarehouseItem, WarehouseDailyMovement, WarehouseItemForecast
+
+CONSUMPTION_OPERATION_TYPES = ('remove',)
+
+
+def _settings():
+    config = current_app.config
+    return {
+        'window_days': config.get('FORECAST_WINDOW_DAYS', 90),
+        'span_days': config.get('FORECAST_EWMA_SPAN_DAYS', 14),
+        'lead_time_days': config.get('FORECAST_LEAD_TIME_DAYS', 7),
+        'safety_factor': config.get('FORECAST_SAFETY_FACTOR', 1.65)
+    }
+
+
+def _load(window_days, today):
+    """Товары и разреженные ряды расхода: (items, [(item_id, индекс дня, количество)])"""
+    start_date = today - timedelta(days=window_days - 1)
+
+    items = db.session.query(
+        WarehouseItem.id,
+        WarehouseItem.current_quantity,
+        WarehouseItem.reserved_quantity,
+        WarehouseItem.max_quantity
+    ).filter(WarehouseItem.status == 'active').order_by(WarehouseItem.id).all()
+
+    usage = db.session.query(
+        WarehouseDailyMovement.item_id,
+        WarehouseDailyMovement.date,
+        db.func.sum(WarehouseDailyMovement.quantity_total)
+    ).filter(
+        WarehouseDailyMovement.operation_type.in_(CONSUMPTION_OPERATION_TYPES),
+        WarehouseDailyMovement.date >= start_date,
+        WarehouseDailyMovement.date <= today
+    ).group_by(WarehouseDailyMovement.item_id, WarehouseDailyMovement.date).all()
+
+    # Расход неактивных товаров в прогноз не попадает
+    active_ids = {item.id for item in items}
+    return items, [
+        (item_id, (date - start_date).days, quantity)
+        for item_id, date, quantity in usage if item_id in active_ids
+    ]
+
+
+def _ewma_weights(window_days, span_days):
+    """Веса EWMA по дням окна (последний день - самый тяжёлый), сумма = 1"""
+    alpha = 2.0 / (span_days + 1)
+    weights = [(1 - alpha) ** (window_days - 1 - day) for day in range(window_days)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+def _compute(items, usage, settings):
+    window_days = settings['window_days']
+    lead_time = settings['lead_time_days']
+
+    ids = np.fromiter((item.id for item in items), dtype=np.int64, count=len(items))
+    available = np.fromiter(
+        ((item.current_quantity or 0) - (item.reserved_quantity or 0) for item in items),
+        dtype=np.float64, count=len(items)
+    )
+    max_quantity = np.fromiter(
+        (item.max_quantity or 0 for item in items), dtype=np.float64, count=len(items)
+    )
+
+    sums = np.zeros(len(items))
+    squares = np.zeros(len(items))
+    weighted = np.zeros(len(items))
+
+    if usage:
+        usage_items, usage_days, usage_quantity = (np.asarray(column) for column in zip(*usage))
+        rows = np.searchsorted(ids, usage_items)
+        quantity = usage_quantity.astype(np.float64)
+        weights = np.asarray(_ewma_weights(window_days, settings['span_days']))
+
+        # Разреженные ряды: суммы по товарам без плотной матрицы товары x дни
+        sums = np.bincount(rows, weights=quantity, minlength=len(items))
+        squares = np.bincount(rows, weights=quantity * quantity, minlength=len(items))
+        weighted = np.bincount(rows, weights=quantity * weights[usage_days], minlength=len(items))
+
+    average = sums / window_days
+    std = np.sqrt(np.maximum(squares / window_days - average * average, 0))
+    ewma = weighted
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_to_stockout = np.where(ewma > 0, np.maximum(available, 0) / ewma, np.nan)
+
+    reorder_point = np.ceil(ewma * lead_time + settings['safety_factor'] * std * math.sqrt(lead_time))
+    suggested_order = np.where(
+        (ewma > 0) & (available <= reorder_point),
+        np.maximum(np.maximum(max_quantity, reorder_point) - available, 0),
+        0
+    )
+
+    return zip(
+        ids.tolist(), average.tolist(), ewma.tolist(), std.tolist(), available.tolist(),
+        days_to_stockout.tolist(), reorder_point.tolist(), suggested_order.tolist()
+    )
+
+
+def compute_forecasts(today=None):
+    """Пересчитать прогноз для всех активных товаров и сохранить его
+
+    Возвращает (количество товаров, время расчёта в секундах).
+    """
+    settings = _settings()
+    today = today or datetime.utcnow().date()
+    items, usage = _load(settings['window_days'], today)
+
+    started = datetime.utcnow()
+    results = list(_compute(items, usage, settings))
+    elapsed = (datetime.utcnow() - started).total_seconds()
+
+    now = datetime.utcnow()
+    rows = []
+    for item_id, average, ewma, std, available, days, reorder_point, suggested_order in results:
+        has_stockout = not math.isnan(days)
+        rows.append({
+            'item_id': item_id,
+            'window_days': settings['window_days'],
+            'average_daily_usage': average,
+            'ewma_daily_usage': ewma,
+            'usage_std': std,
+            'available_quantity': int(available),
+            'days_to_stockout': days if has_stockout else None,
+            'stockout_date': today + timedelta(days=int(days)) if has_stockout and days < 3650 else None,
+            'reorder_point': int(reorder_point),
+            'suggested_order': int(math.ceil(suggested_order)),
+            'computed_at': now
+        })
+
+    db.session.execute(WarehouseItemForecast.__table__.delete())
+    if rows:
+        db.session.execute(db.insert(WarehouseItemForecast), rows)
+
+    return len(rows), elapsed
@@ -1,8 +1,12 @@
 import uuid
 import os
+import json
+import base64
+import binascii
 from datetime import datetime
 from flask import request, current_app
 import re
+import zlib
 
 def generate_booking_number():
     """Генерация уникального номера заявки"""
@@ -151,6 +155,34 @@ def validate_pagination_params(page, per_page, max_per_page=100):
     except (ValueError, TypeError):
         return 1, 20
 
+def encode_cursor(values):
+    """Упаковать значения ключа сортировки в непрозрачный курсор пагинации"""
+    raw = json.dumps(values, separators=(',', ':'), default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Распаковать курсор пагинации, при неверном формате - ValueError"""
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(cursor + padding).decode('utf-8'))
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise ValueError('Неверный курсор пагинации') from e
+
+def accepts_gzip():
+    """Клиент принимает ответ, сжатый gzip"""
+    return request.accept_encodings['gzip'] > 0
+
+def gzip_stream(chunks, encoding='utf-8'):
+    """Сжимать поток текстовых или байтовых кусков gzip на лету"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(encoding)
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 def clean_html_tags(text):
     """Удаление HTML тегов из текста"""
     import re
@@ -0,0 +1,245 @@
+"""Импорт лидов из CSV.
+
+Файл читается построчно и сохраняется пачками. Телефоны нормализуются
+format_phone_number; существующие лиды всей пачки находятся одним запросом
+по индексу нормализованных телефонов (lead_phones) и обновляются, новые
+вставляются одним INSERT. Оценка качества считается для каждого лида пачки.
+Ошибки строк собираются в отчёт и не прерывают импорт остальных строк.
+"""
+import csv
+import io
+import re
+from datetime import datetime
+from itertools import chain
+
+from models import db, Lead, LeadPhone, Admin, refresh_lead_indexes
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+
+STATUSES = ('new', 'contacted', 'interested', 'qualified', 'converted', 'lost')
+TEMPERATURES = ('cold', 'warm', 'hot')
+
+# Заголовки колонок: как в экспорте лидов, плюс названия полей API
+COLUMN_ALIASES = {
+    'name': ('имя', 'name'),
+    'phone': ('телефон', 'phone'),
+    'email': ('email', 'e-mail'),
+    'source': ('источник', 'source'),
+    'status': ('статус', 'status'),
+    'temperature': ('температура', 'temperature'),
+    'preferred_budget': ('бюджет', 'preferred_budget'),
+    'event_type': ('тип события', 'event_type'),
+    'guests_count': ('количество гостей', 'guests_count'),
+    'birthday': ('день рождения', 'birthday'),
+    'age': ('возраст', 'age'),
+    'notes': ('заметки', 'notes'),
+    'manager': ('менеджер', 'manager'),
+}
+
+_HEADER_FIELDS = {alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases}
+
+_MAX_LENGTHS = {
+    'name': 100, 'email': 120, 'source': 50, 'preferred_budget': 50, 'event_type': 50
+}
+
+_TEXT_FIELDS = ('name', 'email', 'preferred_budget', 'event_type', 'notes')
+
+_DIGITS_RE = re.compile(r'\d')
+
+
+def read_lead_rows(file_storage):
+    """Итератор строк загруженного CSV в виде {поле: значение}
+
+    Выбрасывает ValueError, если это не CSV или в заголовке нет имени и телефона.
+    """
+    if not (file_storage.filename or '').lower().endswith('.csv'):
+        raise ValueError('Поддерживаются только файлы CSV')
+
+    text = io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    # Excel в русской локали сохраняет CSV через точку с запятой
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    rows = csv.reader(chain([first_line], text), delimiter=delimiter)
+
+    header = next(rows, None)
+    if header is None:
+        raise ValueError('Файл пуст')
+
+    fields = [_HEADER_FIELDS.get(cell.strip().lower()) for cell in header]
+    if 'name' not in fields or 'phone' not in fields:
+        raise ValueError('В файле нет колонок "Имя" и "Телефон"')
+
+    return ({field: value for field, value in zip(fields, row) if field} for row in rows)
+
+
+def import_lead_rows(rows, batch_size=DEFAULT_BATCH_SIZE):
+    """Импортировать строки пачками по batch_size и вернуть отчёт"""
+    report = {'total_rows': 0, 'created': 0, 'updated': 0, 'errors_count': 0, 'errors': []}
+    managers = {name.strip().lower(): admin_id for admin_id, name in db.session.query(Admin.id, Admin.name)}
+    batch = []
+
+    # Первая строка файла - заголовок
+    for row_number, raw in enumerate(rows, start=2):
+        if not any((value or '').strip() for value in raw.values()):
+            continue
+
+        report['total_rows'] += 1
+        try:
+            batch.append((row_number, _parse_row(raw, managers)))
+        except ValueError as e:
+            _add_error(report, row_number, str(e))
+
+        if len(batch) >= batch_size:
+            _import_batch(batch, report)
+            batch = []
+
+    if batch:
+        _import_batch(batch, report)
+
+    return report
+
+
+def _import_batch(batch, report):
+    """Сохранить пачку в отдельной транзакции; сбой пачки не останавливает импорт"""
+    try:
+        created, updated = _save_batch(batch)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка импорта пачки лидов {batch[0][0]}-{batch[-1][0]}: {e}")
+        for row_number, _ in batch:
+            _add_error(report, row_number, f'Пачка не сохранена: {e}')
+        return
+
+    report['created'] += created
+    report['updated'] += updated
+
+
+def _save_batch(batch):
+    existing = Lead.find_by_phones(data['phone'] for _, data in batch)
+
+    # Строки с одним телефоном сливаются: более поздние значения перекрывают ранние
+    new_leads = {}
+    updated = {}
+    for _, data in batch:
+        lead = existing.get(data['phone'])
+        if lead is not None:
+            # Телефон совпадает после нормализации - исходную запись номера не трогаем
+            for field, value in data.items():
+                if field != 'phone':
+                    setattr(lead, field, value)
+            updated[lead.id] = lead
+        else:
+            new_leads.setdefault(data['phone'], {}).update(data)
+
+    # Изменённые лиды сохраняются одним flush; индексы обновляют ORM-события
+    for lead in updated.values():
+        lead.calculate_quality_score()
+
+    if new_leads:
+        now = datetime.utcnow()
+        rows = []
+        for values in new_leads.values():
+            # Оценка качества считается тем же методом, что и для лидов из API
+            lead = Lead(**values)
+            rows.append({
+                'name': values['name'],
+                'phone': values['phone'],
+                'email': values.get('email'),
+                'source': values.get('source') or 'website',
+                'status': values.get('status') or 'new',
+                'stage': 'awareness',
+                'temperature': values.get('temperature') or 'cold',
+                'preferred_budget': values.get('preferred_budget'),
+                'event_type': values.get('event_type'),
+                'guests_count': values.get('guests_count'),
+                'birthday': values.get('birthday'),
+                'age': values.get('age'),
+                'notes': values.get('notes'),
+                'assigned_to': values.get('assigned_to'),
+                'contact_attempts': 0,
+                'preferred_contact_method': 'phone',
+                'quality_score': lead.calculate_quality_score(),
+                'created_at': now,
+                'updated_at': now
+            })
+
+        # render_nulls: строки с разными пустыми полями уходят одним executemany, а не по одной
+        new_ids = db.session.scalars(
+            db.insert(Lead).returning(Lead.id, sort_by_parameter_order=True).execution_options(render_nulls=True),
+            rows
+        ).all()
+        # Массовая вставка идёт мимо ORM-событий - обновляем индексы телефонов и дней рождения явно
+        refresh_lead_indexes(new_ids)
+
+    return len(new_leads), len(updated)
+
+
+def _parse_row(raw, managers):
+    """Проверить и привести значения строки; пустые ячейки не меняют лида"""
+    data = {}
+    for field in _TEXT_FIELDS:
+        value = (raw.get(field) or '').strip()
+        if value:
+            max_length = _MAX_LENGTHS.get(field)
+            if max_length and len(value) > max_length:
+                raise ValueError(f'Поле {field} длиннее {max_length} символов')
+            data[field] = value
+
+    if not data.get('name'):
+        raise ValueError('Не указано имя')
+
+    phone = LeadPhone.key((raw.get('phone') or '').strip())
+    digits = len(_DIGITS_RE.findall(phone))
+    if not 10 <= digits <= 15 or len(phone) > 20:
+        raise ValueError(f'Неверный номер телефона: "{(raw.get("phone") or "").strip()}"')
+    data['phone'] = phone
+
+    for field, allowed in (('status', STATUSES), ('temperature', TEMPERATURES)):
+        value = (raw.get(field) or '').strip().lower()
+        if value:
+            if value not in allowed:
+                raise ValueError(f'Поле {field}: недопустимое значение "{value}"')
+            data[field] = value
+
+    source = (raw.get('source') or '').strip().lower()
+    if source:
+        if len(source) > _MAX_LENGTHS['source']:
+            raise ValueError(f'Поле source длиннее {_MAX_LENGTHS["source"]} символов')
+        data['source'] = source
+
+    for field in ('guests_count', 'age'):
+        value = (raw.get(field) or '').strip()
+        if value:
+            if not value.isdigit():
+                raise ValueError(f'Поле {field}: ожидается целое неотрицательное число')
+            data[field] = int(value)
+
+    birthday = (raw.get('birthday') or '').strip()
+    if birthday:
+        data['birthday'] = _parse_date(birthday)
+
+    manager = (raw.get('manager') or '').strip()
+    if manager:
+        if manager.lower() not in managers:
+            raise ValueError(f'Менеджер "{manager}" не найден')
+        data['assigned_to'] = managers[manager.lower()]
+
+    return data
+
+
+def _parse_date(value):
+    for date_format in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value[:10], date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f'Дата рождения "{value}" не распознана (ожидается ГГГГ-ММ-ДД или ДД.ММ.ГГГГ)')
+
+
+def _add_error(report, row_number, message):
+    report['errors_count'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'row': row_number, 'error': message})
@@ -0,0 +1,266 @@
+"""Полнотекстовый поиск по товарам склада.
+
+SQLite - виртуальная таблица FTS5 (warehouse_items_fts) с ранжированием bm25,
+PostgreSQL - GIN-индексы pg_trgm и tsvector. Для остальных СУБД, а также
+если индекс недоступен, используется прежний поиск через ILIKE.
+"""
+import re
+
+from sqlalchemy import event, or_
+
+from models import db, WarehouseItem
+
+FTS_TABLE = 'warehouse_items_fts'
+MAX_QUERY_TOKENS = 10
+
+# Веса bm25 по колонкам FTS: name, barcode, sku, description
+BM25_WEIGHTS = (10.0, 5.0, 5.0, 1.0)
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Движки, для которых индекс уже проверен/создан: {url: backend}
+_backends = {}
+
+_fts = db.table(
+    FTS_TABLE,
+    db.column('rowid'),
+    db.column('name'),
+    db.column('barcode'),
+    db.column('sku'),
+    db.column('description')
+)
+
+
+def _tokens(text):
+    return _TOKEN_RE.findall((text or '').lower())[:MAX_QUERY_TOKENS]
+
+
+def _pg_document():
+    """Выражение tsvector; должно совпадать с выражением индекса"""
+    return db.func.to_tsvector(
+        db.literal_column("'simple'"),
+        db.func.coalesce(WarehouseItem.name, '') + ' ' + db.func.coalesce(WarehouseItem.description, '')
+    )
+
+
+# Индексы PostgreSQL: DDL, а не db.Index, чтобы не добавлять их в метаданные таблицы
+# (create_all создал бы их и на других СУБД). Выражение tsvector совпадает с _pg_document()
+PG_INDEXES = {
+    'ix_warehouse_items_search_tsv': (
+        "CREATE INDEX IF NOT EXISTS ix_warehouse_items_search_tsv ON warehouse_items USING gin "
+        "(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(description, '')))"
+    ),
+    'ix_warehouse_items_name_trgm': (
+        'CREATE INDEX IF NOT EXISTS ix_warehouse_items_name_trgm ON warehouse_items USING gin (name gin_trgm_ops)'
+    ),
+    'ix_warehouse_items_barcode_trgm': (
+        'CREATE INDEX IF NOT EXISTS ix_warehouse_items_barcode_trgm ON warehouse_items USING gin (barcode gin_trgm_ops)'
+    ),
+    'ix_warehouse_items_sku_trgm': (
+        'CREATE INDEX IF NOT EXISTS ix_warehouse_items_sku_trgm ON warehouse_items USING gin (sku gin_trgm_ops)'
+    ),
+}
+
+
+def _fts_table_exists(connection):
+    return connection.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': FTS_TABLE}
+    ).first() is not None
+
+
+def _populate_fts(connection):
+    connection.execute(db.text(f'DELETE FROM {FTS_TABLE}'))
+    result = connection.execute(_fts.insert().from_select(
+        ['rowid', 'name', 'barcode', 'sku', 'description'],
+        db.select(
+            WarehouseItem.id,
+            WarehouseItem.name,
+            WarehouseItem.barcode,
+            WarehouseItem.sku,
+            WarehouseItem.description
+        )
+    ))
+    return result.rowcount
+
+
+def ensure_item_search_index():
+    """Создать поисковый индекс при необходимости и вернуть используемый бэкенд.
+
+    Возвращает 'fts5', 'postgresql' или 'like'.
+    """
+    engine = db.engine
+    key = str(engine.url)
+    if key in _backends:
+        return _backends[key]
+
+    backend = 'like'
+    try:
+        with engine.begin() as connection:
+            if engine.dialect.name == 'sqlite':
+                if not _fts_table_exists(connection):
+                    connection.execute(db.text(
+                        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                        f"name, barcode, sku, description, "
+                        f"tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+                    ))
+                    _populate_fts(connection)
+                backend = 'fts5'
+            elif engine.dialect.name == 'postgresql':
+                connection.execute(db.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                for ddl in PG_INDEXES.values():
+                    connection.execute(db.text(ddl))
+                backend = 'postgresql'
+    except Exception as e:
+        print(f"⚠️ Поисковый индекс недоступен, используется ILIKE: {e}")
+        backend = 'like'
+
+    _backends[key] = backend
+    return backend
+
+
+def rebuild_item_search_index():
+    """Полностью перестроить поисковый индекс. Возвращает (backend, количество товаров)"""
+    _backends.pop(str(db.engine.url), None)
+    backend = ensure_item_search_index()
+
+    if backend == 'fts5':
+        with db.engine.begin() as connection:
+            return backend, _populate_fts(connection)
+
+    if backend == 'postgresql':
+        with db.engine.begin() as connection:
+            for name in PG_INDEXES:
+                connection.execute(db.text(f'REINDEX INDEX {name}'))
+
+    return backend, WarehouseItem.query.count()
+
+
+def refresh_item_search_index(item_ids):
+    """Обновить строки индекса для товаров, изменённых массовыми запросами мимо ORM-событий"""
+    item_ids = list(item_ids)
+    if not item_ids:
+        return
+    connection = db.session.connection()
+    if not _fts_enabled(connection):
+        return
+    connection.execute(_fts.delete().where(_fts.c.rowid.in_(item_ids)))
+    connection.execute(_fts.insert().from_select(
+        ['rowid', 'name', 'barcode', 'sku', 'description'],
+        db.select(
+            WarehouseItem.id,
+            WarehouseItem.name,
+            WarehouseItem.barcode,
+            WarehouseItem.sku,
+            WarehouseItem.description
+        ).where(WarehouseItem.id.in_(item_ids))
+    ))
+
+
+def _like_filter(text):
+    search_filter = f"%{text}%"
+    return or_(
+        WarehouseItem.name.ilike(search_filter),
+        WarehouseItem.barcode.ilike(search_filter),
+        WarehouseItem.sku.ilike(search_filter),
+        WarehouseItem.description.ilike(search_filter)
+    )
+
+
+def apply_item_search(query, text, rank=False):
+    """Добавить к запросу товаров фильтр поиска по тексту.
+
+    Штрих-коды и артикулы ищутся по префиксу, название и описание - по
+    префиксам слов. При rank=True результаты упорядочиваются по релевантности
+    (название весит больше остальных полей).
+    """
+    text = (text or '').strip()
+    tokens = _tokens(text)
+    if not tokens:
+        return query.filter(_like_filter(text)) if text else query
+
+    backend = ensure_item_search_index()
+
+    if backend == 'fts5':
+        match = db.literal_column(FTS_TABLE).op('MATCH')(
+            ' '.join(f'"{token}"*' for token in tokens)
+        )
+        if not rank:
+            return query.filter(WarehouseItem.id.in_(
+                db.select(_fts.c.rowid).where(match)
+            ))
+
+        matches = db.select(
+            _fts.c.rowid.label('item_id'),
+            db.func.bm25(db.literal_column(FTS_TABLE), *BM25_WEIGHTS).label('rank')
+        ).where(match).subquery()
+        return query.join(matches, matches.c.item_id == WarehouseItem.id).order_by(
+            matches.c.rank, WarehouseItem.name
+        )
+
+    if backend == 'postgresql':
+        ts_query = db.func.to_tsquery(
+            db.literal_column("'simple'"),
+            ' & '.join(f'{token}:*' for token in tokens)
+        )
+        query = query.filter(or_(
+            _pg_document().op('@@')(ts_query),
+            WarehouseItem.name.ilike(f'%{text}%'),
+            WarehouseItem.barcode.ilike(f'{text}%'),
+            WarehouseItem.sku.ilike(f'{text}%')
+        ))
+        if rank:
+            query = query.order_by(
+                (db.func.ts_rank(_pg_document(), ts_query) + db.func.similarity(WarehouseItem.name, text)).desc(),
+                WarehouseItem.name
+            )
+        return query
+
+    query = query.filter(_like_filter(text))
+    return query.order_by(WarehouseItem.name) if rank else query
+
+
+# ============ СИНХРОНИЗАЦИЯ FTS5 С ТАБЛИЦЕЙ ТОВАРОВ ============
+# В PostgreSQL индексы строятся по выражениям и обновляются самой СУБД.
+
+SEARCH_FIELDS = ('name', 'barcode', 'sku', 'description')
+
+
+def _fts_enabled(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    if _backends.get(str(connection.engine.url)) == 'fts5':
+        return True
+    return _fts_table_exists(connection)
+
+
+def _fts_replace(connection, target):
+    connection.execute(_fts.delete().where(_fts.c.rowid == target.id))
+    connection.execute(_fts.insert().values(
+        rowid=target.id,
+        name=target.name,
+        barcode=target.barcode,
+        sku=target.sku,
+        description=target.description
+    ))
+
+
+@event.listens_for(WarehouseItem, 'after_insert')
+def _search_index_after_insert(mapper, connection, target):
+    if _fts_enabled(connection):
+        _fts_replace(connection, target)
+
+
+@event.listens_for(WarehouseItem, 'after_update')
+def _search_index_after_update(mapper, connection, target):
+    state = db.inspect(target)
+    if not any(state.attrs[field].history.has_changes() for field in SEARCH_FIELDS):
+        return
+    if _fts_enabled(connection):
+        _fts_replace(connection, target)
+
+
+@event.listens_for(WarehouseItem, 'after_delete')
+def _search_index_after_delete(mapper, connection, target):
+    if _fts_enabled(connection):
+        connection.execute(_fts.delete().where(_fts.c.rowid == target.id))
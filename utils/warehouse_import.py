@@ -0,0 +1,342 @@
+"""Импорт каталога товаров склада из CSV/XLSX.
+
+Файл читается построчно и сохраняется пачками: в каждой пачке категории
+разрешаются одним запросом, существующие товары находятся по штрих-коду или
+артикулу и обновляются, новые вставляются одним INSERT. Ошибки строк
+собираются в отчёт и не прерывают импорт остальных строк.
+"""
+import csv
+import io
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import chain
+
+from sqlalchemy import or_
+
+from models import (
+    db, WarehouseItem, WarehouseCategory, WarehouseItemCategory, WarehouseOperation, WarehouseDailyValuation
+)
+from utils.search import refresh_item_search_index
+
+try:
+    from openpyxl import load_workbook
+except ImportError:  # XLSX доступен только при установленном openpyxl
+    load_workbook = None
+
+DEFAULT_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+DEFAULT_CATEGORY_NAME = 'Без категории'
+
+# Заголовки колонок: как в экспорте остатков, плюс названия полей API
+COLUMN_ALIASES = {
+    'name': ('название', 'наименование', 'name'),
+    'barcode': ('штрих-код', 'штрихкод', 'barcode'),
+    'sku': ('артикул', 'sku'),
+    'description': ('описание', 'description'),
+    'categories': ('категории', 'категория', 'categories', 'category'),
+    'unit': ('единица', 'ед. изм.', 'unit'),
+    'current_quantity': ('текущее количество', 'количество', 'current_quantity', 'quantity'),
+    'min_quantity': ('мин. количество', 'min_quantity'),
+    'max_quantity': ('макс. количество', 'max_quantity'),
+    'cost_price': ('себестоимость', 'cost_price'),
+}
+
+_HEADER_FIELDS = {alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases}
+
+_MAX_LENGTHS = {'name': 200, 'barcode': 100, 'sku': 50, 'unit': 20}
+
+
+def read_item_rows(file_storage):
+    """Итератор строк загруженного файла в виде {поле: значение}
+
+    Выбрасывает ValueError, если формат не поддерживается или нет заголовка.
+    """
+    filename = (file_storage.filename or '').lower()
+    if filename.endswith('.xlsx'):
+        rows = _read_xlsx(file_storage.stream)
+    elif filename.endswith('.csv'):
+        rows = _read_csv(file_storage.stream)
+    else:
+        raise ValueError('Поддерживаются файлы CSV и XLSX')
+
+    header = next(rows, None)
+    if header is None:
+        raise ValueError('Файл пуст')
+
+    fields = [_HEADER_FIELDS.get(_text(cell).lower()) for cell in header]
+    if 'name' not in fields:
+        raise ValueError('В файле нет колонки "Название"')
+
+    return ({field: value for field, value in zip(fields, row) if field} for row in rows)
+
+
+def _read_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    # Excel в русской локали сохраняет CSV через точку с запятой
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    return csv.reader(chain([first_line], text), delimiter=delimiter)
+
+
+def _read_xlsx(stream):
+    if load_workbook is None:
+        raise ValueError('Импорт XLSX недоступен: на сервере не установлен openpyxl')
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    return workbook.active.iter_rows(values_only=True)
+
+
+def import_item_rows(rows, user_id=None, ip_address=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Импортировать строки пачками по batch_size и вернуть отчёт"""
+    report = {'total_rows': 0, 'created': 0, 'updated': 0, 'errors_count': 0, 'errors': []}
+    batch = []
+
+    # Первая строка файла - заголовок
+    for row_number, raw in enumerate(rows, start=2):
+        if not any(_text(value) for value in raw.values()):
+            continue
+
+        report['total_rows'] += 1
+        try:
+            batch.append((row_number, _parse_row(raw)))
+        except ValueError as e:
+            _add_error(report, row_number, str(e))
+
+        if len(batch) >= batch_size:
+            _import_batch(batch, report, user_id, ip_address)
+            batch = []
+
+    if batch:
+        _import_batch(batch, report, user_id, ip_address)
+
+    return report
+
+
+def _import_batch(batch, report, user_id, ip_address):
+    """Сохранить пачку в отдельной транзакции; сбой пачки не останавливает импорт"""
+    try:
+        created, updated, errors = _save_batch(batch, user_id, ip_address)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Ошибка импорта пачки строк {batch[0][0]}-{batch[-1][0]}: {e}")
+        for row_number, _ in batch:
+            _add_error(report, row_number, f'Пачка не сохранена: {e}')
+        return
+
+    report['created'] += created
+    report['updated'] += updated
+    for row_number, message in errors:
+        _add_error(report, row_number, message)
+
+
+def _save_batch(batch, user_id, ip_address):
+    barcodes = {data['barcode'] for _, data in batch if data.get('barcode')}
+    skus = {data['sku'] for _, data in batch if data.get('sku')}
+
+    # Владельцы штрих-кодов и артикулов: существующий товар или новая строка пачки
+    owners = {}
+    if barcodes or skus:
+        for item in WarehouseItem.query.filter(or_(
+            WarehouseItem.barcode.in_(barcodes),
+            WarehouseItem.sku.in_(skus)
+        )).all():
+            if item.barcode:
+                owners[('barcode', item.barcode)] = item
+            if item.sku:
+                owners[('sku', item.sku)] = item
+
+    category_ids = WarehouseCategory.resolve_names(
+        name for _, data in batch for name in data.get('categories') or []
+    )
+
+    new_items = []
+    category_updates = {}
+    updated_ids = set()
+    errors = []
+
+    for row_number, data in batch:
+        keys = [(field, data[field]) for field in ('barcode', 'sku') if data.get(field)]
+        matched = {id(owners[key]): owners[key] for key in keys if key in owners}
+        if len(matched) > 1:
+            errors.append((row_number, 'Штрих-код и артикул принадлежат разным товарам'))
+            continue
+
+        target = next(iter(matched.values()), None)
+        if target is None:
+            target = {'row': row_number, 'values': {}, 'categories': None}
+            new_items.append(target)
+        for key in keys:
+            owners[key] = target
+
+        values = {field: value for field, value in data.items() if field != 'categories'}
+        categories = [category_ids[name] for name in data.get('categories') or []]
+
+        if isinstance(target, WarehouseItem):
+            # Остатки существующих товаров импорт не меняет - только операции склада
+            values.pop('current_quantity', None)
+            for field, value in values.items():
+                setattr(target, field, value)
+            if categories:
+                category_updates[target.id] = categories
+            updated_ids.add(target.id)
+        else:
+            target['values'].update(values)
+            if categories:
+                target['categories'] = categories
+
+    # Корневые категории до замены - для переноса стоимости в сводке
+    roots_before = WarehouseDailyValuation.item_roots(category_updates)
+    if category_updates:
+        WarehouseItemCategory.query.filter(
+            WarehouseItemCategory.item_id.in_(list(category_updates))
+        ).delete(synchronize_session=False)
+    db.session.flush()
+
+    links = [
+        {'item_id': item_id, 'category_id': category_id}
+        for item_id, ids in category_updates.items()
+        for category_id in dict.fromkeys(ids)
+    ]
+
+    operations = []
+    new_ids = []
+    if new_items:
+        if any(not new_item['categories'] for new_item in new_items):
+            default_id = WarehouseCategory.resolve_names([DEFAULT_CATEGORY_NAME])[DEFAULT_CATEGORY_NAME]
+        else:
+            default_id = None
+
+        now = datetime.utcnow()
+        rows = []
+        for new_item in new_items:
+            values = new_item['values']
+            quantity = values.get('current_quantity') or 0
+            rows.append({
+                'name': values['name'],
+                'barcode': values.get('barcode'),
+                'sku': values.get('sku'),
+                'description': values.get('description', ''),
+                'unit': values.get('unit') or 'шт',
+                'min_quantity': values.get('min_quantity') or 0,
+                'max_quantity': values.get('max_quantity') if values.get('max_quantity') is not None else 1000,
+                'cost_price': values.get('cost_price') or 0,
+                'current_quantity': quantity,
+                'reserved_quantity': 0,
+                'status': 'active',
+                'created_at': now,
+                'updated_at': now,
+                'last_operation_at': now if quantity > 0 else None
+            })
+
+        new_ids = db.session.scalars(
+            db.insert(WarehouseItem).returning(WarehouseItem.id, sort_by_parameter_order=True),
+            rows
+        ).all()
+
+        for item_id, new_item, row in zip(new_ids, new_items, rows):
+            for category_id in dict.fromkeys(new_item['categories'] or [default_id]):
+                links.append({'item_id': item_id, 'category_id': category_id})
+            if row['current_quantity'] > 0:
+                operations.append({
+                    'item_id': item_id,
+                    'operation_type': 'add',
+                    'quantity_before': 0,
+                    'quantity_after': row['current_quantity'],
+                    'quantity_change': row['current_quantity'],
+                    'reason': 'Начальный остаток',
+                    'comment': 'Импорт каталога',
+                    'document_number': None,
+                    'user_id': user_id,
+                    'ip_address': ip_address,
+                    'created_at': now
+                })
+
+    if links:
+        now = datetime.utcnow()
+        for link in links:
+            link['created_at'] = now
+        db.session.execute(db.insert(WarehouseItemCategory), links)
+
+    # Операции - после связей, чтобы стоимость попала в сводку по своей категории
+    WarehouseOperation.bulk_create(operations)
+    WarehouseDailyValuation.record_moves(roots_before)
+    # Массовая вставка идёт мимо ORM-событий - обновляем поисковый индекс явно
+    refresh_item_search_index(new_ids)
+
+    return len(new_items), len(updated_ids), errors
+
+
+def _parse_row(raw):
+    """Проверить и привести значения строки; пустые ячейки не меняют товар"""
+    data = {}
+    for field in ('name', 'barcode', 'sku', 'description', 'unit'):
+        value = _text(raw.get(field))
+        if value:
+            max_length = _MAX_LENGTHS.get(field)
+            if max_length and len(value) > max_length:
+                raise ValueError(f'Поле {field} длиннее {max_length} символов')
+            data[field] = value
+
+    if not data.get('name'):
+        raise ValueError('Не указано название товара')
+
+    for field in ('current_quantity', 'min_quantity', 'max_quantity'):
+        value = _parse_int(raw.get(field), field)
+        if value is not None:
+            data[field] = value
+
+    cost_price = _parse_price(raw.get('cost_price'))
+    if cost_price is not None:
+        data['cost_price'] = cost_price
+
+    categories = [name.strip() for name in _text(raw.get('categories')).split(',') if name.strip()]
+    if categories:
+        data['categories'] = categories
+
+    return data
+
+
+def _text(value):
+    if value is None:
+        return ''
+    # Числовые ячейки XLSX (штрих-коды) приходят как float
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _number_text(value):
+    return _text(value).replace('\xa0', '').replace(' ', '').replace(',', '.')
+
+
+def _parse_int(value, field):
+    text = _number_text(value)
+    if not text:
+        return None
+    try:
+        number = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f'Поле {field}: "{_text(value)}" не является числом')
+    if number < 0 or number != number.to_integral_value():
+        raise ValueError(f'Поле {field}: ожидается целое неотрицательное число')
+    return int(number)
+
+
+def _parse_price(value):
+    text = _number_text(value)
+    if not text:
+        return None
+    try:
+        price = Decimal(text).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'Себестоимость "{_text(value)}" не является числом')
+    if price < 0:
+        raise ValueError('Себестоимость не может быть отрицательной')
+    return price
+
+
+def _add_error(report, row_number, message):
+    report['errors_count'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'row': row_number, 'error': message})